@@ -0,0 +1,47 @@
+"""Computes the per-band pixel_mean and pixel_std of a dataset for use in a config.
+
+Run with
+    python compute_pixel_stats.py --cfgfile $path_to_config --metadata $path_to_dicts --num-workers 16
+The image reader and key mapper are taken from cfg.dataloader, so the statistics match the
+scaled images the model is trained on.
+"""
+
+import argparse
+import json
+
+from detectron2.config import LazyConfig
+
+from deepdisc.data_format.image_stats import compute_pixel_stats, format_pixel_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cfgfile", required=True, help="The config with dataloader.imagereader/key_mapper")
+    parser.add_argument("--metadata", required=True, help="The dataset dicts stored in json format")
+    parser.add_argument("--num-workers", type=int, default=1, help="The number of worker processes")
+    parser.add_argument(
+        "--quantiles", type=float, nargs="*", default=None, help="Quantiles to estimate, e.g. 0.001 0.999"
+    )
+    parser.add_argument("--output", default=None, help="Also write the statistics to this json file")
+    args = parser.parse_args()
+
+    cfg = LazyConfig.load(args.cfgfile)
+    stats = compute_pixel_stats(
+        args.metadata,
+        cfg.dataloader.imagereader,
+        cfg.dataloader.key_mapper,
+        num_workers=args.num_workers,
+        quantiles=args.quantiles,
+    )
+
+    print(format_pixel_stats(stats))
+    if "quantiles" in stats:
+        for q, values in stats["quantiles"].items():
+            print(f"# quantile {q}: {values}")
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,8 @@ from astropy.wcs import WCS
 from matplotlib.patches import Ellipse
 from scipy.stats import median_abs_deviation as mad
 
+from deepdisc.preprocessing.starlet import starlet_transform
+
 
 def write_scarlet_results(
     datas,
@@ -267,7 +269,7 @@ def make_catalog(
             detect = detect_image.mean(axis=0)
     else:
         if wave:
-            wave_detect = scarlet.Starlet.from_image(detect_image).coefficients
+            wave_detect = starlet_transform(detect_image, scales=3)
             detect = wave_detect[0] + wave_detect[1] + wave_detect[2]
         else:
             detect = detect_image
@@ -321,7 +323,7 @@ def mad_wavelet_own(image):
     # Scale =1/1.4826 to replicate older scipy MAD behavior
     scale = 1 / 1.4826
     sigma = astromad(
-        scarlet.Starlet.from_image(image, scales=2).coefficients[0, ...],
+        starlet_transform(image, scales=2)[..., 0, :, :],
         axis=(-2, -1),
         ignore_nan=True,
     )
@@ -0,0 +1,196 @@
+"""Reading the per-source masks written by the scarlet preprocessing.
+
+Two layouts of a mask file are understood:
+
+- one ImageHDU per source after an empty primary HDU, with the source metadata in the headers
+- the packed layout of `write_packed_masks`: a "SOURCES" BinTableHDU with one row of metadata
+  per source, and a "PIXELS" ImageHDU with the footprint crops of all sources flattened and
+  concatenated.  Row k of the table holds the OFFSET, HEIGHT and WIDTH of crop k.  Opening a
+  file of this layout costs the same for any number of sources.
+"""
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+
+def image_shape(filename, ext=0):
+    """Returns the shape of a FITS image from its header, without reading the data
+
+    Parameters
+    ----------
+    filename : str
+        The FITS file
+    ext : int
+        The HDU of the image. Default is 0
+
+    Returns
+    -------
+    tuple
+        The numpy shape of the image, e.g. (height, width)
+    """
+    with fits.open(filename, memmap=False, lazy_load_hdus=True) as hdul:
+        header = hdul[ext].header
+        return tuple(header[f"NAXIS{k}"] for k in range(header["NAXIS"], 0, -1))
+
+
+def write_packed_masks(filename, masks, columns, dtype=None, overwrite=True):
+    """Writes source masks and metadata in the packed layout
+
+    Parameters
+    ----------
+    filename : str
+        The FITS file to write
+    masks : list[array]
+        The 2D footprint crop of each source
+    columns : dict
+        The metadata columns, each an array with one entry per source, e.g. BBOX and AREA.
+        Names are case insensitive for SourceMasks, like header keywords.
+    dtype : numpy dtype (optional)
+        The dtype the pixels are stored as, e.g. np.uint8 for 0/1 masks.
+        Default is None (the common dtype of the masks)
+    overwrite : bool
+        Whether to overwrite an existing file. Default is True
+    """
+    shapes = np.array([np.shape(m) for m in masks], dtype=np.int64).reshape(-1, 2)
+    sizes = shapes[:, 0] * shapes[:, 1]
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+    if dtype is None:
+        dtype = np.result_type(*masks) if len(masks) > 0 else np.uint8
+    pixels = np.empty(int(sizes.sum()), dtype=dtype)
+    for m, offset, size in zip(masks, offsets, sizes):
+        pixels[offset : offset + size] = np.ravel(m)
+
+    table = Table({name: np.asarray(value) for name, value in columns.items()})
+    table["OFFSET"] = offsets
+    table["HEIGHT"] = shapes[:, 0]
+    table["WIDTH"] = shapes[:, 1]
+
+    hdul = fits.HDUList(
+        [
+            fits.PrimaryHDU(),
+            fits.BinTableHDU(table, name="SOURCES"),
+            fits.ImageHDU(data=pixels, name="PIXELS"),
+        ]
+    )
+    hdul.writeto(filename, overwrite=overwrite)
+
+
+def _is_packed(hdul):
+    return len(hdul) > 1 and hdul[1].name == "SOURCES"
+
+
+class SourceMasks:
+    """Reads the masks and metadata of the sources of a mask file, in either layout
+
+    The metadata of all sources are read in one pass into columns, and the data of a source is
+    only decoded when it is requested, so a file with thousands of sources is not read at once.
+    Use as a context manager, as the file stays open for the lazy reads.
+
+    Examples
+    --------
+    >>> with SourceMasks(mask, ["BBOX", "objid"]) as masks:
+    ...     for i in range(len(masks)):
+    ...         x, y, w, h = masks.bbox[i]
+    ...         data = masks.data(i)
+    """
+
+    def __init__(self, filename, keys=(), defaults=None, first=1):
+        """
+        Parameters
+        ----------
+        filename : str
+            The mask file
+        keys : list[str]
+            The header keywords (or table columns) to read into columns.  A missing keyword
+            raises a KeyError unless it has a default.
+        defaults : dict (optional)
+            Default values of keywords, used for every source if any source lacks the keyword
+        first : int
+            The first HDU of the sources, in the layout with one HDU per source.
+            Default is 1 (after an empty primary HDU)
+        """
+        self._hdul = fits.open(filename, memmap=False, lazy_load_hdus=True)
+        try:
+            if _is_packed(self._hdul):
+                rows, missing = self._read_table(list(keys), defaults or {}, filename)
+            else:
+                rows, missing = self._read_headers(list(keys), defaults or {}, first, filename)
+        except Exception:
+            self._hdul.close()
+            raise
+
+        self.columns = {}
+        for j, key in enumerate(keys):
+            if key in missing:
+                self.columns[key] = [defaults[key]] * len(self)
+            else:
+                self.columns[key] = rows[j]
+        if "BBOX" in self.columns:
+            self.bbox = [list(map(int, b.split(","))) for b in self.columns["BBOX"]]
+
+    def _read_headers(self, keys, defaults, first, filename):
+        self._hdus = self._hdul[first:]
+        self._n = len(self._hdus)
+        missing = set()
+        rows = []
+        for hdu in self._hdus:
+            header = hdu.header
+            row = []
+            for key in keys:
+                if key in header:
+                    row.append(header[key])
+                elif key in defaults:
+                    missing.add(key)
+                    row.append(None)
+                else:
+                    raise KeyError(f"Keyword '{key}' not found in {filename}")
+            rows.append(row)
+        return [[row[j] for row in rows] for j in range(len(keys))], missing
+
+    def _read_table(self, keys, defaults, filename):
+        self._hdus = None
+        table = self._hdul["SOURCES"].data
+        names = {name.upper(): name for name in table.columns.names}
+        self._n = len(table)
+        self._offsets = np.asarray(table[names["OFFSET"]])
+        self._shapes = np.column_stack([table[names["HEIGHT"]], table[names["WIDTH"]]])
+        self._pixels = self._hdul["PIXELS"]
+
+        missing = set()
+        columns = []
+        for key in keys:
+            if key.upper() in names:
+                columns.append(table[names[key.upper()]].tolist())
+            elif key in defaults:
+                missing.add(key)
+                columns.append(None)
+            else:
+                raise KeyError(f"Column '{key}' not found in {filename}")
+        return columns, missing
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def data(self, i):
+        """Reads and returns the data of source i, without keeping it cached in the file"""
+        if self._hdus is None:
+            h, w = self._shapes[i]
+            offset = self._offsets[i]
+            return self._pixels.section[offset : offset + h * w].reshape(h, w)
+        hdu = self._hdus[i]
+        data = hdu.data
+        del hdu.data
+        return data
+
+    def close(self):
+        self._hdul.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
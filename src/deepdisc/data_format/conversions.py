@@ -38,6 +38,38 @@ def fitsim_to_numpy(img_files, outdir):
     return
 
 
+def fitsim_psfs_to_grid(filenames, grid_shape, filters=["u", "g", "r", "i", "z", "y"]):
+    """Converts full resolution {filename}_{band}_psfs.fits PSF images to coarse PSF grids
+
+    The PSF images are smooth bilinear interpolations of a coarse grid, so only the pixels at
+    the grid knots are kept.  The grids are written to {filename}_psfgrid.npy with dimensions
+    (band, h, w) and are upsampled again by wlDC2psfImageReader(psf_grid=True).  The round trip
+    is exact when (H - 1) is a multiple of (h - 1) for an image of size H.
+
+    Parameters
+    ----------
+    filenames: list[str]
+        The filename prefixes, one per cutout
+    grid_shape: (int, int)
+        The (h, w) shape of the coarse grids
+    filters: list[str]
+        The bands of the PSF images, in channel order
+    """
+
+    for filename in filenames:
+        grid = []
+        for band in filters:
+            with fits.open(f"{filename}_{band}_psfs.fits", memmap=False, lazy_load_hdus=False) as hdul:
+                data = hdul[0].data
+            rows = np.round(np.linspace(0, data.shape[0] - 1, grid_shape[0])).astype(int)
+            cols = np.round(np.linspace(0, data.shape[1] - 1, grid_shape[1])).astype(int)
+            grid.append(data[np.ix_(rows, cols)])
+
+        np.save(f"{filename}_psfgrid.npy", np.array(grid, dtype=np.float32))
+
+    return
+
+
 def fitsim_to_hdf5(img_files, outname, dset="train"):
     """Converts a list of single-band FITS images to flattened multi-band images in an hdf5 file
 
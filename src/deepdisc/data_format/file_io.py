@@ -1,7 +1,12 @@
+import fnmatch
 import glob
+import hashlib
 import json
+import multiprocessing as mp
 import ntpath
 import os
+import time
+import traceback
 from pathlib import Path
 
 import numpy as np
@@ -20,13 +25,22 @@ class DDLoader:
     def __init__(self):
         self.filedict = None
         self.dataset = None
+        self.failures = []
 
     def get_dataset(self):
         """retrieves the list of dataset_dicts if established."""
         return self.dataset
 
     def generate_filedict(
-        self, dirpath, filters, img_files, mask_files, subdirs=False, filt_loc=0, n_samples=None
+        self,
+        dirpath,
+        filters,
+        img_files,
+        mask_files,
+        subdirs=False,
+        filt_loc=0,
+        n_samples=None,
+        manifest_file=None,
     ):
         """Generates a path dictionary from a directory of files.
 
@@ -56,6 +70,10 @@ class DDLoader:
         n_samples: int
             If specified, filters down to a subset of the dataset that contains
             `n_samples` image files per filter.
+        manifest_file: str
+            If specified, the directory listing is saved to this JSON file with
+            the modification time of every directory, and later calls only
+            list the directories that changed since. See `scan_tree`.
 
         Returns
         -------
@@ -68,38 +86,59 @@ class DDLoader:
         filenames_dict = {}
         filenames_dict["filters"] = filters
 
-        # Glob in filenames from the paths
-        if subdirs:
-            imgs = sorted(glob.glob(os.path.join(dirpath, "*","*","*", img_files)))
-            masks = sorted(glob.glob(os.path.join(dirpath, "*","*","*", mask_files)))
-        else:
-            imgs = sorted(glob.glob(os.path.join(dirpath, img_files)))
-            masks = sorted(glob.glob(os.path.join(dirpath, mask_files)))
+        # List the directories once and match both patterns against the listing
+        depth = 3 if subdirs else 0
+        manifest = load_manifest(manifest_file, dirpath, depth) if manifest_file else None
+        tree = scan_tree(dirpath, depth, manifest=manifest)
+        if manifest_file:
+            save_manifest(manifest_file, dirpath, depth, tree)
+        imgs = match_files(dirpath, tree, img_files)
+        masks = match_files(dirpath, tree, mask_files)
 
-        # Assign files to the dictionary by filter
+        # Assign files to the dictionary by filter, in one pass over the images
         # Requires good assignment of the img_files and filt_loc parameters
         for filt in filenames_dict["filters"]:
             filenames_dict[filt] = {}
-            if n_samples:
-                filenames_dict[filt]["img"] = [f for f in imgs if ntpath.basename(f)[(filt_loc-len(filt)+1):(filt_loc+1)] == filt][
-                    0:n_samples
-                ]
-            else:
-                filenames_dict[filt]["img"] = [f for f in imgs if ntpath.basename(f)[filt_loc] == filt]
+            filenames_dict[filt]["img"] = []
+        for f in imgs:
+            name = ntpath.basename(f)
+            for filt in filenames_dict["filters"]:
+                if n_samples:
+                    matched = name[(filt_loc - len(filt) + 1) : (filt_loc + 1)] == filt
+                else:
+                    matched = name[filt_loc] == filt
+                if matched:
+                    filenames_dict[filt]["img"].append(f)
+        if n_samples:
+            for filt in filenames_dict["filters"]:
+                filenames_dict[filt]["img"] = filenames_dict[filt]["img"][0:n_samples]
         # confirm (or raise exception) that all filters have the same number of files
         self._verify_input_file_count(filenames_dict)
         print(len(masks))
         if n_samples:
             masks = masks[0:n_samples]
         filenames_dict["mask"] = masks
-        filenames_dict["index"] = [masks.index(val) for val in masks]
+        # The paths are unique, so each mask's index is its position
+        filenames_dict["index"] = list(range(len(masks)))
 
         # Store the result in a class property for future use.
         self.filedict = filenames_dict
 
         return self
 
-    def generate_dataset_dict(self, func=None, filedict=None, filters=True, **kwargs):
+    def generate_dataset_dict(
+        self,
+        func=None,
+        filedict=None,
+        filters=True,
+        num_workers=1,
+        chunksize=8,
+        progress=False,
+        skip_failures=False,
+        index_file=None,
+        fingerprint="mtime",
+        **kwargs,
+    ):
         """Generates a list of dictionaries using a user-defined annotation
         generator function on each image file/mask. The format is determined
         by the user defined function
@@ -121,6 +160,27 @@ class DDLoader:
             Determines whether the list of filters is passed along to the
             annotation function. If true is passed along as
             (images, mask, index, filters, other kwargs).
+        num_workers: int
+            The number of worker processes. With more than one, `func` has to
+            be a module level function. The records keep the order of the
+            filedict. Default is 1 (run in this process)
+        chunksize: int
+            The number of image sets sent to a worker at a time. Default is 8
+        progress: bool
+            Whether to print the number of records done as they complete.
+        skip_failures: bool
+            If True, an image set whose annotation raises is left out of the
+            dataset and recorded in `DDLoader.failures` instead of aborting.
+        index_file: str
+            If specified, a JSON lines sidecar index of the fingerprint and
+            record of every image set. Only image sets that are new, moved to
+            another index or whose files changed are annotated again, and the
+            index is updated. Write the dataset out again with
+            `convert_to_json(..., allow_cached=False)` afterwards.
+        fingerprint: str
+            How a changed file is detected for the index, "mtime" for its size
+            and modification time or "hash" for a hash of its content.
+            Default is "mtime"
 
         Returns
         -------
@@ -143,18 +203,57 @@ class DDLoader:
         img_files = np.transpose([filedict[filt]["img"] for filt in filedict["filters"]])
 
         # Initialize data dictionary
-        dataset_dicts = []
+        self.failures = []
+
+        # Use user-provided function to generate a dictionary record per image set,
+        # passing along the filter list if requested
+        filter_list = filedict["filters"] if filters else None
+        tasks = [
+            (func, images, mask, index, filter_list, kwargs, skip_failures)
+            for images, mask, index in zip(img_files, filedict["mask"], filedict["index"])
+        ]
+        records = [None] * len(tasks)
+
+        # Reuse the records of the image sets that did not change
+        todo = list(range(len(tasks)))
+        if index_file is not None:
+            cached = load_record_index(index_file)
+            keys = [_record_key(task[1], task[2], task[3]) for task in tasks]
+            fingerprints = [file_fingerprints(list(task[1]) + [task[2]], fingerprint) for task in tasks]
+            todo = []
+            for i, key in enumerate(keys):
+                entry = cached.get(key)
+                if entry is not None and entry["fingerprint"] == fingerprints[i]:
+                    records[i] = entry["record"]
+                else:
+                    todo.append(i)
+            print(f"Reusing {len(tasks) - len(todo)} cached records, annotating {len(todo)} image sets")
+        report_every = max(len(todo) // 20, 1)
+
+        def _collect(results):
+            for n, (i, (record, failure)) in enumerate(zip(todo, results), start=1):
+                if failure is not None:
+                    print(f"Annotation failed for {failure['mask']}:\n{failure['error']}")
+                    self.failures.append(failure)
+                else:
+                    records[i] = record
+                if progress and (n % report_every == 0 or n == len(todo)):
+                    print(f"Annotated {n}/{len(todo)} image sets, {len(self.failures)} failed")
+
+        if num_workers > 1:
+            with mp.Pool(num_workers) as pool:
+                _collect(pool.imap(_annotate, [tasks[i] for i in todo], chunksize=chunksize))
+        else:
+            _collect(map(_annotate, [tasks[i] for i in todo]))
 
-        # Use user-provided function to generate a dictionary record per image set
-        for images, mask, index in zip(img_files, filedict["mask"], filedict["index"]):
-            # pass along filter list if requested
-            if filters:
-                record = func(images, mask, index, filedict["filters"], **kwargs)
-            else:
-                record = func(images, mask, index, **kwargs)
+        if index_file is not None:
+            save_record_index(
+                index_file,
+                [(keys[i], fingerprints[i], records[i]) for i in range(len(tasks)) if records[i] is not None],
+            )
 
-            # Add records to the data_dict
-            dataset_dicts.append(record)
+        # Add records to the data_dict, leaving out the failed image sets
+        dataset_dicts = [record for record in records if record is not None]
 
         self.dataset = dataset_dicts
         return self
@@ -239,6 +338,178 @@ class DDLoader:
         return self
 
 
+def _annotate(args):
+    """Runs an annotation function on one image set, returning (record, failure)"""
+    func, images, mask, index, filters, kwargs, skip_failures = args
+    try:
+        if filters is not None:
+            return func(images, mask, index, filters, **kwargs), None
+        return func(images, mask, index, **kwargs), None
+    except Exception:
+        if not skip_failures:
+            raise
+        failure = {
+            "index": index,
+            "images": [str(f) for f in images],
+            "mask": str(mask),
+            "error": traceback.format_exc(),
+        }
+        return None, failure
+
+
+def _record_key(images, mask, index):
+    return json.dumps([int(index), [str(f) for f in images], str(mask)])
+
+
+def file_fingerprints(filenames, fingerprint="mtime"):
+    """Returns a fingerprint of each file that changes when the file is rewritten
+
+    Parameters
+    ----------
+    filenames : list[str]
+        The files
+    fingerprint : str
+        "mtime" for the size and modification time of the file, or "hash" for
+        a BLAKE2 hash of its content
+
+    Returns
+    -------
+    list
+        The fingerprint of each file
+    """
+    fingerprints = []
+    for filename in filenames:
+        if fingerprint == "mtime":
+            stat = os.stat(filename)
+            fingerprints.append([stat.st_size, stat.st_mtime_ns])
+        elif fingerprint == "hash":
+            digest = hashlib.blake2b(digest_size=16)
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            fingerprints.append(digest.hexdigest())
+        else:
+            raise ValueError(f"Unknown fingerprint {fingerprint}, use 'mtime' or 'hash'")
+    return fingerprints
+
+
+def load_record_index(index_file):
+    """Loads a sidecar record index, keyed by image set, skipping a partial last line"""
+    index = {}
+    if not os.path.exists(index_file):
+        return index
+    with open(index_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            index[entry["key"]] = entry
+    return index
+
+
+def save_record_index(index_file, entries):
+    """Writes a sidecar record index from (key, fingerprint, record) entries"""
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        for key, fingerprint, record in entries:
+            f.write(json.dumps({"key": key, "fingerprint": fingerprint, "record": record}, cls=NpEncoder) + "\n")
+    os.replace(tmp_file, index_file)
+
+
+def scan_tree(dirpath, depth, manifest=None):
+    """Lists the entries of every directory `depth` levels below `dirpath`
+
+    Hidden entries are skipped, as by glob.  A directory whose modification time matches the
+    one in `manifest` is not listed again, since adding, removing or renaming an entry updates
+    the modification time of its directory.  Directories modified within the last few seconds
+    are not trusted on a later run, as a change in the same clock tick would go unnoticed.
+
+    Parameters
+    ----------
+    dirpath : str
+        The root directory
+    depth : int
+        The number of directory levels between `dirpath` and the files, e.g. 3 for
+        `dirpath/*/*/*/<pattern>`
+    manifest : dict (optional)
+        A previous result of scan_tree for the same dirpath and depth
+
+    Returns
+    -------
+    tree : dict
+        For each directory path relative to `dirpath` ("" for the root), its "mtime_ns" and its
+        sorted subdirectory names ("dirs") or, at the last level, entry names ("files")
+    """
+    previous = manifest or {}
+    tree = {}
+    now_ns = time.time_ns()
+
+    def _visit(rel, level):
+        path = os.path.join(dirpath, rel)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        key = "files" if level == depth else "dirs"
+        entry = previous.get(rel)
+        if entry is None or entry["mtime_ns"] != mtime_ns or key not in entry:
+            names = []
+            try:
+                with os.scandir(path) as it:
+                    for e in it:
+                        if e.name.startswith("."):
+                            continue
+                        if key == "files" or e.is_dir():
+                            names.append(e.name)
+            except OSError:
+                return
+            racy = now_ns - mtime_ns < 2 * 10**9
+            entry = {"mtime_ns": None if racy else mtime_ns, key: sorted(names)}
+        tree[rel] = entry
+        if level < depth:
+            for name in entry["dirs"]:
+                _visit(os.path.join(rel, name), level + 1)
+
+    _visit("", 0)
+    return tree
+
+
+def match_files(dirpath, tree, pattern):
+    """Returns the sorted paths of the files of a `scan_tree` listing that match a glob pattern"""
+    matched = []
+    for rel, entry in tree.items():
+        if "files" not in entry:
+            continue
+        if glob.has_magic(pattern):
+            names = fnmatch.filter(entry["files"], pattern)
+        else:
+            names = [name for name in entry["files"] if name == pattern]
+        matched.extend(os.path.join(dirpath, rel, name) for name in names)
+    return sorted(matched)
+
+
+def load_manifest(manifest_file, dirpath, depth):
+    """Loads the directory listing saved by `save_manifest`, or None if it does not apply"""
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        manifest = get_data_from_json(manifest_file)
+    except ValueError:
+        return None
+    if manifest.get("dirpath") != os.path.abspath(dirpath) or manifest.get("depth") != depth:
+        return None
+    return manifest["dirs"]
+
+
+def save_manifest(manifest_file, dirpath, depth, tree):
+    """Saves a `scan_tree` listing to a JSON manifest"""
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump({"dirpath": os.path.abspath(dirpath), "depth": depth, "dirs": tree}, f)
+    os.replace(tmp_file, manifest_file)
+
+
 def get_data_from_json(filename):
     """Open a JSON text file, and return encoded data as dictionary.
 
@@ -0,0 +1,272 @@
+"""Caches for images read by an ImageReader."""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+def _hash_sources(key, files, *extra):
+    """Hashes a reader key together with the path, mtime and size of each source file."""
+    sources = []
+    for f in files:
+        st = os.stat(f)
+        sources.append([os.path.abspath(f), st.st_mtime_ns, st.st_size])
+    desc = json.dumps([repr(key), sources, *extra])
+    return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+
+class DiskImageCache:
+    """A persistent on-disk cache of scaled images.
+
+    Images are stored as .npy files named by a hash of the reader key, the source files
+    (with their modification times and sizes), the contrast scaling and its kwargs, so a cached
+    image is invalidated when any of its inputs changes.  Hits are returned as copy-on-write
+    memory maps, so after the first epoch reads are served from the page cache.
+
+    The cache size is bounded by evicting the least recently used images once the total size
+    exceeds `max_bytes`.  The bound is soft: each process tracks the bytes it writes and only
+    rescans the cache directory when its own estimate exceeds the budget.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, dtype=np.float32):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            The directory to store the cached images in.  It will be created if needed.
+        max_bytes : int (optional)
+            The size budget of the cache in bytes.  Default is None (unbounded)
+        dtype : numpy dtype (optional)
+            The dtype floating point images are stored as, e.g. np.float16 to halve the size
+            of the cache.  Images are always returned as float32.  Default is np.float32
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, key, files, norm, scalekwargs):
+        """Returns the cache key for an image.
+
+        Parameters
+        ----------
+        key : str or list
+            The key the image reader was called with
+        files : list[str]
+            The source files of the image
+        norm : str
+            The name of the contrast scaling
+        scalekwargs : dict
+            Key word args for the contrast scaling function
+
+        Returns
+        -------
+        str
+            A hex digest identifying the scaled image
+        """
+        kwargs = sorted((k, repr(v)) for k, v in scalekwargs.items())
+        return _hash_sources(key, files, norm, kwargs, self.dtype.str)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def get(self, key):
+        """Returns the cached image for `key`, or None if it is not cached."""
+        path = self._path(key)
+        try:
+            image = np.load(path, mmap_mode="c")
+            # The modification time records the last access for LRU eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        if image.dtype == np.float16:
+            image = image.astype(np.float32)
+        return image
+
+    def put(self, key, image):
+        """Stores `image` under `key`."""
+        if np.issubdtype(image.dtype, np.floating):
+            image = image.astype(self.dtype, copy=False)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that other workers never see a partial image
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp_file, path)
+
+        if self.max_bytes is not None:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += os.path.getsize(path)
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def _scan(self):
+        """Returns the (mtime, size, path) of every cached image and their total size."""
+        entries = []
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(".npy"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        return entries, sum(e[1] for e in entries)
+
+    def evict(self, target_bytes=None):
+        """Removes least recently used images until the cache is below `target_bytes`.
+
+        Parameters
+        ----------
+        target_bytes : int (optional)
+            The size to shrink the cache to.  Default is 90% of max_bytes, so that eviction
+            does not run again on the next write.
+        """
+        if target_bytes is None:
+            target_bytes = int(0.9 * self.max_bytes)
+        entries, size = self._scan()
+        for _, nbytes, path in sorted(entries):
+            if size <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= nbytes
+        self._size = size
+
+
+class SharedMemoryImageCache:
+    """A node-local cache of decoded (unscaled) images shared by all processes on a node.
+
+    Images are stored as .npy files in a shared memory filesystem (/dev/shm by default), so
+    every dataloader worker of every rank on the node maps the same pages.  The first process
+    to read an image fills its slot, later readers map it read-only.  If two processes miss on
+    the same image at once, only one of them writes it.
+
+    Slots are never evicted.  Once `max_bytes` have been reserved, images that are not cached
+    yet are decoded from disk as usual.  Call `clear` at the end of a job to free the memory.
+    A slot whose writer failed is freed again, and a slot left half written by a writer that died
+    is taken over after `stale_seconds`.
+    """
+
+    def __init__(self, name="deepdisc-image-cache", max_bytes=None, shm_dir="/dev/shm", stale_seconds=600):
+        """
+        Parameters
+        ----------
+        name : str (optional)
+            The name of the cache.  Processes using the same name on a node share the cache.
+            Default is "deepdisc-image-cache"
+        max_bytes : int (optional)
+            The byte budget of the cache, shared by all processes.  Default is None (unbounded)
+        shm_dir : str (optional)
+            The shared memory filesystem to keep the cache in.  Default is "/dev/shm"
+        stale_seconds : float (optional)
+            The age after which a slot that is still being written is taken to be abandoned.
+            Default is 600
+        """
+        self.cache_dir = os.path.join(shm_dir, name)
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self._full = False
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def make_key(self, key, files):
+        """Returns the cache key for the decoded image read from `files`."""
+        return _hash_sources(key, files)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        """Returns a read-only view of the cached image for `key`, or None if it is not cached."""
+        try:
+            return np.load(self._path(key), mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _reserve(self, nbytes):
+        """Reserve `nbytes` of the shared budget, returns False if the budget is used up.
+
+        A negative `nbytes` gives a reservation back.
+        """
+        if self.max_bytes is None:
+            return True
+        with open(os.path.join(self.cache_dir, "reserved_bytes"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            reserved = int(f.read() or 0)
+            if nbytes > 0 and reserved + nbytes > self.max_bytes:
+                return False
+            f.seek(0)
+            f.truncate()
+            f.write(str(max(reserved + nbytes, 0)))
+        return True
+
+    def _claim(self, tmp_file):
+        """Creates the temporary file of a slot, returns its descriptor or None if it is taken."""
+        try:
+            return os.open(tmp_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            pass
+        # A temporary file that has not been written to for stale_seconds was left by a writer
+        # that died, and holds no reservation
+        try:
+            if time.time() - os.stat(tmp_file).st_mtime < self.stale_seconds:
+                return None
+            os.remove(tmp_file)
+            return os.open(tmp_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except (FileNotFoundError, FileExistsError):
+            return None
+
+    def put(self, key, image):
+        """Stores `image` under `key` if there is room left and no other process is writing it."""
+        if self._full:
+            return
+        path = self._path(key)
+        tmp_file = path + ".tmp"
+        fd = self._claim(tmp_file)
+        if fd is None:
+            # Another process is filling this slot
+            return
+
+        reserved = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, image)
+            # Reserve once the image is written, so that a failed write holds no bytes
+            reserved = self._reserve(image.nbytes)
+            if reserved:
+                os.replace(tmp_file, path)
+            else:
+                self._full = True
+                os.remove(tmp_file)
+        except BaseException as e:
+            if reserved:
+                self._reserve(-image.nbytes)
+            try:
+                os.remove(tmp_file)
+            except FileNotFoundError:
+                pass
+            if not isinstance(e, OSError):
+                raise
+            # The image is still returned to the reader, only it is not cached
+            if e.errno == errno.ENOSPC:
+                self._full = True
+
+    def clear(self):
+        """Removes the cache and frees its memory for every process on the node."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -1,9 +1,14 @@
 import abc
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from astropy.io import fits
 from astropy.visualization import make_lupton_rgb
+from scipy.ndimage import zoom
+
+from deepdisc.data_format.tile_store import TileStore
 
 
 class ImageReader(abc.ABC):
@@ -14,18 +19,134 @@ class ImageReader(abc.ABC):
     and a custom version of _read_image().
     """
 
-    def __init__(self, norm="raw", *args, **kwargs):
+    def __init__(self, norm="raw", *args, io_threads=0, buffer_pool=0, cache=None, shared_cache=None, **kwargs):
         """
         Parameters
         ----------
         norm : str (optional)
             A contrast scaling to apply before data augmentation, i.e. luptonizing or z-score scaling
             Default = raw
+        io_threads : int (optional)
+            If greater than 1, the number of threads used to read the band files of an image
+            concurrently.  Useful when reads are latency bound, e.g. on a parallel filesystem.
+            Default = 0 (read the bands one after another)
+        buffer_pool : int (optional)
+            If greater than 0, images are decoded into float32 buffers that are reused, with this
+            many buffers kept per image shape.  A returned image is overwritten `buffer_pool` reads
+            later, so this must be larger than the number of images a worker holds at once
+            (e.g. the per-worker batch size + 1).
+            Default = 0 (allocate a new buffer for every image)
+        cache : DiskImageCache (optional)
+            A cache that stores images after contrast scaling, so that later epochs do not
+            have to read and scale the source files again.
+            Default = None
+        shared_cache : SharedMemoryImageCache (optional)
+            A node-local cache of decoded images shared by all dataloader workers and ranks,
+            so that each image is only decoded once per node.
+            Default = None
         **kwargs : key word args
             Key word args for the contrast scaling function
         """
+        self.norm = norm
         self.scaling = ImageReader.norm_dict[norm]
         self.scalekwargs = kwargs
+        self.io_threads = io_threads
+        self.buffer_pool = buffer_pool
+        self.cache = cache
+        self.shared_cache = shared_cache
+        self._executor = None
+        self._executor_pid = None
+        self._buffers = {}
+        self._owned = None
+
+    def __getstate__(self):
+        # Thread pools can't be pickled or shared with forked dataloader workers,
+        # and each worker fills its own buffer pool
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_executor_pid"] = None
+        state["_buffers"] = {}
+        state["_owned"] = None
+        return state
+
+    def _get_buffer(self, shape):
+        """Returns a float32 buffer to decode an image into.
+
+        Buffers are drawn round-robin from a per-process pool keyed by shape if buffer_pool > 0.
+        The scaling in __call__ is applied in place on buffers handed out here.
+        """
+        shape = tuple(shape)
+        if self.buffer_pool > 0:
+            buffers, count = self._buffers.get(shape, ([], 0))
+            if len(buffers) < self.buffer_pool:
+                buffers.append(np.empty(shape, dtype=np.float32))
+            buf = buffers[count % len(buffers)]
+            self._buffers[shape] = (buffers, count + 1)
+        else:
+            buf = np.empty(shape, dtype=np.float32)
+        self._owned = buf
+        return buf
+
+    def _get_executor(self):
+        """Returns the thread pool for band reads, creating one per process."""
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.io_threads)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _read_bands(self, filenames, nplanes=None):
+        """Read single-band FITS files into one (h, w, band) cube.
+
+        If io_threads > 1, the files are fetched concurrently and each band is written into
+        the output cube as soon as it has been read.
+
+        Parameters
+        ----------
+        filenames : list[str]
+            The FITS file of each band, in channel order.
+        nplanes : int (optional)
+            The number of channels of the output cube, if the caller fills extra channels
+            after the bands.  Default is None (one channel per file)
+
+        Returns
+        -------
+        image : numpy array
+            The float32 image with dimensions (h, w, band)
+        """
+        image = None
+        lock = threading.Lock()
+
+        def _read_band(i):
+            nonlocal image
+            data = fits.getdata(filenames[i], memmap=False)
+            with lock:
+                if image is None:
+                    image = self._get_buffer([*data.shape, nplanes or len(filenames)])
+            image[:, :, i] = data
+
+        if self.io_threads > 1 and len(filenames) > 1:
+            # list() re-raises any exception from the reading threads
+            list(self._get_executor().map(_read_band, range(len(filenames))))
+        else:
+            for i in range(len(filenames)):
+                _read_band(i)
+
+        return image
+
+    def _source_files(self, key):
+        """The files an image is read from, used to invalidate cached images.
+
+        Parameters
+        ----------
+        key : str or list[str]
+            The key indicating the image to read.
+
+        Returns
+        -------
+        files : list[str]
+            The paths of the source files.
+        """
+        return [key] if isinstance(key, str) else list(key)
 
     @abc.abstractmethod
     def _read_image(self, key):
@@ -43,42 +164,119 @@ class ImageReader(abc.ABC):
         """
         pass
 
-    def __call__(self, image):
+    def __call__(self, image, stats=None):
         """Read the image and apply scaling.
 
         Parameters
         ----------
         image : str or numpy array
             The path indicating the image to read or image data in a numpy array with dimensions (band, h, w).
+        stats : dict (optional)
+            Precomputed normalization statistics of the image (see deepdisc.data_format.image_stats).
+            Scalings that support it use these instead of recomputing them.
 
         Returns
         -------
         im : numpy array
             The image.
         """
+        self._owned = None
         if isinstance(image, str) or all(isinstance(s, str) for s in image):
-            im = self._read_image(image)
+            if self.cache is not None:
+                return self._read_cached(image, stats)
+            im = self._load(image)
         elif isinstance(image, np.ndarray):
-            im = np.transpose(image, axes=(1, 2, 0)).astype(np.float32)
+            im = self._get_buffer([*image.shape[1:], image.shape[0]])
+            np.copyto(im, np.transpose(image, axes=(1, 2, 0)), casting="unsafe")
         else:
             raise ValueError("Input must be a string or a numpy array.")
-        im_scale = self.scaling(im, **self.scalekwargs)
+        return self._scale(im, stats)
+
+    def read_unscaled(self, image):
+        """Read the image without applying the contrast scaling.
+
+        The image is read like in __call__, through the shared memory cache if there is one,
+        but not through the cache of scaled images.
+
+        Parameters
+        ----------
+        image : str or list[str]
+            The key indicating the image to read.
+
+        Returns
+        -------
+        im : numpy array
+            The unscaled image with dimensions (h, w, band).  With a buffer_pool, it is
+            overwritten by later reads.
+        """
+        im = self._load(image)
+        self._owned = None
+        return im
+
+    def _scale(self, im, stats=None):
+        """Apply the contrast scaling, in place if the image was decoded into one of our own buffers."""
+        kwargs = self._scale_kwargs(stats)
+        inplace = im is self._owned
+        self._owned = None
+        if inplace and self.norm in ImageReader.inplace_norms:
+            return self.scaling(im, out=im, **kwargs)
+        im_scale = self.scaling(im, **kwargs)
         return im_scale
 
-    def raw(im):
+    def _scale_kwargs(self, stats):
+        """The scaling kwargs, including the precomputed statistics if the scaling takes them."""
+        if stats is None or self.norm not in ImageReader.stats_norms:
+            return self.scalekwargs
+        return {**self.scalekwargs, "stats": stats}
+
+    def _read_cached(self, key, stats=None):
+        """Return the scaled image from the cache, reading and scaling it on a miss."""
+        cache_key = self.cache.make_key(
+            [type(self).__name__, key], self._source_files(key), self.norm, self._scale_kwargs(stats)
+        )
+        im_scale = self.cache.get(cache_key)
+        if im_scale is None:
+            im_scale = self._scale(self._load(key), stats)
+            self.cache.put(cache_key, im_scale)
+        return im_scale
+
+    def _load(self, key):
+        """Read the unscaled image, going through the shared memory cache if there is one."""
+        if self.shared_cache is None:
+            return self._read_image(key)
+
+        shm_key = self.shared_cache.make_key([type(self).__name__, key], self._source_files(key))
+        shared = self.shared_cache.get(shm_key)
+        if shared is not None:
+            # Copy out of the read-only shared pages so the scaling can still run in place
+            im = self._get_buffer(shared.shape)
+            np.copyto(im, shared, casting="unsafe")
+            return im
+
+        im = self._read_image(key)
+        self.shared_cache.put(shm_key, im)
+        return im
+
+    def raw(im, out=None):
         """Apply raw image scaling (no scaling done).
 
         Parameters
         ----------
         im : numpy array
             The image.
+        out : numpy array (optional)
+            A float32 array to write the result to.  May be `im` itself.
 
         Returns
         -------
         numpy array
             The image with pixels as float32.
         """
-        return im.astype(np.float32)
+        if out is None:
+            return im.astype(np.float32)
+        if out is not im:
+            np.copyto(out, im, casting="same_kind")
+        return out
 
     def lupton(im, bandlist=[2, 1, 0], stretch=0.5, Q=10, m=0):
         """Apply Lupton scaling to the image and return the scaled image.
@@ -108,7 +306,64 @@ class ImageReader(abc.ABC):
 
         return make_lupton_rgb(b1, b2, b3, minimum=m, stretch=stretch, Q=Q)
 
-    def zscore(im, A=1., m=0.0):
+    def lupton_float(im, bandlist=[2, 1, 0], stretch=0.5, Q=10, m=0, out=None):
+        """Apply Lupton scaling to the image without quantizing to uint8.
+
+        This is the same asinh mapping as `lupton` (astropy make_lupton_rgb), with pixel values
+        on the same 0-255 scale, but computed in float32 and vectorized over the bands.
+
+        Parameters
+        ----------
+        im : np array
+            The image being scaled
+        bandlist : list[int]
+            Which bands to use for lupton scaling (must be 3)
+        stretch : float
+            lupton stretch parameter
+        Q : float
+            lupton Q parameter
+        m: float
+            lupton minimum parameter
+        out : numpy array (optional)
+            A float32 array with dimensions (h, w, 3) to write the result to.
+
+        Returns
+        -------
+        image : numpy array
+            The float32 3-channel image after lupton scaling
+        """
+        assert np.array(im.shape).argmin() == 2 and len(bandlist) == 3
+        if out is None:
+            out = np.empty((*im.shape[:2], 3), dtype=np.float32)
+        for i, band in enumerate(bandlist):
+            np.subtract(im[:, :, band], m, out=out[:, :, i])
+
+        # Same constants as astropy's AsinhMapping
+        pixmax = 255.0
+        if abs(Q) < 1.0 / 2**23:
+            Q = 0.1
+        Q = min(Q, 1e10)
+        slope = 0.1 * pixmax / np.arcsinh(0.1 * Q)
+        soften = Q / float(stretch)
+
+        intensity = np.mean(out, axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fac = np.multiply(intensity, soften)
+            np.arcsinh(fac, out=fac)
+            fac *= slope
+            fac /= intensity
+        fac[~(intensity > 0)] = 0
+        out *= fac[:, :, None]
+        np.maximum(out, 0, out=out)
+
+        # Rescale pixels whose brightest band saturates, preserving the colour
+        peak = np.max(out, axis=-1)
+        np.maximum(peak, pixmax, out=peak)
+        np.divide(pixmax, peak, out=peak)
+        out *= peak[:, :, None]
+        return out
+
+    def zscore(im, A=1., m=0.0, out=None, stats=None):
         """Apply z-score scaling to the image and return the scaled image.
 
         Parameters
@@ -119,24 +374,41 @@ class ImageReader(abc.ABC):
             A multiplicative scaling factor applied to each band
         m : float
             A minimum pixel value. Defaults to 0.0
+        out : numpy array (optional)
+            An array to write the result to.  May be `im` itself.
+        stats : dict (optional)
+            Precomputed statistics of the image with the "image_mean" and "image_std" of the
+            band-averaged image.  If not given, they are computed from `im`.
 
         Returns
         -------
         image : numpy array
             The image after z-score scaling (subtract mean and divide by std deviation)
         """
-        I = np.mean(im, axis=-1)
-        Imean = np.nanmean(I)
-        Isigma = np.nanstd(I)
-
-        image = np.zeros_like(im)
-        for i in range(im.shape[-1]):
-            image[:, :, i] = A * (im[:, :, i] - Imean - m) / Isigma
+        if stats is not None:
+            Imean = np.float32(stats["image_mean"])
+            Isigma = np.float32(stats["image_std"])
+        else:
+            I = np.mean(im, axis=-1)
+            Imean = I.mean()
+            if np.isfinite(Imean):
+                Isigma = I.std()
+            else:
+                Imean = np.nanmean(I)
+                Isigma = np.nanstd(I)
+
+        image = np.empty_like(im) if out is None else out
+        np.subtract(im, Imean + m, out=image)
+        image *= A / Isigma
 
         return image
 
     # This dict is created to map an input string to a scaling function
-    norm_dict = {"raw": raw, "lupton": lupton, "zscore": zscore}
+    norm_dict = {"raw": raw, "lupton": lupton, "lupton_float": lupton_float, "zscore": zscore}
+    # The scaling functions that take an out= array and can be applied in place
+    inplace_norms = {"raw", "zscore"}
+    # The scaling functions that can use precomputed statistics passed as stats=
+    stats_norms = {"zscore"}
 
     @classmethod
     def add_scaling(cls, name, func):
@@ -176,20 +448,34 @@ class wlDC2ImageReader(ImageReader):
             The image.
         """
         #bands = ['g', 'r', 'i', 'z', 'y']
-        eg = fits.getdata(os.path.join(filename + "_"+self.bands[0]+".fits"), memmap=False)
-        length, width = eg.shape
-        image = np.empty([length, width, len(self.bands)], dtype=np.float64)
-        for (i, band) in enumerate(self.bands):
-            image[:,:,i] = fits.getdata(os.path.join(filename + "_"+band+".fits"), memmap=False).astype('float64')
+        image = self._read_bands(self._source_files(filename))
         #print(image.shape)
-        return image.astype('float32')
+        return image
+
+    def _source_files(self, filename):
+        return [os.path.join(filename + "_"+band+".fits") for band in self.bands]
     
 class wlDC2psfImageReader(ImageReader):
-    """An ImageReader for DC2 image files."""
+    """An ImageReader for DC2 image files with PSF channels.
 
-    def __init__(self, *args, **kwargs):
+    The six band images are followed by six PSF planes.  By default the PSF planes are read
+    from full resolution {filename}_{band}_psfs.fits files.  With psf_grid=True they are
+    upsampled at read time from a coarse (band, h, w) grid stored in {filename}_psfgrid.npy,
+    see conversions.fitsim_psfs_to_grid.
+    """
+
+    filters = ["u", "g", "r", "i", "z", "y"]
+
+    def __init__(self, *args, psf_grid=False, **kwargs):
+        """
+        Parameters
+        ----------
+        psf_grid : bool (optional)
+            Whether to read the PSF planes from coarse PSF grids.  Default = False
+        """
         # Pass arguments to the parent function.
         super().__init__(*args, **kwargs)
+        self.psf_grid = psf_grid
 
     def _read_image(self, filename):
         """Read the image.
@@ -204,16 +490,50 @@ class wlDC2psfImageReader(ImageReader):
         im : numpy array
             The image.
         """
-        filters = ['u','g','r','i','z','y']
-        filter_psfs = [i+'_psfs' for i in filters]
-        filters += filter_psfs
-        g = fits.getdata(os.path.join(filename + "_g.fits"), memmap=False)
-        length, width = g.shape
-        image = np.empty([length, width, len(filters)], dtype=np.float64)
-        for (i, band) in enumerate(filters):
-            image[:,:,i] = fits.getdata(os.path.join(filename + "_"+band+".fits"), memmap=False).astype('float64')
-        
-        return image.astype('float32')
+        if not self.psf_grid:
+            return self._read_bands(self._source_files(filename))
+
+        *band_files, grid_file = self._source_files(filename)
+        grid = np.load(grid_file)
+        image = self._read_bands(band_files, nplanes=len(band_files) + len(grid))
+        upsample_psf_grid(grid, image.shape[:2], out=image[:, :, len(band_files) :])
+
+        return image
+
+    def _source_files(self, filename):
+        if self.psf_grid:
+            return [filename + "_" + band + ".fits" for band in self.filters] + [filename + "_psfgrid.npy"]
+        filters = self.filters + [i + "_psfs" for i in self.filters]
+        return [os.path.join(filename + "_"+band+".fits") for band in filters]
+
+
+def upsample_psf_grid(grid, shape, out=None):
+    """Bilinearly upsample a coarse PSF grid to the image size.
+
+    The corners of the grid are aligned with the corner pixels of the image, as in the
+    scipy.ndimage.zoom(order=1) interpolation used to make the full resolution PSF images.
+
+    Parameters
+    ----------
+    grid : numpy array
+        The PSF grid with dimensions (band, h, w)
+    shape : tuple
+        The (H, W) shape of the image
+    out : numpy array (optional)
+        An (H, W, band) array to write the PSF planes into
+
+    Returns
+    -------
+    psf : numpy array
+        The upsampled PSF planes with dimensions (H, W, band)
+    """
+    grid = np.moveaxis(np.asarray(grid, dtype=np.float32), 0, -1)
+    factors = (shape[0] / grid.shape[0], shape[1] / grid.shape[1], 1)
+    if out is None:
+        out = np.empty((*shape, grid.shape[-1]), dtype=np.float32)
+    zoom(grid, factors, output=out, order=1)
+    return out
+
 
 class wlHSCImageReader(ImageReader):
     """An ImageReader for DC2 image files."""
@@ -237,13 +557,12 @@ class wlHSCImageReader(ImageReader):
             The image.
         """
         #filters = ['G', 'R', 'I', 'Z', 'Y']
-        eg = fits.getdata(os.path.join(filename + "_"+self.bands[0]+".fits"), memmap=False)
-        length, width = eg.shape
-        image = np.empty([length, width, len(self.bands)], dtype=np.float64)
-        for (i, band) in enumerate(self.bands):
-            image[:,:,i] = fits.getdata(os.path.join(filename + "_"+band+".fits"), memmap=False).astype('float64')
-        
-        return image.astype('float32')
+        image = self._read_bands(self._source_files(filename))
+
+        return image
+
+    def _source_files(self, filename):
+        return [os.path.join(filename + "_"+band+".fits") for band in self.bands]
 
 
 class NumpyImageReader(ImageReader):
@@ -266,9 +585,45 @@ class NumpyImageReader(ImageReader):
         im : numpy array
             The image.
         """
+        data = np.load(self._source_files(filename)[0])
+        image = self._get_buffer([*data.shape[1:], data.shape[0]])
+        np.copyto(image, np.transpose(data, axes=(1, 2, 0)), casting="unsafe")
+        return image
+
+    def _source_files(self, filename):
         file = filename.split("/")[-1].split(".")[0]
         base = os.path.dirname(filename)
-        fn = os.path.join(base, file) + ".npy"
-        image = np.load(fn)
-        image = np.transpose(image, axes=(1, 2, 0)).astype(np.float32)
-        return image
+        return [os.path.join(base, file) + ".npy"]
+
+
+class TileStoreImageReader(ImageReader):
+    """An ImageReader for cutouts packed into a tile store (see deepdisc.data_format.tile_store)."""
+
+    def __init__(self, store, *args, **kwargs):
+        """
+        Parameters
+        ----------
+        store : str or TileStore
+            The tile store, or the name of its data file
+        """
+        self.store = TileStore(store) if isinstance(store, str) else store
+        # Pass arguments to the parent function.
+        super().__init__(*args, **kwargs)
+
+    def _read_image(self, key):
+        """Read the image.
+
+        Parameters
+        ----------
+        key : str
+            The key of the cutout in the tile store.
+
+        Returns
+        -------
+        im : numpy array
+            A read-only (h, w, band) view into the memory mapped store.
+        """
+        return np.transpose(self.store[key], axes=(1, 2, 0))
+
+    def _source_files(self, key):
+        return [self.store.filename]
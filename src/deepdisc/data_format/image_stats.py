@@ -0,0 +1,262 @@
+"""Utilities for computing image normalization statistics."""
+
+import numpy as np
+
+# Scale factor to turn a median absolute deviation into a gaussian sigma
+MAD_TO_SIGMA = 1.4826
+
+
+def image_moments(im):
+    """Computes the normalization statistics of a single image.
+
+    Parameters
+    ----------
+    im : numpy array
+        The unscaled image with dimensions (h, w, band)
+
+    Returns
+    -------
+    stats : dict
+        The per-band "mean", "std" and "sigma_robust" (1.4826 * MAD), and the "image_mean"
+        and "image_std" of the band-averaged image that the zscore scaling uses.
+    """
+    flat = im.reshape(-1, im.shape[-1])
+    median = np.nanmedian(flat, axis=0)
+    mad = np.nanmedian(np.abs(flat - median), axis=0)
+
+    band_mean = np.mean(im, axis=-1)
+    return {
+        "mean": np.nanmean(flat, axis=0).tolist(),
+        "std": np.nanstd(flat, axis=0).tolist(),
+        "sigma_robust": (MAD_TO_SIGMA * mad).tolist(),
+        "image_mean": float(np.nanmean(band_mean)),
+        "image_std": float(np.nanstd(band_mean)),
+    }
+
+
+def add_image_stats(dataset_dicts, imreader, key_mapper, stats_key="norm_stats", num_workers=1, chunksize=4):
+    """Stores the normalization statistics of every image in its dataset dict.
+
+    The DictMapper passes the stored statistics on to the ImageReader, so that the scaling
+    uses them instead of recomputing them on every read.
+
+    Parameters
+    ----------
+    dataset_dicts : list[dict]
+        The dataset dicts, e.g. loaded with get_data_from_json.  Modified in place.
+    imreader : ImageReader
+        The reader used to load the unscaled images, see ImageReader.read_unscaled
+    key_mapper : function
+        The function that takes a dataset dict and returns the key used to load the image
+    stats_key : str
+        The dict key the statistics are stored under.  Default is "norm_stats"
+    num_workers : int
+        The number of worker processes.  Default is 1 (no pool)
+    chunksize : int
+        The number of images sent to a worker at once
+
+    Returns
+    -------
+    dataset_dicts : list[dict]
+        The dataset dicts with statistics added
+    """
+    moments = _map_images(_image_moments, dataset_dicts, (imreader, key_mapper), num_workers, chunksize)
+    for d, stats in zip(dataset_dicts, list(moments)):
+        d[stats_key] = stats
+    return dataset_dicts
+
+
+class PixelStats:
+    """Streaming per-band pixel statistics that can be merged across processes.
+
+    Means and variances are accumulated with Welford/Chan updates in float64, so the
+    statistics of a whole dataset can be computed one image at a time.  Optionally a bounded
+    uniform sample of pixels is kept to estimate quantiles, by bottom-k sampling on random
+    priorities.  Every pixel gets an exponential priority, of which each image only draws its
+    `sample_per_image` smallest, so every pixel of every image has the same chance to be kept
+    regardless of the image size, as long as no image would contribute more than
+    `sample_per_image` pixels to the sample.
+    """
+
+    def __init__(self, nbands, max_samples=0, sample_per_image=1000, seed=None):
+        """
+        Parameters
+        ----------
+        nbands : int
+            The number of bands
+        max_samples : int (optional)
+            The number of pixels per band kept for the quantile estimate.  Default is 0 (none)
+        sample_per_image : int (optional)
+            The maximum number of pixels per band sampled from each image.  Default is 1000
+        seed : int (optional)
+            The seed of the random pixel sample
+        """
+        self.n = np.zeros(nbands)
+        self.mean = np.zeros(nbands)
+        self.m2 = np.zeros(nbands)
+        self.max_samples = max_samples
+        self.sample_per_image = sample_per_image
+        self.rng = np.random.default_rng(seed)
+        self.samples = np.empty((0, nbands), dtype=np.float32)
+        self.priorities = np.empty(0)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n)
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta**2 * self.n * n / total, 0)
+        self.n = total
+
+    def _merge_samples(self, samples, priorities):
+        self.samples = np.concatenate([self.samples, samples])
+        self.priorities = np.concatenate([self.priorities, priorities])
+        if len(self.priorities) > self.max_samples:
+            keep = np.argpartition(self.priorities, self.max_samples)[: self.max_samples]
+            self.samples = self.samples[keep]
+            self.priorities = self.priorities[keep]
+
+    def update(self, im):
+        """Adds the pixels of an image with dimensions (h, w, band)."""
+        flat = im.reshape(-1, im.shape[-1])
+        finite = np.isfinite(flat)
+        n = finite.sum(axis=0).astype(np.float64)
+        with np.errstate(invalid="ignore"):
+            mean = np.nanmean(flat, axis=0, dtype=np.float64)
+            m2 = np.nansum((flat - mean) ** 2, axis=0, dtype=np.float64)
+        self._merge_moments(n, np.nan_to_num(mean), m2)
+
+        if self.max_samples > 0:
+            size = min(self.sample_per_image, len(flat))
+            rows = self.rng.choice(len(flat), size=size, replace=False)
+            # The `size` smallest of len(flat) exponential priorities, as increasing spacings
+            spacings = self.rng.exponential(size=size) / (len(flat) - np.arange(size))
+            self._merge_samples(flat[rows].astype(np.float32), np.cumsum(spacings))
+        return self
+
+    def merge(self, other):
+        """Merges the statistics accumulated by another PixelStats."""
+        self._merge_moments(other.n, other.mean, other.m2)
+        if self.max_samples > 0:
+            self._merge_samples(other.samples, other.priorities)
+        return self
+
+    def quantiles(self, q):
+        """Estimates per-band quantiles from the pixel sample."""
+        return np.nanquantile(self.samples, q, axis=0)
+
+
+_worker_state = {}
+
+
+def _init_stats_worker(imreader, key_mapper, *args):
+    _worker_state.update(imreader=imreader, key_mapper=key_mapper)
+    _worker_state["args"] = args
+
+
+def _map_images(func, items, initargs, num_workers, chunksize, ordered=True):
+    """Maps func over items, in a pool of workers that each hold the reader and key mapper."""
+    if num_workers > 1:
+        import multiprocessing as mp
+
+        with mp.Pool(num_workers, initializer=_init_stats_worker, initargs=initargs) as pool:
+            imap = pool.imap if ordered else pool.imap_unordered
+            yield from imap(func, items, chunksize=chunksize)
+    else:
+        _init_stats_worker(*initargs)
+        yield from map(func, items)
+
+
+def _image_moments(d):
+    return image_moments(_worker_state["imreader"].read_unscaled(_worker_state["key_mapper"](d)))
+
+
+def _image_stats(args):
+    i, d = args
+    nbands, sample_per_image = _worker_state["args"]
+    im = _worker_state["imreader"](_worker_state["key_mapper"](d))
+    # Every image gets its own seed, so the result does not depend on the number of workers
+    stats = PixelStats(nbands, max_samples=sample_per_image, sample_per_image=sample_per_image, seed=i)
+    return stats.update(im)
+
+
+def compute_pixel_stats(
+    dataset_dicts,
+    imreader,
+    key_mapper,
+    num_workers=1,
+    quantiles=None,
+    max_samples=1000000,
+    sample_per_image=1000,
+    chunksize=4,
+):
+    """Computes dataset-wide per-band pixel statistics of the images an ImageReader returns.
+
+    Images are streamed through a process pool and never held in memory together, which makes
+    this suitable for deriving model.pixel_mean / model.pixel_std for a full survey release.
+
+    Parameters
+    ----------
+    dataset_dicts : list[dict] or str
+        The dataset dicts, or the name of a metadata JSON file
+    imreader : ImageReader
+        The reader used in training, including its contrast scaling
+    key_mapper : function
+        The function that takes a dataset dict and returns the key used to load the image
+    num_workers : int
+        The number of worker processes.  Default is 1 (no pool)
+    quantiles : list[float] (optional)
+        Quantiles to estimate from a uniform sample of pixels, e.g. [0.001, 0.999] for robust
+        limits, see PixelStats.  Default is None
+    max_samples : int
+        The number of pixels per band kept for the quantile estimate
+    sample_per_image : int
+        The largest number of pixels per band sampled from each image for the quantile
+        estimate.  The sample is uniform over pixels if no image holds more than this many of
+        the max_samples pixels, e.g. if it is at least max_samples times the largest image's
+        share of all pixels
+    chunksize : int
+        The number of images sent to a worker at once
+
+    Returns
+    -------
+    stats : dict
+        The per-band "pixel_mean" and "pixel_std", the number of pixels "n_pixels", and if
+        requested the "quantiles" as a dict of quantile to per-band values.
+    """
+    if isinstance(dataset_dicts, str):
+        from deepdisc.data_format.file_io import get_data_from_json
+
+        dataset_dicts = get_data_from_json(dataset_dicts)
+
+    nbands = imreader(key_mapper(dataset_dicts[0])).shape[-1]
+    per_image = sample_per_image if quantiles else 0
+    total = PixelStats(nbands, max_samples=max_samples if quantiles else 0)
+
+    initargs = (imreader, key_mapper, nbands, per_image)
+    tasks = enumerate(dataset_dicts)
+    for stats in _map_images(_image_stats, tasks, initargs, num_workers, chunksize, ordered=False):
+        total.merge(stats)
+
+    result = {
+        "pixel_mean": total.mean.tolist(),
+        "pixel_std": total.std.tolist(),
+        "n_pixels": total.n.tolist(),
+    }
+    if quantiles:
+        result["quantiles"] = {q: total.quantiles(q).tolist() for q in quantiles}
+    return result
+
+
+def format_pixel_stats(stats):
+    """Formats pixel statistics as config lines that can be pasted into a solo config."""
+    lines = []
+    for name in ["pixel_mean", "pixel_std"]:
+        lines.append(f"model.{name} = [")
+        lines.extend(f"        {v:.8g}," for v in stats[name])
+        lines.append("]")
+    return "\n".join(lines)
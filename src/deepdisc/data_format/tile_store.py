@@ -0,0 +1,143 @@
+"""A packed, memory-mappable store of multi-band image cutouts.
+
+Each cutout is stored as one contiguous (band, h, w) cube of a fixed dtype inside a single
+flat binary file.  A JSON index next to the data file maps a cutout key to its element offset
+and shape, so a cutout can be returned as a zero-copy view of a memory map without any FITS
+header parsing or per-band file opens.
+"""
+
+import json
+import os
+
+import numpy as np
+from astropy.io import fits
+
+
+def _index_name(filename):
+    return filename + ".index.json"
+
+
+def write_tile_store(outname, cubes, keys, dtype=np.float32):
+    """Packs a sequence of multi-band cutouts into a single tile store file
+
+    Parameters
+    ----------
+    outname: str
+        The name of the output data file.  The index is written to `outname` + ".index.json"
+    cubes: iterable[numpy array]
+        The cutouts, each with dimensions (band, h, w).  Cutouts may have different shapes.
+    keys: iterable[str]
+        A unique key for each cutout, e.g. the key returned by the key_mapper used in training
+    dtype: numpy dtype
+        The dtype all cutouts are stored as.  Default is float32
+
+    Returns
+    -------
+    index : dict
+        The index that was written alongside the data file
+    """
+    dtype = np.dtype(dtype)
+    index = {"dtype": dtype.str, "tiles": {}}
+
+    offset = 0
+    tmp_file = outname + ".tmp"
+    with open(tmp_file, "wb") as f:
+        for key, cube in zip(keys, cubes):
+            if key in index["tiles"]:
+                raise ValueError(f"Duplicate tile key {key}")
+            cube = np.ascontiguousarray(cube, dtype=dtype)
+            if cube.ndim != 3:
+                raise ValueError(f"Expected a (band, h, w) cube for {key}, got shape {cube.shape}")
+            cube.tofile(f)
+            index["tiles"][key] = [offset, *cube.shape]
+            offset += cube.size
+    os.replace(tmp_file, outname)
+
+    with open(_index_name(outname) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(_index_name(outname) + ".tmp", _index_name(outname))
+
+    return index
+
+
+def fitsim_to_tile_store(filenames, bands, outname, dtype=np.float32):
+    """Packs single-band FITS cutouts named {filename}_{band}.fits into a tile store
+
+    The keys of the store are the filename prefixes, matching what the wlDC2/wlHSC image
+    readers expect as input.
+
+    Parameters
+    ----------
+    filenames: list[str]
+        The filename prefixes, one per cutout
+    bands: list[str]
+        The band suffixes, in the channel order of the stored cubes
+    outname: str
+        The name of the output data file
+    dtype: numpy dtype
+        The dtype all cutouts are stored as.  Default is float32
+
+    Returns
+    -------
+    index : dict
+        The index that was written alongside the data file
+    """
+
+    def _cubes():
+        for filename in filenames:
+            yield np.stack([fits.getdata(f"{filename}_{band}.fits", memmap=False) for band in bands])
+
+    return write_tile_store(outname, _cubes(), filenames, dtype=dtype)
+
+
+class TileStore:
+    """Read-only access to a tile store written by `write_tile_store`
+
+    The data file is memory mapped lazily on first access, so the store can be created in the
+    main process and pickled to dataloader workers, which then each map the file themselves.
+    """
+
+    def __init__(self, filename):
+        """
+        Parameters
+        ----------
+        filename : str
+            The name of the data file.  The index is expected at `filename` + ".index.json"
+        """
+        self.filename = filename
+        with open(_index_name(filename), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index["dtype"])
+        self.tiles = index["tiles"]
+        self._data = None
+
+    def __getstate__(self):
+        # Never pickle the memory map, each process maps the file on its own
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def keys(self):
+        return self.tiles.keys()
+
+    @property
+    def data(self):
+        """The flat, read-only memory map of the whole data file."""
+        if self._data is None:
+            self._data = np.memmap(self.filename, dtype=self.dtype, mode="r")
+        return self._data
+
+    def shape(self, key):
+        """The (band, h, w) shape of the cutout stored under `key`."""
+        return tuple(self.tiles[key][1:])
+
+    def __getitem__(self, key):
+        """Returns a zero-copy (band, h, w) view of the cutout stored under `key`."""
+        offset, *shape = self.tiles[key]
+        return self.data[offset : offset + int(np.prod(shape))].reshape(shape)
@@ -77,7 +77,9 @@ class DictMapper(DataMapper):
 
         dataset_dict = copy.deepcopy(dataset_dict)
         key = self.km(dataset_dict)
-        image = self.IR(key)
+        # Use normalization statistics stored with the metadata if there are any
+        stats = dataset_dict.get("norm_stats")
+        image = self.IR(key) if stats is None else self.IR(key, stats=stats)
 
         # Data Augmentation
         auginput = T.AugInput(image)
@@ -0,0 +1,291 @@
+"""Splitting a scarlet scene into independent blends that are fit in parallel.
+
+Sources whose (padded) footprint boxes do not overlap, directly or through other sources, do
+not interact in a scarlet fit.  The boxes come from a thresholded detection image of the scene,
+so no scarlet source has to be initialized to find the groups.  Each connected group of sources
+is then initialized and fit as its own small blend on a crop of the scene, in a worker process,
+and the fitted models are placed back into scene coordinates as `FittedSource` objects that the
+writers in process.py accept in place of scarlet sources.
+"""
+
+import multiprocessing as mp
+
+import numpy as np
+import sep
+
+from deepdisc.preprocessing.driver import pool_workers
+
+
+def group_overlapping_boxes(boxes, pad=0):
+    """Groups boxes into connected components of overlapping boxes
+
+    Parameters
+    ----------
+    boxes : array
+        The boxes as rows of (y0, x0, y1, x1), with exclusive upper edges
+    pad : int
+        Boxes closer than this many pixels are treated as overlapping. Default is 0
+
+    Returns
+    -------
+    groups : list[numpy array]
+        The indices of the boxes in each group, sorted, with groups in order of their first box
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    parent = np.arange(len(boxes))
+
+    def _find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Sweep over the boxes in order of their lower y edge, keeping the boxes still open in y
+    order = np.argsort(boxes[:, 0], kind="stable")
+    active = []
+    for i in order:
+        y0, x0, y1, x1 = boxes[i]
+        active = [j for j in active if boxes[j, 2] + pad > y0]
+        for j in active:
+            if boxes[j, 1] < x1 + pad and x0 < boxes[j, 3] + pad:
+                parent[_find(i)] = _find(j)
+        active.append(i)
+
+    roots = np.array([_find(i) for i in range(len(boxes))], dtype=int)
+    groups = {}
+    for i, root in enumerate(roots):
+        groups.setdefault(root, []).append(i)
+    return [np.array(g) for g in sorted(groups.values(), key=lambda g: g[0])]
+
+
+def footprint_boxes(image, centers, lvl=1, min_size=11):
+    """Returns the box of the detected footprint that contains each center
+
+    The image is thresholded at lvl times its global noise without deblending, so that all
+    centers in one connected footprint get the box of that footprint.  Every box covers at least
+    a min_size box around its center, which is all a center outside of the footprints gets.
+
+    Parameters
+    ----------
+    image : array
+        The detection image, e.g. the sum over the bands of the scene
+    centers : list
+        The (y, x) center of each source
+    lvl : float
+        The detection threshold, in units of the global noise of the image. Default is 1
+    min_size : int
+        The smallest box size. Default is 11
+
+    Returns
+    -------
+    boxes : numpy array
+        The boxes as rows of (y0, x0, y1, x1), with exclusive upper edges, clipped to the image
+    """
+    image = np.ascontiguousarray(image, dtype=np.float64)
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    bkg = sep.Background(image)
+    sep.set_extract_pixstack(max(sep.get_extract_pixstack(), image.size))
+    footprints, segmap = sep.extract(
+        image, lvl, err=bkg.globalrms, minarea=1, deblend_cont=1.0, segmentation_map=True
+    )
+
+    cy = np.clip(np.round(centers[:, 0]).astype(int), 0, image.shape[0] - 1)
+    cx = np.clip(np.round(centers[:, 1]).astype(int), 0, image.shape[1] - 1)
+    half = min_size // 2
+    boxes = np.column_stack([cy - half, cx - half, cy + half + 1, cx + half + 1])
+
+    labels = segmap[cy, cx]
+    inside = labels > 0
+    obj = footprints[labels[inside] - 1]
+    boxes[inside, 0] = np.minimum(boxes[inside, 0], obj["ymin"])
+    boxes[inside, 1] = np.minimum(boxes[inside, 1], obj["xmin"])
+    boxes[inside, 2] = np.maximum(boxes[inside, 2], obj["ymax"] + 1)
+    boxes[inside, 3] = np.maximum(boxes[inside, 3], obj["xmax"] + 1)
+    return np.clip(boxes, 0, np.tile(image.shape, 2))
+
+
+class FittedSource:
+    """A source fitted in a crop of the scene, with its model in scene coordinates
+
+    Provides the `bbox` and `get_model` of a scarlet source, so that it can be written by the
+    functions in process.py, and keeps the model rendered with the observation PSF.
+    """
+
+    def __init__(self, origin, model, rendered):
+        """
+        Parameters
+        ----------
+        origin : tuple
+            The (channel, y, x) origin of the source box in the scene
+        model : array
+            The model in the source box, with dimensions (channel, h, w)
+        rendered : array
+            The model rendered to the observation, in the source box
+        """
+        import scarlet
+
+        self.bbox = scarlet.Box(model.shape, origin=tuple(int(o) for o in origin))
+        self.model = model
+        self.rendered = rendered
+
+    def get_model(self, frame=None):
+        """Returns the model in its box, or placed in a frame the size of the scene"""
+        if frame is None:
+            return self.model
+        full = np.zeros(frame.shape, dtype=self.model.dtype)
+        _, y0, x0 = self.bbox.origin
+        _, h, w = self.model.shape
+        ys, xs = slice(max(y0, 0), min(y0 + h, full.shape[1])), slice(max(x0, 0), min(x0 + w, full.shape[2]))
+        full[:, ys, xs] = self.model[:, ys.start - y0 : ys.stop - y0, xs.start - x0 : xs.stop - x0]
+        return full
+
+
+def render_source(src, observation, model_frame):
+    """Returns the model of a source rendered to the observation, in the source box"""
+    if isinstance(src, FittedSource):
+        return src.rendered
+    model = observation.render(src.get_model(frame=model_frame))
+    return src.bbox.extract_from(model)
+
+
+def _fit_group(args):
+    """Initializes and fits the sources of one group on a crop of the scene"""
+    import scarlet
+
+    from deepdisc.preprocessing.detection import fit_scarlet_blend
+
+    datas, weights, centers, origin, filters, psf, sigma_model, sigma_obs, morph_thresh, fit_kwargs = args
+
+    model_psf = scarlet.GaussianPSF(sigma=sigma_model)
+    model_frame = scarlet.Frame(datas.shape, psf=model_psf, channels=filters)
+    observation_psf = scarlet.GaussianPSF(sigma=sigma_obs) if psf is None else scarlet.ImagePSF(psf)
+    observation = scarlet.Observation(datas, psf=observation_psf, weights=weights, channels=filters).match(
+        model_frame
+    )
+    sources, skipped = scarlet.initialization.init_all_sources(
+        model_frame,
+        centers,
+        observation,
+        max_components=5,
+        thresh=morph_thresh,
+        fallback=False,
+        silent=True,
+        set_spectra=False,
+    )
+    record = None
+    if len(sources) > 0:
+        _, _, record = fit_scarlet_blend(
+            sources, observation, centers, plot_likelihood=False, return_record=True, **fit_kwargs
+        )
+
+    fitted = []
+    for src in sources:
+        model = src.get_model()
+        rendered = render_source(src, observation, model_frame)
+        box_origin = np.array(src.bbox.origin) + np.array([0, origin[0], origin[1]])
+        fitted.append((box_origin, np.asarray(model), np.asarray(rendered)))
+    return fitted, list(skipped), record
+
+
+def fit_independent_blends(
+    datas,
+    centers,
+    filters,
+    weights=None,
+    psf=None,
+    sigma_model=1,
+    sigma_obs=5,
+    morph_thresh=0.1,
+    lvl=1,
+    padding=5,
+    num_workers=1,
+    boxes=None,
+    **fit_kwargs,
+):
+    """Initializes and fits groups of overlapping sources as independent blends in a process pool
+
+    Parameters
+    ----------
+    datas : ndarray
+        multichannel array of data, shape (Nfilters x N x N)
+    centers : list
+        The (y, x) center of each source
+    filters : list
+        str list of filters
+    weights : ndarray
+        The weights of the observation, or None
+    psf : ndarray
+        psf image array, or None to use a gaussian with sigma_obs
+    sigma_model, sigma_obs, morph_thresh :
+        As in run_scarlet
+    lvl : float
+        The detection level of the footprints that group the sources, see footprint_boxes.
+        Default is 1
+    padding : int
+        Sources whose boxes are closer than this are fit together, and the crops are padded by it
+    num_workers : int
+        The number of worker processes. Default is 1.
+        Inside a daemonic process, e.g. a job of driver.run_jobs, the groups are fit serially
+    boxes : array (optional)
+        The (y0, x0, y1, x1) box of each source used to find the groups, e.g. from the footprints
+        of a detection catalog.  Default is None (footprint_boxes of the band sum of datas)
+    **fit_kwargs : key word args
+        Key word args for fit_scarlet_blend, e.g. max_iters and the budget policy
+
+    Returns
+    -------
+    fitted_sources : list[FittedSource]
+        The fitted sources, in the order of `centers`
+    kept : numpy array
+        The indices of `centers` that could be initialized in their crop
+    records : list[dict]
+        The fit record of each group, see fit_scarlet_blend
+    """
+    if boxes is None:
+        boxes = footprint_boxes(np.sum(datas, axis=0), centers, lvl=lvl)
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    groups = group_overlapping_boxes(boxes, pad=padding)
+    shape = datas.shape[-2:]
+
+    tasks = []
+    for group in groups:
+        y0 = max(boxes[group, 0].min() - padding, 0)
+        x0 = max(boxes[group, 1].min() - padding, 0)
+        y1 = min(boxes[group, 2].max() + padding, shape[0])
+        x1 = min(boxes[group, 3].max() + padding, shape[1])
+        crop = (slice(None), slice(y0, y1), slice(x0, x1))
+        group_centers = [(centers[k][0] - y0, centers[k][1] - x0) for k in group]
+        group_weights = None if weights is None else np.ascontiguousarray(weights[crop])
+        tasks.append(
+            (
+                np.ascontiguousarray(datas[crop]),
+                group_weights,
+                group_centers,
+                (y0, x0),
+                filters,
+                psf,
+                sigma_model,
+                sigma_obs,
+                morph_thresh,
+                fit_kwargs,
+            )
+        )
+
+    num_workers = pool_workers(num_workers)
+    if num_workers > 1:
+        with mp.Pool(num_workers) as pool:
+            results = pool.map(_fit_group, tasks)
+    else:
+        results = list(map(_fit_group, tasks))
+
+    fitted = {}
+    records = []
+    for group, (group_fitted, skipped, record) in zip(groups, results):
+        kept = [k for i, k in enumerate(group) if i not in skipped]
+        for k, (origin, model, rendered) in zip(kept, group_fitted):
+            fitted[k] = FittedSource(origin, model, rendered)
+        if record is not None:
+            records.append(record)
+
+    kept = np.array(sorted(fitted), dtype=int)
+    return [fitted[k] for k in kept], kept, records
@@ -0,0 +1,181 @@
+"""A sky-partitioned index for selecting the catalog rows that fall in a cutout.
+
+The sky is cut into declination zones of a fixed height, and the catalog positions are sorted
+by zone and then by right ascension.  A footprint query only has to binary search the RA range
+in the few zones it overlaps, so selecting the rows of a cutout costs O(log N + N_local)
+instead of projecting the whole catalog.
+
+The index is saved as plain .npy files and opened as read-only memory maps, so worker
+processes share one copy of it through the page cache instead of each holding the catalog.
+"""
+
+import os
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+
+_ARRAYS = ["ra", "dec", "rows", "zone_offsets"]
+
+
+def build_catalog_index(ra, dec, outdir, zone_height=0.1):
+    """Builds a catalog index and saves it to `outdir`
+
+    Parameters
+    ----------
+    ra, dec : array
+        The positions of the catalog rows in degrees
+    outdir : str
+        The directory to save the index in.  It will be created if needed.
+    zone_height : float
+        The height of the declination zones in degrees.  It should be comparable to the size
+        of a cutout.  Default is 0.1
+
+    Returns
+    -------
+    CatalogIndex
+        The index opened from `outdir`
+    """
+    ra = np.mod(np.asarray(ra, dtype=np.float64), 360.0)
+    dec = np.asarray(dec, dtype=np.float64)
+    nzones = int(np.ceil(180.0 / zone_height))
+    zones = _zone(dec, zone_height, nzones)
+
+    rows = np.lexsort((ra, zones))
+    zone_offsets = np.searchsorted(zones[rows], np.arange(nzones + 1))
+
+    os.makedirs(outdir, exist_ok=True)
+    arrays = {"ra": ra[rows], "dec": dec[rows], "rows": rows, "zone_offsets": zone_offsets}
+    for name, array in arrays.items():
+        np.save(os.path.join(outdir, name + ".npy"), array)
+    np.save(os.path.join(outdir, "zone_height.npy"), np.float64(zone_height))
+
+    return CatalogIndex(outdir)
+
+
+def _zone(dec, zone_height, nzones):
+    return np.clip(((np.asarray(dec) + 90.0) / zone_height).astype(int), 0, nzones - 1)
+
+
+class CatalogIndex:
+    """Read-only access to a catalog index written by `build_catalog_index`
+
+    The arrays are memory mapped on first access, so the index can be created in the main
+    process and pickled to workers, which then each map the files themselves.
+    """
+
+    def __init__(self, dirname):
+        """
+        Parameters
+        ----------
+        dirname : str
+            The directory the index was saved in
+        """
+        self.dirname = dirname
+        self.zone_height = float(np.load(os.path.join(dirname, "zone_height.npy")))
+        self._arrays = None
+
+    def __getstate__(self):
+        # Never pickle the memory maps, each process maps the files on its own
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def _get(self, name):
+        if self._arrays is None:
+            self._arrays = {
+                a: np.load(os.path.join(self.dirname, a + ".npy"), mmap_mode="r") for a in _ARRAYS
+            }
+        return self._arrays[name]
+
+    def __len__(self):
+        return len(self._get("rows"))
+
+    def _search(self, ra_min, ra_max, dec_min, dec_max):
+        """Returns the positions in the sorted arrays of the entries inside an RA/Dec box"""
+        ra, dec, zone_offsets = self._get("ra"), self._get("dec"), self._get("zone_offsets")
+        nzones = len(zone_offsets) - 1
+        if ra_max - ra_min >= 360.0:
+            ranges = [(0.0, 360.0)]
+        elif ra_min % 360.0 <= ra_max % 360.0:
+            ranges = [(ra_min % 360.0, ra_max % 360.0)]
+        else:
+            ranges = [(ra_min % 360.0, 360.0), (0.0, ra_max % 360.0)]
+
+        first, last = _zone([dec_min, dec_max], self.zone_height, nzones)
+        found = [np.array([], dtype=np.int64)]
+        for zone in range(first, last + 1):
+            start, end = zone_offsets[zone], zone_offsets[zone + 1]
+            zone_ra = ra[start:end]
+            for lo, hi in ranges:
+                i0 = start + np.searchsorted(zone_ra, lo, side="left")
+                i1 = start + np.searchsorted(zone_ra, hi, side="right")
+                keep = (dec[i0:i1] >= dec_min) & (dec[i0:i1] <= dec_max)
+                found.append(np.arange(i0, i1)[keep])
+
+        pos = np.concatenate(found)
+        return pos[np.argsort(self._get("rows")[pos])]
+
+    def query_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Returns the catalog rows inside an RA/Dec box
+
+        Parameters
+        ----------
+        ra_min, ra_max : float
+            The RA range in degrees.  If ra_min > ra_max the box wraps around RA = 0.
+        dec_min, dec_max : float
+            The Dec range in degrees
+
+        Returns
+        -------
+        rows : numpy array
+            The sorted row numbers of the catalog the index was built from
+        """
+        return np.array(self._get("rows")[self._search(ra_min, ra_max, dec_min, dec_max)])
+
+    def query_footprint(self, wcs, shape, pad=1.0, return_coords=False):
+        """Returns the catalog rows that may fall inside an image footprint
+
+        The RA/Dec bounding box of the image edges is searched, so the rows returned are a
+        superset of the rows inside the image and still need to be cut in pixel space.
+
+        Parameters
+        ----------
+        wcs : WCS
+            The celestial WCS of the image
+        shape : tuple
+            The (h, w) shape of the image
+        pad : float
+            Padding added around the image in pixels.  Default is 1
+        return_coords : bool
+            Whether to also return the positions of the rows.  Default is False
+
+        Returns
+        -------
+        rows : numpy array
+            The sorted row numbers of the catalog the index was built from
+        coords : SkyCoord
+            The positions of the rows, if return_coords is True
+        """
+        h, w = shape[-2:]
+        edge_x = np.linspace(-0.5 - pad, w - 0.5 + pad, 9)
+        edge_y = np.linspace(-0.5 - pad, h - 0.5 + pad, 9)
+        xs = np.concatenate([edge_x, edge_x, np.full(9, edge_x[0]), np.full(9, edge_x[-1])])
+        ys = np.concatenate([np.full(9, edge_y[0]), np.full(9, edge_y[-1]), edge_y, edge_y])
+        edges = wcs.pixel_to_world(xs, ys)
+        edge_ra, edge_dec = edges.ra.deg, edges.dec.deg
+
+        dec_min, dec_max = edge_dec.min(), edge_dec.max()
+        if dec_max >= 90.0 - self.zone_height or dec_min <= -90.0 + self.zone_height:
+            # Near a pole the footprint can span every RA
+            ra_min, ra_max = 0.0, 360.0
+        else:
+            # Unwrap the RA of the edges around the center so a footprint crossing RA = 0 works
+            center_ra = wcs.pixel_to_world((w - 1) / 2, (h - 1) / 2).ra.deg
+            offsets = (edge_ra - center_ra + 180.0) % 360.0 - 180.0
+            ra_min, ra_max = center_ra + offsets.min(), center_ra + offsets.max()
+
+        pos = self._search(ra_min, ra_max, dec_min, dec_max)
+        rows = np.array(self._get("rows")[pos])
+        if not return_coords:
+            return rows
+        return rows, SkyCoord(ra=self._get("ra")[pos], dec=self._get("dec")[pos], unit="deg")
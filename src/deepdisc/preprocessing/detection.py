@@ -6,6 +6,10 @@ import sep
 import matplotlib.pyplot as plt
 import time
 
+from deepdisc.preprocessing.blends import fit_independent_blends, render_source
+from deepdisc.preprocessing.extraction import extract_tiled
+from deepdisc.preprocessing.starlet import starlet_transform
+
 def mad_wavelet_own(image):
     """image: Median absolute deviation of the first wavelet scale.
     (WARNING: sorry to disapoint, this is not a wavelet for mad scientists)
@@ -21,15 +25,48 @@ def mad_wavelet_own(image):
     mad: array
         median absolute deviation for each image in the cube
     """
+    return mad_first_scale(starlet_transform(image, scales=1)[..., 0, :, :])
+
 
+def mad_first_scale(first_scale):
+    """Noise estimate from the first starlet scale of one or more images, as in mad_wavelet_own
+
+    Parameters
+    ----------
+    first_scale: array
+        The first starlet scale of an image, or of each image in a cube
+    Returns
+    -------
+    mad: array
+        median absolute deviation for each image in the cube
+    """
     # Scale =1/1.4826 to replicate older scipy MAD behavior
     scale = 1 / 1.4826
-    sigma = astromad(
-        scarlet.Starlet.from_image(image, scales=2).coefficients[0, ...], axis=(-2, -1), ignore_nan=True
-    )
+    sigma = astromad(first_scale, axis=(-2, -1), ignore_nan=True)
     return sigma / scale
 
 
+def starlet_coefficients(datas, scales=3):
+    """Starlet transform of every band of a multi-band image
+
+    The detection image of make_catalog is the sum of the first three scales of the band-summed
+    image, and the noise estimate uses the first scale of each band.  The transform is linear, so
+    both come from one per-band transform with 3 scales.
+
+    Parameters
+    ----------
+    datas: array
+        multichannel array of data, shape (Nfilters x N x N)
+    scales: int
+        The number of starlet scales. Default is 3
+    Returns
+    -------
+    coefficients: array
+        The starlet coefficients, shape (Nfilters x scales+1 x N x N)
+    """
+    return starlet_transform(datas, scales=scales)
+
+
 def make_catalog(
     datas,
     lvl=4,
@@ -37,6 +74,10 @@ def make_catalog(
     segmentation_map=False,
     maskthresh=10.0,
     object_limit=100000,
+    coefficients=None,
+    tile_size=None,
+    overlap=64,
+    num_workers=1,
 ):
     """
     Creates a detection catalog by combining low and high resolution data
@@ -58,6 +99,17 @@ def make_catalog(
         Mask threshold for sep segmentation
     object_limit : int
         Limit on number of objects to detect in image
+    coefficients : array
+        Per-band starlet coefficients of datas from starlet_coefficients, computed if None.
+        Used for the detection image and the background estimate, so with wave=True they need
+        at least 3 scales plus the residual.
+    tile_size : int
+        If set, extract sources on tiles of this size in parallel, see extraction.extract_tiled.
+        Default is None (extract the whole image at once)
+    overlap : int
+        Margin around each tile, must be larger than the largest source. Default is 64
+    num_workers : int
+        Number of processes for tiled extraction. Default is 1
 
     Code adapted from https://pmelchior.github.io/scarlet/tutorials/wavelet_model.html
 
@@ -70,7 +122,16 @@ def make_catalog(
     """
 
     if type(datas) is np.ndarray:
-        hr_images = datas / np.sum(datas, axis=(1, 2))[:, None, None]
+        # One transform per band serves both detection and the background estimate,
+        # which only needs the first scale
+        if coefficients is None:
+            coefficients = starlet_coefficients(datas, scales=3 if wave else 1)
+        elif wave and coefficients.shape[1] <= 3:
+            # Summing fewer planes would add the coarse residual to the detection image
+            raise ValueError(
+                "Wavelet detection needs at least 3 starlet scales and the residual, "
+                f"got coefficients of shape {coefficients.shape}"
+            )
         # Detection image as the sum over all images
         # detect_image = np.sum(hr_images, axis=0)
         detect_image = np.sum(datas, axis=0)
@@ -97,32 +158,47 @@ def make_catalog(
             # Direct detection
             detect = detect_image.mean(axis=0)
     else:
-        if wave:
-            wave_detect = scarlet.Starlet.from_image(detect_image).coefficients
+        if wave and coefficients is not None:
+            # The transform is linear, so the scales of the summed image are the sums over bands
+            detect = np.sum(coefficients[:, :3], axis=(0, 1))
+        elif wave:
+            wave_detect = starlet_transform(detect_image, scales=3)
             detect = wave_detect[0] + wave_detect[1] + wave_detect[2]
         else:
             detect = detect_image
 
     bkg = sep.Background(detect)
-    # Set the limit on the number of sub-objects when deblending.
-    sep.set_sub_object_limit(object_limit)
-
-    # Extract detection catalog with segmentation maps!
-    # Can use this to retrieve ellipse params
-    catalog = sep.extract(
-        detect,
-        lvl,
-        err=bkg.globalrms,
-        segmentation_map=segmentation_map,
-        maskthresh=maskthresh,
-    )
+
+    if tile_size is not None:
+        catalog = extract_tiled(
+            detect,
+            lvl,
+            bkg.globalrms,
+            tile_size=tile_size,
+            overlap=overlap,
+            num_workers=num_workers,
+            object_limit=object_limit,
+            segmentation_map=segmentation_map,
+            maskthresh=maskthresh,
+        )
+    else:
+        # Set the limit on the number of sub-objects when deblending.
+        sep.set_sub_object_limit(object_limit)
+
+        # Extract detection catalog with segmentation maps!
+        # Can use this to retrieve ellipse params
+        catalog = sep.extract(
+            detect,
+            lvl,
+            err=bkg.globalrms,
+            segmentation_map=segmentation_map,
+            maskthresh=maskthresh,
+        )
 
     # Estimate background
     # Have to include because will no longer take ndarray
     if type(datas) is np.ndarray and len(datas > 2):
-        bkg_rms = np.zeros(len(datas))
-        for i, data in enumerate(datas):
-            bkg_rms[i] = mad_wavelet_own(data)
+        bkg_rms = mad_first_scale(coefficients[:, 0])
 
     else:
         bkg_rms = []
@@ -132,6 +208,31 @@ def make_catalog(
     return catalog, bkg_rms
 
 
+def iteration_budget(n_sources, max_iters=15, iters_per_source=None, min_iters=1):
+    """Returns the iteration cap of a blend with a given number of sources
+
+    Parameters
+    ----------
+    n_sources : int
+        The number of sources in the blend
+    max_iters : int
+        The largest number of iterations of any blend
+    iters_per_source : float (optional)
+        If given, the cap grows by this many iterations per source, starting from min_iters,
+        so that small blends stop early.  Default is None (always max_iters)
+    min_iters : int
+        The smallest cap. Default is 1
+
+    Returns
+    -------
+    int
+        The iteration cap
+    """
+    if iters_per_source is None:
+        return int(max_iters)
+    return int(min(max_iters, max(min_iters, min_iters + iters_per_source * n_sources)))
+
+
 def fit_scarlet_blend(
     starlet_sources,
     observation,
@@ -141,26 +242,53 @@ def fit_scarlet_blend(
     plot_likelihood=True,
     savefigs=False,
     figpath="",
+    iters_per_source=None,
+    return_record=False,
 ):
     """
-    Creates a detection catalog by combining low and high resolution data
+    Creates and fits a scarlet Blend of the initialized sources
+
+    Will end early if likelihood and constraints converge.  The blend is fit in one call, as the
+    optimizer state does not carry over between calls, so the plateau of the log likelihood is
+    detected by scarlet itself: the fit stops once the relative change of the log likelihood
+    between two iterations is below e_rel.
 
     Parameters
     ----------
-    datas: array
-        array of Data objects
-
-    Will end early if likelihood and constraints converge
+    starlet_sources : list
+        The initialized scarlet sources
+    observation : scarlet.Observation
+        The observation matched to the model frame
+    catalog : list
+        The detection catalog, only used to report failures
+    max_iters : int
+        The iteration cap of the largest blends. Default is 15
+    e_rel : float
+        The relative log likelihood change of scarlet's convergence test. Default is 1e-4
+    iters_per_source : float (optional)
+        Scale the iteration cap with the number of sources, see iteration_budget. Default is None
+    return_record : bool
+        Whether to also return the fit record. Default is False
 
     Returns
     -------
+    starlet_blend : scarlet.Blend
+        The fitted blend
+    logL : float
+        The final log likelihood
+    record : dict
+        The number of sources, iterations used, the stop reason ("converged" or "budget"), the
+        run time and time per iteration, and the log likelihood after every iteration,
+        if return_record is True
     """
-    # Create and fit Blend model. Go for 200 iterations,
-    # but will end early if likelihood and constraints converge
+    budget = iteration_budget(len(starlet_sources), max_iters, iters_per_source)
+
+    # Create and fit Blend model, but will end early if likelihood and constraints converge
     print(f"Fitting Blend model.")
+    t0 = time.time()
     try:
         starlet_blend = scarlet.Blend(starlet_sources, observation)
-        it, logL = starlet_blend.fit(max_iters, e_rel=e_rel)
+        it, logL = starlet_blend.fit(budget, e_rel=e_rel)
         print(f"Scarlet ran for {it} iterations to logL = {logL}")
 
     # Catch any exceptions like no detections
@@ -168,9 +296,25 @@ def fit_scarlet_blend(
         print(f"Length of detection catalog is {len(catalog)}.")
         raise
 
+    if not return_record:
+        return starlet_blend, logL
 
-    return starlet_blend, logL
-
+    seconds = time.time() - t0
+    if hasattr(starlet_blend, "log_likelihood"):
+        trajectory = [float(v) for v in np.ravel(starlet_blend.log_likelihood)]
+    else:
+        trajectory = [float(logL)]
+    record = {
+        "n_sources": len(starlet_sources),
+        "iterations": int(it),
+        "max_iters": budget,
+        "stop": "converged" if it < budget else "budget",
+        "seconds": seconds,
+        "seconds_per_iter": seconds / max(it, 1),
+        "logL": float(logL),
+        "logL_trajectory": trajectory,
+    }
+    return starlet_blend, logL, record
 
 
 def run_scarlet(
@@ -202,7 +346,15 @@ def run_scarlet(
     savefigs=False,
     figpath="",
     weights=None,
-    return_models=True
+    return_models=True,
+    fit_blend=False,
+    independent_blends=False,
+    blend_lvl=1,
+    blend_padding=5,
+    num_workers=1,
+    fit_kwargs=None,
+    fit_records=None,
+    writer=None,
 ):
     """Run P. Melchior's scarlet (https://github.com/pmelchior/scarlet) implementation
     for source separation. This function will create diagnostic plots, a source detection catalog,
@@ -256,6 +408,28 @@ def run_scarlet(
     plot_first_isolated_comp : boolean
         Plot the subtracted and isolated first (or any) starlet component. Recommended for finding a bright
         component. Default is False.
+    fit_blend : boolean
+        Fit one blend of all initialized sources before their models are extracted.
+        Default is False (the sources keep their initialized models)
+    independent_blends : boolean
+        Fit each group of sources with overlapping footprints as its own blend on a crop of the scene,
+        in parallel, see blends.fit_independent_blends.  The sources are initialized on their crop
+        only.  Sources that could not be initialized are dropped from the returned catalog, so that
+        sources and catalog rows line up.  Default is False (one blend of the whole scene)
+    blend_lvl : float
+        Detection level of the footprints that group the sources of independent blends. Default is 1
+    blend_padding : int
+        Sources whose footprint boxes are closer than this many pixels are fit together. Default is 5
+    num_workers : int
+        Number of processes used to fit independent blends. Default is 1
+    fit_kwargs : dict (optional)
+        Additional key word args for fit_scarlet_blend, e.g. e_rel and the iters_per_source of the
+        iteration budget
+    fit_records : list (optional)
+        If given, the fit record of every blend (see fit_scarlet_blend) is appended to it
+    writer : process.StreamingResultsWriter (optional)
+        If given, the model and segmentation mask of each source are written as soon as they are
+        rendered instead of being kept, and segmentation_masks is returned as None
 
 
     Return
@@ -303,10 +477,7 @@ def run_scarlet(
 
     else:
         wavecat=False
-        catalog_, bg_rms_hsc = make_catalog(datas, lvl, wave=True)
-        Rs = np.sqrt(catalog_["a"] ** 2 + catalog_["b"] ** 2)
-        spread = Rs / sigma_obs
-        print(spread)
+        # Sources are initialized from the external catalog, so no detection is needed
         print("Source catalog has ", len(catalog), "objects")
 
         chi2s = np.zeros(len(catalog))
@@ -340,18 +511,59 @@ def run_scarlet(
     t0 = time.time()
 
 
-    starlet_sources, skipped = scarlet.initialization.init_all_sources(
-        model_frame,
-        centers,
-        observation,
-        max_components=5,
-        thresh=morph_thresh,
-        fallback=False,
-        silent=True,
-        set_spectra=False,
-    )
+    # Independent blends initialize their sources on the crop of their group only
+    if not independent_blends:
+        starlet_sources, skipped = scarlet.initialization.init_all_sources(
+            model_frame,
+            centers,
+            observation,
+            max_components=5,
+            thresh=morph_thresh,
+            fallback=False,
+            silent=True,
+            set_spectra=False,
+        )
 
-    if len(starlet_sources)==0:
+    fit_kwargs = fit_kwargs or {}
+    if independent_blends:
+        print("Fitting independent blends")
+        starlet_sources, kept, records = fit_independent_blends(
+            datas,
+            centers,
+            filters,
+            weights=weights,
+            psf=psf,
+            sigma_model=sigma_model,
+            sigma_obs=sigma_obs,
+            morph_thresh=morph_thresh,
+            lvl=blend_lvl,
+            padding=blend_padding,
+            num_workers=num_workers,
+            max_iters=max_iters,
+            **fit_kwargs,
+        )
+        catalog = catalog.iloc[kept] if hasattr(catalog, "iloc") else catalog[kept]
+        print(f"Fit {len(records)} independent blends")
+        if fit_records is not None:
+            fit_records.extend(records)
+
+    elif fit_blend and len(starlet_sources) > 0:
+        # Fit scarlet blend
+        starlet_blend, logL, record = fit_scarlet_blend(
+            starlet_sources,
+            observation,
+            catalog,
+            max_iters=max_iters,
+            plot_likelihood=plot_likelihood,
+            savefigs=savefigs,
+            figpath=figpath,
+            return_record=True,
+            **fit_kwargs,
+        )
+        if fit_records is not None:
+            fit_records.append(record)
+
+    elif len(starlet_sources)==0:
         
         print("Modeling as extended sources")
         for k, src in enumerate(catalog):
@@ -377,10 +589,8 @@ def run_scarlet(
     segmentation_masks = []
 
     for k, src in enumerate(starlet_sources):
-        model = src.get_model(frame=model_frame)
-        model = observation.render(model)
         # Compute in bbox only
-        model = src.bbox.extract_from(model)
+        model = render_source(src, observation, model_frame)
         bkgmod = sep.Background(np.sum(model, axis=0))
         
         # Run sep
@@ -414,14 +624,20 @@ def run_scarlet(
 
             
         # Append to full catalog
+        mask = None
         if segmentation_map == True:
             # For some reason sep doesn't like these images, so do the segmask ourselves for now
             model_det = np.sum(model, axis=0)
             mask = np.zeros_like(model_det)
             mask[model_det > lvl_segmask * bkgmod.globalrms] = 1
-            segmentation_masks.append(mask)
+            if writer is None:
+                segmentation_masks.append(mask)
             # plt.imshow(mask)
             # plt.show()
+
+        if writer is not None:
+            source_cat = catalog.iloc[k] if hasattr(catalog, "iloc") else None
+            writer.write(src, model, mask, source_cat)
         
 
     # Plot scene: rendered model, observations, and residuals
@@ -457,6 +673,8 @@ def run_scarlet(
             plt.savefig(figpath + "sources.png")
         plt.show()
 
+    if writer is not None:
+        segmentation_masks = None
         
     if return_models:
         return (
@@ -0,0 +1,352 @@
+"""A resumable driver for running preprocessing jobs over a local process pool.
+
+A job is one (tract, patch, sp) sub-patch.  The jobs of a campaign are written once to a JSON
+lines manifest, and the outcome of every job is appended to a JSON lines status log by the
+parent process only, one flushed and fsynced line per job.  A killed run leaves at most a
+partial last line, which is ignored, so restarting with the same manifest and status log only
+runs the jobs that have not completed.
+"""
+
+import json
+import multiprocessing as mp
+import os
+import time
+import traceback
+from functools import lru_cache
+
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+]
+
+
+def pool_workers(num_workers):
+    """Returns the number of worker processes a pool started in this process can use
+
+    Daemonic processes, like the workers of run_jobs, are not allowed to start children, so a
+    pool requested inside a job runs in the job's own process instead.
+
+    Parameters
+    ----------
+    num_workers : int
+        The requested number of worker processes
+
+    Returns
+    -------
+    int
+        num_workers, or 1 in a daemonic process
+    """
+    if num_workers > 1 and mp.current_process().daemon:
+        return 1
+    return num_workers
+
+
+def job_id(tract, patch, sp):
+    return f"{tract}_{patch}_{sp}"
+
+
+def build_manifest(manifest_file, tract_patches, nblocks=4):
+    """Writes a job manifest with one job per sub-patch
+
+    Parameters
+    ----------
+    manifest_file : str
+        The JSON lines file to write
+    tract_patches : list[(int, str)]
+        The (tract, patch) pairs to process, e.g. [(3828, '2,2')]
+    nblocks : int
+        Each patch is cut into nblocks x nblocks sub-patches. Default is 4
+
+    Returns
+    -------
+    jobs : list[dict]
+        The jobs that were written
+    """
+    jobs = []
+    for tract, patch in tract_patches:
+        for sp in range(nblocks**2):
+            jobs.append({"job_id": job_id(tract, patch, sp), "tract": tract, "patch": patch, "sp": sp})
+
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        for job in jobs:
+            f.write(json.dumps(job) + "\n")
+    os.replace(tmp_file, manifest_file)
+    return jobs
+
+
+def _read_jsonl(filename):
+    records = []
+    if not os.path.exists(filename):
+        return records
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A partial line left by a killed run
+                continue
+    return records
+
+
+def read_status(status_file):
+    """Returns the last recorded status of every job in a status log, keyed by job_id"""
+    return {record["job_id"]: record for record in _read_jsonl(status_file)}
+
+
+def pending_jobs(manifest_file, status_file, retry_failed=True):
+    """Returns the jobs of a manifest that still have to run
+
+    Parameters
+    ----------
+    manifest_file : str
+        The job manifest
+    status_file : str
+        The status log of previous runs
+    retry_failed : bool
+        Whether jobs that failed before are run again. Default is True
+
+    Returns
+    -------
+    jobs : list[dict]
+        The jobs that have not completed
+    """
+    status = read_status(status_file)
+    skip = {"done"} if retry_failed else {"done", "failed"}
+    jobs = _read_jsonl(manifest_file)
+    return [job for job in jobs if status.get(job["job_id"], {}).get("status") not in skip]
+
+
+def _run_job(args):
+    job_fn, job, job_kwargs = args
+    t0 = time.time()
+    try:
+        telemetry = job_fn(job["tract"], job["patch"], job["sp"], **job_kwargs)
+        result = {"job_id": job["job_id"], "status": "done", "seconds": time.time() - t0}
+        if isinstance(telemetry, dict):
+            result["telemetry"] = telemetry
+        return result
+    except Exception:
+        return {
+            "job_id": job["job_id"],
+            "status": "failed",
+            "seconds": time.time() - t0,
+            "error": traceback.format_exc(),
+        }
+
+
+def run_jobs(
+    manifest_file,
+    status_file,
+    job_fn,
+    job_kwargs=None,
+    num_workers=1,
+    threads_per_worker=1,
+    retry_failed=True,
+    maxtasksperchild=None,
+):
+    """Runs the pending jobs of a manifest and records their outcome in the status log
+
+    Parameters
+    ----------
+    manifest_file : str
+        The job manifest written by build_manifest
+    status_file : str
+        The status log.  It is appended to, and read to skip completed jobs on a restart
+    job_fn : function
+        A module level function called as job_fn(tract, patch, sp, **job_kwargs) that
+        processes one job and writes its outputs.  A job that raises is recorded as failed.
+        With num_workers > 1 the jobs run in daemonic workers, in which the process pools of
+        make_catalog and run_scarlet run serially, see pool_workers.
+        A dict returned by job_fn is recorded as the "telemetry" of the job.
+    job_kwargs : dict (optional)
+        Key word args passed on to job_fn
+    num_workers : int
+        The number of worker processes.  Default is 1 (run in this process)
+    threads_per_worker : int
+        The number of BLAS/OpenMP threads of each worker.  Default is 1
+    retry_failed : bool
+        Whether jobs that failed in a previous run are run again. Default is True
+    maxtasksperchild : int (optional)
+        Restart a worker after this many jobs, to bound memory growth. Default is None
+
+    Returns
+    -------
+    summary : dict
+        The number of jobs that were "done" and "failed" in this run
+    """
+    job_kwargs = job_kwargs or {}
+    jobs = pending_jobs(manifest_file, status_file, retry_failed=retry_failed)
+    summary = {"done": 0, "failed": 0}
+    if len(jobs) == 0:
+        return summary
+
+    tasks = [(job_fn, job, job_kwargs) for job in jobs]
+    with open(status_file, "a+", encoding="utf-8") as status:
+        # Terminate a partial line left by a killed run, so the next record starts on its own line
+        if status.tell() > 0:
+            status.seek(status.tell() - 1)
+            if status.read(1) != "\n":
+                status.write("\n")
+
+        def _record(result):
+            status.write(json.dumps(result) + "\n")
+            status.flush()
+            os.fsync(status.fileno())
+            summary[result["status"]] += 1
+            if result["status"] == "failed":
+                print(f"Job {result['job_id']} failed:\n{result['error']}")
+
+        if num_workers > 1:
+            # Spawned workers inherit the environment, so the thread limits apply before
+            # numpy and friends are imported in them
+            saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+            os.environ.update({var: str(threads_per_worker) for var in THREAD_ENV_VARS})
+            try:
+                ctx = mp.get_context("spawn")
+                with ctx.Pool(num_workers, maxtasksperchild=maxtasksperchild) as pool:
+                    for result in pool.imap_unordered(_run_job, tasks):
+                        _record(result)
+            finally:
+                for var, value in saved.items():
+                    if value is None:
+                        os.environ.pop(var, None)
+                    else:
+                        os.environ[var] = value
+        else:
+            for task in tasks:
+                _record(_run_job(task))
+
+    return summary
+
+
+def read_fit_telemetry(status_file):
+    """Collects the blend fit records of the completed jobs of a status log
+
+    Parameters
+    ----------
+    status_file : str
+        The status log of jobs whose telemetry has a "blends" list, e.g. dc2_ground_truth_job
+
+    Returns
+    -------
+    pandas DataFrame
+        One row per fitted blend with its job_id and the fields of its fit record, see
+        detection.fit_scarlet_blend
+    """
+    import pandas as pd
+
+    rows = []
+    for job, record in read_status(status_file).items():
+        if record.get("status") != "done":
+            continue
+        for blend in record.get("telemetry", {}).get("blends", []):
+            rows.append(dict(blend, job_id=job))
+    return pd.DataFrame(rows)
+
+
+@lru_cache(maxsize=None)
+def _load_catalog(catalog_file):
+    """Loads a truth catalog once per worker process"""
+    import pandas as pd
+
+    return pd.read_parquet(catalog_file) if catalog_file.endswith(".parquet") else pd.read_pickle(catalog_file)
+
+
+def dc2_ground_truth_job(
+    tract,
+    patch,
+    sp,
+    dirpath,
+    outdir,
+    catalog_file,
+    index_dir=None,
+    nblocks=4,
+    filters=["u", "g", "r", "i", "z", "y"],
+    stream_masks=False,
+    mask_layout="hdus",
+    **scarlet_kwargs,
+):
+    """Generates the ground truth of one DC2 sub-patch
+
+    Runs get_cutout_cat, run_scarlet and write_scarlet_results_nomodels, writing the results to
+    {outdir}/{tract}/{patch}/{sp}.  Use with run_jobs as the job_fn, which records the fit
+    records of the blends in the status log, see read_fit_telemetry.
+
+    Parameters
+    ----------
+    tract : int
+        The tract
+    patch : str
+        The patch, e.g. '2,2'
+    sp : int
+        The sub-patch index
+    dirpath : str
+        Path to the directory of the {tract}_{patch}_images.fits files
+    outdir : str
+        The output directory
+    catalog_file : str
+        A pickled or parquet truth catalog, loaded once per worker
+    index_dir : str (optional)
+        A CatalogIndex of the truth catalog, see catalog_index.build_catalog_index
+    nblocks : int
+        Each patch is cut into nblocks x nblocks sub-patches. Default is 4
+    filters : list
+        A list of filters for your images. Default is ['u','g','r','i','z','y']
+    stream_masks : bool
+        Write the segmentation masks while the sources are rendered instead of keeping them all in
+        memory, see process.StreamingResultsWriter. Default is False
+    mask_layout : str
+        The layout of masks.fits when the masks are not streamed, "hdus" or "packed", see
+        process.write_scarlet_results_nomodels. Default is "hdus"
+    **scarlet_kwargs : key word args
+        Key word args for run_scarlet
+
+    Returns
+    -------
+    telemetry : dict
+        The fit records of the blends under "blends"
+    """
+    from deepdisc.preprocessing.catalog_index import CatalogIndex
+    from deepdisc.preprocessing.detection import run_scarlet
+    from deepdisc.preprocessing.get_data import get_cutout_cat
+    from deepdisc.preprocessing.process import StreamingResultsWriter, write_scarlet_results_nomodels
+
+    dall = _load_catalog(catalog_file)
+    index = CatalogIndex(index_dir) if index_dir is not None else None
+    datas, catalog = get_cutout_cat(dirpath, dall, tract, patch, sp, nblocks=nblocks, filters=filters, index=index)
+    images = datas[: len(filters)]
+
+    job_dir = os.path.join(outdir, str(tract), str(patch), str(sp))
+    os.makedirs(job_dir, exist_ok=True)
+
+    fit_records = []
+    writer = StreamingResultsWriter(job_dir) if stream_masks else None
+    observation, starlet_sources, model_frame, catalog, segmentation_masks = run_scarlet(
+        images,
+        filters,
+        catalog=catalog,
+        plot_likelihood=False,
+        fit_records=fit_records,
+        writer=writer,
+        **scarlet_kwargs,
+    )
+    if writer is not None:
+        writer.close()
+
+    write_scarlet_results_nomodels(
+        datas,
+        observation,
+        starlet_sources,
+        model_frame,
+        segmentation_masks,
+        job_dir,
+        filters + [f + "_psfs" for f in filters],
+        job_id(tract, patch, sp),
+        catalog=catalog,
+        layout=mask_layout,
+    )
+    return {"blends": fit_records}
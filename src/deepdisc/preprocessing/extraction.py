@@ -0,0 +1,148 @@
+"""Tile-parallel source extraction with sep.
+
+The detection image is cut into a grid of core regions, and each core is extracted together
+with an overlap margin in a worker process.  A source is kept by the tile whose core contains its
+centroid, and only if its footprint does not touch an edge of the tile that lies inside the
+image, i.e. only if the tile saw the whole source.  A complete source is measured identically by
+every tile that contains it, so exactly one tile keeps it.  The overlap has to be larger than the
+footprint of the largest source for it to be complete in its owning tile.
+
+The sources, their positions and the detected pixels match an extraction of the whole image.
+Deblended siblings may trade a few ambiguous pixels, and so differ slightly in flux and shape,
+because sep assigns those pixels by random draws whose order depends on the other sources.
+"""
+
+import multiprocessing as mp
+
+import numpy as np
+import sep
+
+from deepdisc.preprocessing.driver import pool_workers
+
+X_FIELDS = ["x", "xmin", "xmax", "xcpeak", "xpeak"]
+Y_FIELDS = ["y", "ymin", "ymax", "ycpeak", "ypeak"]
+
+
+def _tile_slices(shape, tile_size, overlap):
+    """Returns the (core, tile) slices of every tile of an image"""
+    tiles = []
+    for y0 in range(0, shape[0], tile_size):
+        for x0 in range(0, shape[1], tile_size):
+            core = (slice(y0, min(y0 + tile_size, shape[0])), slice(x0, min(x0 + tile_size, shape[1])))
+            tile = tuple(
+                slice(max(s.start - overlap, 0), min(s.stop + overlap, n)) for s, n in zip(core, shape)
+            )
+            tiles.append((core, tile))
+    return tiles
+
+
+def _extract_tile(args):
+    data, core, tile, shape, lvl, err, extract_kwargs, object_limit = args
+    sep.set_sub_object_limit(object_limit)
+    result = sep.extract(data, lvl, err=err, **extract_kwargs)
+    catalog, segmap = result if extract_kwargs.get("segmentation_map") else (result, None)
+
+    # Move to image coordinates
+    catalog = catalog.copy()
+    for field in X_FIELDS:
+        catalog[field] += tile[1].start
+    for field in Y_FIELDS:
+        catalog[field] += tile[0].start
+
+    # Keep complete sources whose centroid is in the core
+    owned = (
+        (catalog["x"] >= core[1].start - 0.5)
+        & (catalog["x"] < core[1].stop - 0.5)
+        & (catalog["y"] >= core[0].start - 0.5)
+        & (catalog["y"] < core[0].stop - 0.5)
+    )
+    truncated = np.zeros(len(catalog), dtype=bool)
+    if tile[1].start > 0:
+        truncated |= catalog["xmin"] == tile[1].start
+    if tile[1].stop < shape[1]:
+        truncated |= catalog["xmax"] == tile[1].stop - 1
+    if tile[0].start > 0:
+        truncated |= catalog["ymin"] == tile[0].start
+    if tile[0].stop < shape[0]:
+        truncated |= catalog["ymax"] == tile[0].stop - 1
+
+    keep = np.where(owned & ~truncated)[0]
+    lost = int(np.sum(owned & truncated))
+    if segmap is not None:
+        # Only return the footprints of the kept sources, numbered in catalog order
+        labels = np.zeros(len(catalog) + 1, dtype=np.int32)
+        labels[keep + 1] = np.arange(1, len(keep) + 1)
+        segmap = labels[segmap]
+    return catalog[keep], segmap, lost
+
+
+def extract_tiled(
+    detect,
+    lvl,
+    err,
+    tile_size=1024,
+    overlap=64,
+    num_workers=1,
+    object_limit=100000,
+    **extract_kwargs,
+):
+    """Runs sep.extract on overlapping tiles of an image and merges the catalogs
+
+    Parameters
+    ----------
+    detect : array
+        The detection image
+    lvl : float
+        The detection threshold, in units of err
+    err : float
+        The global noise level, e.g. the globalrms of a sep.Background of the whole image,
+        so that every tile uses the same threshold
+    tile_size : int
+        The size of the tile cores. Default is 1024
+    overlap : int
+        The margin added around each core.  Must be larger than the largest source footprint.
+        Default is 64
+    num_workers : int
+        The number of worker processes. Default is 1 (extract in this process).
+        Inside a daemonic process, e.g. a job of driver.run_jobs, the tiles are extracted serially
+    object_limit : int
+        Limit on number of sub-objects when deblending, per tile
+    **extract_kwargs : key word args
+        Key word args for sep.extract, e.g. segmentation_map and maskthresh
+
+    Returns
+    -------
+    catalog : numpy structured array
+        The merged catalog, with the dtype of sep.extract
+    segmap : array
+        The merged segmentation map if segmentation_map=True, with the labels in catalog order
+    """
+    detect = np.ascontiguousarray(detect)
+    tiles = _tile_slices(detect.shape, tile_size, overlap)
+    tasks = [
+        (np.ascontiguousarray(detect[tile]), core, tile, detect.shape, lvl, err, extract_kwargs, object_limit)
+        for core, tile in tiles
+    ]
+    num_workers = pool_workers(num_workers)
+    if num_workers > 1:
+        with mp.Pool(num_workers) as pool:
+            results = pool.map(_extract_tile, tasks)
+    else:
+        results = list(map(_extract_tile, tasks))
+
+    lost = sum(r[2] for r in results)
+    if lost > 0:
+        print(f"{lost} sources were larger than the tile overlap of {overlap} pixels and were dropped")
+
+    catalog = np.concatenate([r[0] for r in results])
+    if not extract_kwargs.get("segmentation_map"):
+        return catalog
+
+    segmap = np.zeros(detect.shape, dtype=np.int32)
+    offset = 0
+    for (core, tile), (cat, tile_segmap, _) in zip(tiles, results):
+        # Kept sources are complete in their tile, so their footprints are copied whole
+        mask = tile_segmap > 0
+        segmap[tile][mask] = tile_segmap[mask] + offset
+        offset += len(cat)
+    return catalog, segmap
@@ -1,47 +1,152 @@
 import numpy as np
 import os
+from functools import lru_cache
+from astropy.coordinates import SkyCoord
 from astropy.nddata import Cutout2D
 from astropy.wcs import WCS
 import astropy.io.fits as fits
 import matplotlib.pyplot as plt
 import scarlet
 import pandas as pd
-from scipy.ndimage import zoom
+from scipy.ndimage import map_coordinates, zoom
 
 from scarlet.display import AsinhMapping
 stretch = 1
 Q = 5
 NORM = AsinhMapping(minimum=0, stretch=stretch, Q=Q)
 
+DC2_PSF_IMG_DIR = '/home/wenyinli/wl_deepdisc/datasets/CosmoDC2/psf_img/'
 
-def get_psf_itpl(tract, patch, n_blocks, sp, band):
-    psf_fname = f'/home/wenyinli/wl_deepdisc/datasets/psf_data_25/{tract}/{patch}/{band}_psf_image.fits'
+
+DC2_PSF_GRID_DIR = '/home/wenyinli/wl_deepdisc/datasets/psf_data_25/'
+
+@lru_cache(maxsize=64)
+def _load_psf_grid(psf_fname):
+    """Load a low resolution PSF grid and its WCS, cached so each file is opened once per process"""
     with fits.open(psf_fname) as hdul_psf:
         psf_sam = hdul_psf[1].data
         wcs = WCS(hdul_psf[1].header).dropaxis(2)
+    return psf_sam, wcs
 
+def _psf_block(tract, patch, n_blocks, sp, band, psf_dir):
+    """Cut the low resolution PSF grid of sub-patch sp"""
+    psf_sam, wcs = _load_psf_grid(os.path.join(psf_dir, str(tract), str(patch), f'{band}_psf_image.fits'))
     low_res_block_size = [psf_sam.shape[1] // n_blocks, psf_sam.shape[2] // n_blocks]
     centers = get_centers(low_res_block_size[::-1], n_blocks)
-    coord = centers[sp]
+    cutout = Cutout2D(np.broadcast_to(np.float32(0), psf_sam.shape[1:]), position=centers[sp], size=low_res_block_size, wcs=wcs)
+    return psf_sam[(slice(None),) + cutout.slices_original]
 
-    cutout_low_res = np.zeros([3, low_res_block_size[0], low_res_block_size[1]])
-    for j in range(3):
-        cutout_low_res[j] = Cutout2D(psf_sam[j], position=coord, size=low_res_block_size, wcs=wcs).data
+def get_psf_itpl(tract, patch, n_blocks, sp, band, psf_dir=DC2_PSF_GRID_DIR, patch_size=4200):
+    cutout_low_res = _psf_block(tract, patch, n_blocks, sp, band, psf_dir)[:3].astype(np.float64)
 
-    final_block_size = int(4200 // n_blocks)
-    zoom_factor = [1, final_block_size / low_res_block_size[0], final_block_size / low_res_block_size[1]]
+    final_block_size = int(patch_size // n_blocks)
+    zoom_factor = [1, final_block_size / cutout_low_res.shape[1], final_block_size / cutout_low_res.shape[2]]
     
     return zoom(cutout_low_res, zoom_factor, order=1)
+
+def sample_psf(tract, patch, n_blocks, sp, band, x, y, psf_dir=DC2_PSF_GRID_DIR, patch_size=4200):
+    """
+    Evaluate the PSF of sub-patch sp at pixel positions, without interpolating the full resolution PSF image
+
+    The low resolution grid is sampled bilinearly at the grid coordinates of the rounded positions, which gives
+    the same values as indexing the zoomed image of get_psf_itpl.
+
+    Parameters
+    ----------
+    tract : int
+        The tract
+    patch : str
+        The patch, e.g. '2,2'
+    n_blocks : int
+        The patch is cut into n_blocks x n_blocks sub-patches
+    sp : int
+        The sub-patch index
+    band : str
+        The filter
+    x, y : array
+        The pixel positions in the sub-patch
+    psf_dir : str
+        Path to the directory of the {tract}/{patch}/{band}_psf_image.fits PSF grids
+    patch_size : int
+        The size of the full resolution patch in pixels. Default is 4200
+
+    Returns
+    -------
+    psf : ndarray
+        The 3 PSF parameters at each position, with dimensions [3, len(x)]
+    """
+    cutout_low_res = _psf_block(tract, patch, n_blocks, sp, band, psf_dir)[:3].astype(np.float64)
+    final_block_size = int(patch_size // n_blocks)
+
+    # zoom maps output pixel i to input coordinate i * (n_in - 1) / (n_out - 1)
+    rows = np.round(np.asarray(y, dtype=np.float64)) * (cutout_low_res.shape[1] - 1) / (final_block_size - 1)
+    cols = np.round(np.asarray(x, dtype=np.float64)) * (cutout_low_res.shape[2] - 1) / (final_block_size - 1)
+    return np.array([map_coordinates(plane, [rows, cols], order=1, mode='nearest') for plane in cutout_low_res])
             
-def get_psf(tract, patch, n_blocks, sp, catalog):
+def get_psf(tract, patch, n_blocks, sp, catalog, psf_dir=DC2_PSF_GRID_DIR):
     filters = ['u','g','r','i','z','y']
     n_truth = len(catalog['new_x'].values)
     psf_gt = np.zeros([len(filters), 3, n_truth])
     for (i, band) in enumerate(filters):
-        cutout = get_psf_itpl(tract, patch, n_blocks, sp, band)
-        psf_gt[i] = np.array([cutout[:,round(pos[1]), round(pos[0])] for pos in catalog[['new_x','new_y']].values]).transpose()
+        psf_gt[i] = sample_psf(tract, patch, n_blocks, sp, band, catalog['new_x'].values, catalog['new_y'].values, psf_dir=psf_dir)
     return psf_gt
 
+def _header_shape(header):
+    return tuple(header[f'NAXIS{i}'] for i in range(header['NAXIS'], 0, -1))
+
+def get_image_shape(filepath, ext=1):
+    """
+    Get the shape of an image HDU from its header, without reading any pixels
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    ext : int
+        The HDU index. Default is 1
+
+    Returns
+    -------
+    shape : tuple
+        The numpy shape of the image, e.g. (bands, N, M)
+    """
+    return _header_shape(fits.getheader(filepath, ext))
+
+def read_window(hdu, wcs, position=None, cutout_size=None):
+    """
+    Read a window of an image HDU through its section, so only the requested pixels are read from disk
+
+    Parameters
+    ----------
+    hdu : ImageHDU
+        The image HDU.  Any leading (e.g. band) axes are read in full
+    wcs : WCS
+        The celestial WCS of the last two axes of the image
+    position : tuple or SkyCoord
+        Center of the window, (x, y) in pixels or a SkyCoord.  Default is None (center of the image)
+    cutout_size : [int, int]
+        Size of the window (set to None for the whole image). Default is None
+
+    Returns
+    -------
+    data : ndarray
+        The image data in the window
+    cutout : Cutout2D
+        The cutout with the window WCS and slices, or None if cutout_size is None
+    """
+    if cutout_size is None:
+        return hdu.data, None
+
+    shape = _header_shape(hdu.header)
+    if position is None:
+        position = (shape[-1]/2, shape[-2]/2)
+
+    # Let Cutout2D work out the WCS and the overlap slices on a zero-size stand-in for the image
+    cutout = Cutout2D(np.broadcast_to(np.float32(0), shape[-2:]), position=position, size=cutout_size, wcs=wcs)
+    leading = tuple(slice(None) for _ in shape[:-2])
+    cutout.data = hdu.section[leading + cutout.slices_original]
+    return cutout.data, cutout
+
 def get_DC2_data(dirpath, filters=['u','g','r','i','z','y'], tract=10054, patch=[0,0], coord=None, cutout_size=[128, 128]):
     """
     Get HSC data given tract/patch info or SkyCoord
@@ -80,24 +185,10 @@ def get_DC2_data(dirpath, filters=['u','g','r','i','z','y'], tract=10054, patch=
         #print(f'Loading "{filepath}".')
         #try:
         
-        with fits.open(filepath) as obs_hdul:
-        #obs_hdul = fits.open(filepath)
-            data = obs_hdul[1].data
-            wcs = WCS(obs_hdul[1].header)
-        
-        cutout =None
-        
         # Cutout data at center of patch (coord=None) or at coord (if specified)
-        if cutout_size is not None:
-            # Use coord for center position if specified
-            if coord is None:
-                shape = np.shape(data)
-                position = (shape[0]/2, shape[1]/2)
-            else:
-                position = coord
-            #data = Cutout2D(data, position=position, size=cutout_size, wcs=wcs).data
-            cutout = Cutout2D(data, position=position, size=cutout_size, wcs=wcs)
-            data = cutout.data
+        with fits.open(filepath, memmap=True) as obs_hdul:
+            wcs = WCS(obs_hdul[1].header)
+            data, cutout = read_window(obs_hdul[1], wcs, position=coord, cutout_size=cutout_size)
 
         datas.append(data)
         #except:
@@ -138,39 +229,18 @@ def get_HSC(dirpath, filters=['G','R','I','Z','Y'], tract=10054, patch=[0,0], co
 
     
     datas = []
-    alldata = []
-    wcs_s = []
-
     psf=None
 
     for band in filters:
         filepath = os.path.join(dirpath,str(tract)+'/'+str(patch)+'/calexp-HSC-'+band+'-'+str(tract)+'-'+str(patch)+'.fits')
-        with fits.open(filepath) as obs_hdul:
-            #obs_hdul = fits.open(filepath)
-            alldata.append(obs_hdul[1].data)
-            wcs_s.append(WCS(obs_hdul[1].header))
+        # Cutout data at center of patch (coord=None) or at coord (if specified)
+        with fits.open(filepath, memmap=True) as obs_hdul:
+            wcs = WCS(obs_hdul[1].header)
+            datai, cutout = read_window(obs_hdul[1], wcs, position=coord, cutout_size=cutout_size)
             if get_psf:
                 psf = obs_hdul[3].data
 
-        cutout =None
-    
-    for i,f in enumerate(filters):
-        datai = alldata[i]
-        # Cutout data at center of patch (coord=None) or at coord (if specified)
-        if cutout_size is not None:
-            # Use coord for center position if specified
-            if coord is None:
-                shape = np.shape(data)
-                position = (shape[0]/2, shape[1]/2)
-            else:
-                position = coord
-            #data = Cutout2D(data, position=position, size=cutout_size, wcs=wcs).data
-            cutout = Cutout2D(datai, position=position, size=cutout_size, wcs=wcs_s[i])
-            datai = cutout.data
-
         datas.append(datai)
-            #except:
-            #    print('Missing filter ', f)        
 
 
     return np.array(datas), cutout, psf
@@ -205,42 +275,19 @@ def get_DC2_data_alltracts(dirpath, filters=['u','g','r','i','z','y'], tract=100
         DC2 data array with dimensions [filters, N, N]
     """
 
-    
-    datas = []
     filepath = os.path.join(dirpath,f'{tract}_{patch}_images.fits')
-
     psf=None
 
-    
-    with fits.open(filepath) as obs_hdul:
-        #obs_hdul = fits.open(filepath)
-        alldata = obs_hdul[1].data
+    # All bands are in one (band, N, N) HDU, so one section read gets the window of every band
+    with fits.open(filepath, memmap=True) as obs_hdul:
         wcs = WCS(obs_hdul[1].header).dropaxis(2)
+        data, cutout = read_window(obs_hdul[1], wcs, position=coord, cutout_size=cutout_size)
         if get_psf:
             psf = obs_hdul[2].data
-        
-    cutout =None
-    
-    for i,f in enumerate(filters):
-        datai = alldata[i]
-        # Cutout data at center of patch (coord=None) or at coord (if specified)
-        if cutout_size is not None:
-            # Use coord for center position if specified
-            if coord is None:
-                shape = np.shape(data)
-                position = (shape[0]/2, shape[1]/2)
-            else:
-                position = coord
-            #data = Cutout2D(data, position=position, size=cutout_size, wcs=wcs).data
-            cutout = Cutout2D(datai, position=position, size=cutout_size, wcs=wcs)
-            datai = cutout.data
-
-        datas.append(datai)
-            #except:
-            #    print('Missing filter ', f)        
 
+    datas = np.array(data[:len(filters)])
 
-    return np.array(datas), cutout, psf
+    return datas, cutout, psf
 
 def get_DC2_psf_alltracts(dirpath, filters=['u','g','r','i','z','y'], tract=10054, patch=[0,0], coord=None, cutout_size=[128, 128], get_psf=False):
     """
@@ -273,33 +320,18 @@ def get_DC2_psf_alltracts(dirpath, filters=['u','g','r','i','z','y'], tract=1005
 
     
     datas = []
-    dirpath = '/home/wenyinli/wl_deepdisc/datasets/CosmoDC2/psf_img/'
+    dirpath = DC2_PSF_IMG_DIR
     psf=None
-    cutout =None
     for i,f in enumerate(filters):
         filepath = os.path.join(dirpath+str(tract)+'/'+str(patch)+'/'+f+'_psf_image.fits')
-        with fits.open(filepath) as obs_hdul:
-            #obs_hdul = fits.open(filepath)
-            alldata = obs_hdul[1].data
+        # Cutout data at center of patch (coord=None) or at coord (if specified)
+        with fits.open(filepath, memmap=True) as obs_hdul:
             wcs = WCS(obs_hdul[1].header)
+            datai, cutout = read_window(obs_hdul[1], wcs, position=coord, cutout_size=cutout_size)
             if get_psf:
                 psf = obs_hdul[2].data
-        datai = alldata
-        # Cutout data at center of patch (coord=None) or at coord (if specified)
-        if cutout_size is not None:
-            # Use coord for center position if specified
-            if coord is None:
-                shape = np.shape(data)
-                position = (shape[0]/2, shape[1]/2)
-            else:
-                position = coord
-            #data = Cutout2D(data, position=position, size=cutout_size, wcs=wcs).data
-            cutout = Cutout2D(datai, position=position, size=cutout_size, wcs=wcs)
-            datai = cutout.data
 
         datas.append(datai)
-            #except:
-            #    print('Missing filter ', f)        
 
 
     return np.array(datas), cutout, psf
@@ -315,16 +347,123 @@ def get_centers(sub_shape,n):
     return centers
 
 
-def get_cutout(dirpath,tract,patch,sp,nblocks=4,filters=['u','g','r','i','z','y'],plot=False, get_psf=True):
+def _sub_patch_cutouts(shape, wcs, nblocks, sub_shape=None):
+    """
+    Make the Cutout2D of every sub-patch of a patch, in the same order as the sp index of get_cutout
 
-    #dat,cutout = get_DC2_data(dirpath,filters=filters,tract=tract,patch=patch,coord=None,cutout_size=None)
-    dat,cutout,psf = get_DC2_data_alltracts(dirpath,filters=filters,tract=tract,patch=patch,coord=None,cutout_size=None, get_psf=get_psf)
+    The cutouts are made on a zero-size stand-in for the image and only carry the WCS and slices
+    """
+    if sub_shape is None:
+        sub_shape = [shape[-2] // nblocks, shape[-1] // nblocks]
+    stand_in = np.broadcast_to(np.float32(0), shape[-2:])
+    centers = get_centers(sub_shape[::-1], nblocks)
+    return [Cutout2D(stand_in, position=coord, size=sub_shape, wcs=wcs) for coord in centers]
 
-    
-    block_size = [dat.shape[1]//nblocks, dat.shape[2]//nblocks]
+def tile_patch(dirpath, tract, patch, nblocks=4, filters=None, get_psf=True, psf_dirpath=DC2_PSF_IMG_DIR):
+    """
+    Cut a DC2 patch into all of its sub-patches, reading each band of the patch once
 
-    
-    sub_shape =[dat.shape[1]//nblocks,dat.shape[2]//nblocks]
+    Parameters
+    ----------
+    dirpath : str
+        Path to the directory of the {tract}_{patch}_images.fits files
+    tract : int
+        The tract
+    patch : str
+        The patch, e.g. '2,2'
+    nblocks : int
+        The patch is cut into nblocks x nblocks sub-patches. Default is 4
+    filters : list
+        A list of filters for your images. Default is None (['u','g','r','i','z','y'])
+    get_psf : bool
+        Whether to also return the PSF HDU of the patch. Default is True
+    psf_dirpath : str
+        Path to the directory of the {tract}/{patch}/{filter}_psf_image.fits PSF images
+
+    Yields
+    ------
+    sp : int
+        The sub-patch index, as used by get_cutout
+    cutout : Cutout2D
+        The cutout of the sub-patch with its WCS
+    dats_all : ndarray
+        The images followed by the PSF images of the sub-patch, with dimensions [2*filters, N, N]
+    psf : ndarray
+        The PSF HDU of the patch, or None if get_psf is False
+    """
+    if filters is None:
+        filters = ['u', 'g', 'r', 'i', 'z', 'y']
+
+    psf = None
+    with fits.open(os.path.join(dirpath, f'{tract}_{patch}_images.fits'), memmap=True) as obs_hdul:
+        data = np.array(obs_hdul[1].data[:len(filters)])
+        wcs = WCS(obs_hdul[1].header).dropaxis(2)
+        if get_psf:
+            psf = np.array(obs_hdul[2].data)
+
+    psf_data = []
+    for f in filters:
+        psf_file = os.path.join(psf_dirpath, str(tract), str(patch), f'{f}_psf_image.fits')
+        with fits.open(psf_file, memmap=True) as psf_hdul:
+            psf_data.append(np.array(psf_hdul[1].data))
+            psf_wcs = WCS(psf_hdul[1].header)
+    psf_data = np.array(psf_data)
+
+    sub_shape = [data.shape[1] // nblocks, data.shape[2] // nblocks]
+    cutouts = _sub_patch_cutouts(data.shape, wcs, nblocks)
+    psf_cutouts = _sub_patch_cutouts(psf_data.shape, psf_wcs, nblocks, sub_shape=sub_shape)
+    for sp, (cutout, psf_cutout) in enumerate(zip(cutouts, psf_cutouts)):
+        cutout.data = data[(slice(None),) + cutout.slices_original]
+        datsp = psf_data[(slice(None),) + psf_cutout.slices_original]
+        yield sp, cutout, np.concatenate((cutout.data, datsp), axis=0), psf
+
+def tile_patch_HSC(dirpath, tract, patch, nblocks=4, filters=None, get_psf=True):
+    """
+    Cut an HSC patch into all of its sub-patches, reading each band of the patch once
+
+    Parameters
+    ----------
+    dirpath : str
+        Path to HSC image file directory
+    tract : int
+        The tract
+    patch : str
+        The patch, e.g. '2,2'
+    nblocks : int
+        The patch is cut into nblocks x nblocks sub-patches. Default is 4
+    filters : list
+        A list of filters for your images. Default is None (['G','R','I','Z','Y'])
+    get_psf : bool
+        Whether to also return the PSF HDU of the last filter. Default is True
+
+    Yields
+    ------
+    sp : int
+        The sub-patch index, as used by get_cutout_HSC
+    cutout : Cutout2D
+        The cutout of the sub-patch with the WCS of the last filter
+    datsm : ndarray
+        The images of the sub-patch, with dimensions [filters, N, N]
+    psf : ndarray
+        The PSF HDU of the patch, or None if get_psf is False
+    """
+    if filters is None:
+        filters = ['G', 'R', 'I', 'Z', 'Y']
+
+    data, _, psf = get_HSC(dirpath, filters=filters, tract=tract, patch=patch, coord=None, cutout_size=None,
+                           get_psf=get_psf)
+    filepath = os.path.join(dirpath, f'{tract}/{patch}/calexp-HSC-{filters[-1]}-{tract}-{patch}.fits')
+    wcs = WCS(fits.getheader(filepath, 1))
+
+    for sp, cutout in enumerate(_sub_patch_cutouts(data.shape, wcs, nblocks)):
+        cutout.data = data[(slice(None),) + cutout.slices_original]
+        yield sp, cutout, cutout.data, psf
+
+def get_cutout(dirpath,tract,patch,sp,nblocks=4,filters=['u','g','r','i','z','y'],plot=False, get_psf=True):
+
+    # Only the header is needed to find the sub-patch, the full patch is read only for plotting
+    shape = get_image_shape(os.path.join(dirpath,f'{tract}_{patch}_images.fits'))
+    sub_shape =[shape[-2]//nblocks,shape[-1]//nblocks]
     centers = get_centers(sub_shape[::-1],nblocks)
 
     coord=centers[sp]
@@ -334,6 +473,7 @@ def get_cutout(dirpath,tract,patch,sp,nblocks=4,filters=['u','g','r','i','z','y'
     datsp, _ ,_ = get_DC2_psf_alltracts(dirpath,tract=tract,patch=patch,coord=coord,cutout_size=sub_shape, get_psf=get_psf)
     dats_all = np.concatenate((datsm, datsp), axis = 0)
     if plot:
+        dat,_,_ = get_DC2_data_alltracts(dirpath,filters=filters,tract=tract,patch=patch,coord=None,cutout_size=None)
         fig,ax = plt.subplots(1,2,figsize=(10,10))
         img_rgb = scarlet.display.img_to_rgb(dat, norm=NORM)
         img_rgbsm = scarlet.display.img_to_rgb(datsm, norm=NORM)
@@ -351,14 +491,9 @@ def get_cutout(dirpath,tract,patch,sp,nblocks=4,filters=['u','g','r','i','z','y'
 
 def get_cutout_HSC(dirpath,tract,patch,sp,nblocks=4,filters=['G','R','I','Z','Y'],plot=False, get_psf=True):
 
-    #dat,cutout = get_DC2_data(dirpath,filters=filters,tract=tract,patch=patch,coord=None,cutout_size=None)
-    dat,cutout,psf = get_HSC(dirpath,filters=filters,tract=tract,patch=patch,coord=None,cutout_size=None, get_psf=get_psf)
-
-    
-    block_size = [dat.shape[1]//nblocks, dat.shape[2]//nblocks]
-
-    
-    sub_shape =[dat.shape[1]//nblocks,dat.shape[2]//nblocks]
+    # Only the header is needed to find the sub-patch, the full patch is read only for plotting
+    shape = get_image_shape(os.path.join(dirpath,f'{tract}/{patch}/calexp-HSC-{filters[0]}-{tract}-{patch}.fits'))
+    sub_shape =[shape[-2]//nblocks,shape[-1]//nblocks]
     centers = get_centers(sub_shape[::-1],nblocks)
 
     coord=centers[sp]
@@ -366,6 +501,7 @@ def get_cutout_HSC(dirpath,tract,patch,sp,nblocks=4,filters=['G','R','I','Z','Y'
     #datsm,cutout = get_DC2_data(dirpath,tract=tract,patch=patch,coord=coord,cutout_size=sub_shape)
     datsm,cutout,psf = get_HSC(dirpath,tract=tract,patch=patch,coord=coord,cutout_size=sub_shape, get_psf=get_psf)
     if plot:
+        dat,_,_ = get_HSC(dirpath,filters=filters,tract=tract,patch=patch,coord=None,cutout_size=None)
         fig,ax = plt.subplots(1,2,figsize=(10,10))
         img_rgb = scarlet.display.img_to_rgb(dat, norm=NORM)
         img_rgbsm = scarlet.display.img_to_rgb(datsm, norm=NORM)
@@ -380,18 +516,26 @@ def get_cutout_HSC(dirpath,tract,patch,sp,nblocks=4,filters=['G','R','I','Z','Y'
     
     return cutout,datsm, psf
 
-def get_cutout_cat(dirpath,dall,tract,patch,sp,nblocks=4,filters=['u','g','r','i','z','y']):
+def get_cutout_cat(dirpath,dall,tract,patch,sp,nblocks=4,filters=['u','g','r','i','z','y'],index=None):
     '''
-        WARNING!!!!!
-        It is not efficient to have the full catalog as input when doing multiprocesing.  
-        Keep it in the top level process
+        Get a sub-patch and the catalog rows that fall inside it
+
+        With a CatalogIndex (see catalog_index.build_catalog_index) built from the ra/dec of dall,
+        only the rows near the sub-patch are projected.  The index is memory mapped, so it can be
+        passed to worker processes cheaply.  Without an index the full catalog is projected, and
+        it is not efficient to have the full catalog as input when doing multiprocesing.
     '''
 
-    cutout,datsm= get_cutout(tract=tract,patch=patch,sp=sp,nblocks=nblocks, filters=filters,plot=False)
-    xs,ys = cutout.wcs.world_to_pixel(allcatalog)
+    cutout,datsm,_ = get_cutout(dirpath,tract=tract,patch=patch,sp=sp,nblocks=nblocks,filters=filters,plot=False,get_psf=False)
+    if index is not None:
+        rows, coords = index.query_footprint(cutout.wcs, cutout.shape, return_coords=True)
+    else:
+        rows = np.arange(len(dall))
+        coords = SkyCoord(ra=dall['ra'].values, dec=dall['dec'].values, unit='deg')
+    xs,ys = cutout.wcs.world_to_pixel(coords)
     inds = np.where((xs>=0) & (xs<cutout.shape[1]-1) & (ys>=0) & (ys<cutout.shape[0]-1))[0]
     
-    dcut = dall.iloc[inds]
+    dcut = dall.iloc[rows[inds]].copy()
 
     dcut['new_x'] = xs[inds]
     dcut['new_y'] = ys[inds]
@@ -402,4 +546,4 @@ def get_cutout_cat(dirpath,dall,tract,patch,sp,nblocks=4,filters=['u','g','r','i
     dcut.insert(0, "objectId", column_to_move)
     dcut.sort_values(by='objectId')
     
-    return datsm, dcut
\ No newline at end of file
+    return datsm, dcut
@@ -5,6 +5,9 @@ import os
 import h5py
 import pandas as pd
 
+from deepdisc.data_format.annotation_functions.mask_reader import write_packed_masks
+from deepdisc.preprocessing.blends import render_source
+
 
 def write_scarlet_results(
     datas,
@@ -118,9 +121,7 @@ def write_scarlet_results(
             else:
                 source_cat=None
             # Get each model, make into image
-            model = starlet_sources[k].get_model(frame=model_frame)
-            model = observation.render(model)
-            model = src.bbox.extract_from(model)
+            model = render_source(src, observation, model_frame)
 
             model_hdr = _make_hdr(starlet_sources[k], cat, source_cat)
 
@@ -174,6 +175,223 @@ def write_scarlet_results(
 
 
 
+def dc2_source_header(starlet_source, source_cat=None):
+    """
+    Makes the FITS header of a source with the DC2 truth catalog metadata.
+    Parameters
+    ----------
+    starlet_source: starlet_source
+        starlet_source object for source k
+    source_cat: pandas Series
+        truth catalog row of source k
+
+    Returns
+    -------
+    model_hdr : Astropy fits.Header
+        FITS header for source k with catalog metadata
+    """
+    # For each header, assign descriptive data about each source
+    # (x0, y0, w, h) in absolute floating pixel coordinates
+    bbox_h = starlet_source.bbox.shape[1]
+    bbox_w = starlet_source.bbox.shape[2]
+    bbox_y = starlet_source.bbox.origin[1] + int(np.floor(bbox_w / 2))  # y-coord of the source's center
+    bbox_x = starlet_source.bbox.origin[2] + int(np.floor(bbox_w / 2))  # x-coord of the source's center
+
+    
+    # Add info to header
+    model_hdr = fits.Header()
+    model_hdr["bbox"] = ",".join(map(str, [bbox_x, bbox_y, bbox_w, bbox_h]))
+    model_hdr["area"] = bbox_w * bbox_h
+
+    if source_cat is not None:
+        #catalog_redshift = source_cat["redshift_truth"]
+        #oid = source_cat["objectId"]
+        catalog_redshift = source_cat["redshift"]
+        oid = source_cat["id"]
+        imag = source_cat["mag_i"]
+        shear_1 = source_cat["shear_1"]
+        shear_2 = source_cat["shear_2"]
+        convergence = source_cat["convergence"]
+        et_1 = source_cat["ellipticity_1_true"]
+        et_2 = source_cat["ellipticity_2_true"]
+        size_1 = source_cat["size_true"]
+        
+        if not np.isfinite(imag):
+            imag = -1
+        #model_hdr["cat_id"] = source_cat['truth_type']  # Category ID
+        model_hdr["redshift"] = catalog_redshift
+        model_hdr["objid"] = oid
+        model_hdr["mag_i"] = imag
+        model_hdr["shear_1"] = shear_1
+        model_hdr["shear_2"] = shear_2
+        model_hdr["kappa"] = convergence
+        model_hdr["et_1"] = et_1
+        model_hdr["et_2"] = et_2
+        model_hdr["size_1"] = size_1
+        #for psf_i in range(18):
+        #    model_hdr["psf_"+str(psf_i)] = source_cat["psf_"+str(psf_i)]
+
+    return model_hdr
+
+
+def _bbox_columns(starlet_sources):
+    """The BBOX and AREA of every source as columns, as written to the source headers"""
+    boxes = np.array(
+        [[*src.bbox.origin[1:], *src.bbox.shape[1:]] for src in starlet_sources], dtype=np.int64
+    ).reshape(-1, 4)
+    y0, x0, bbox_h, bbox_w = boxes.T
+    # The headers offset both coordinates by half the width
+    bbox_y = y0 + bbox_w // 2
+    bbox_x = x0 + bbox_w // 2
+    bbox = [f"{x},{y},{w},{h}" for x, y, w, h in zip(bbox_x, bbox_y, bbox_w, bbox_h)]
+    return {"BBOX": np.array(bbox), "AREA": bbox_w * bbox_h}
+
+
+def dc2_source_columns(starlet_sources, source_catalog=None):
+    """
+    Makes the metadata columns of all sources for the packed mask layout, with the same
+    values as dc2_source_header.
+    Parameters
+    ----------
+    starlet_sources: list
+        List of ScarletSource objects
+    source_catalog: pandas df
+        truth catalog, with one row per source
+
+    Returns
+    -------
+    columns : dict
+        The metadata columns
+    """
+    columns = _bbox_columns(starlet_sources)
+    if source_catalog is not None:
+        cat = source_catalog.iloc[: len(starlet_sources)]
+        imag = cat["mag_i"].to_numpy(dtype=float)
+        columns["REDSHIFT"] = cat["redshift"].to_numpy()
+        columns["OBJID"] = cat["id"].to_numpy()
+        columns["MAG_I"] = np.where(np.isfinite(imag), imag, -1)
+        columns["SHEAR_1"] = cat["shear_1"].to_numpy()
+        columns["SHEAR_2"] = cat["shear_2"].to_numpy()
+        columns["KAPPA"] = cat["convergence"].to_numpy()
+        columns["ET_1"] = cat["ellipticity_1_true"].to_numpy()
+        columns["ET_2"] = cat["ellipticity_2_true"].to_numpy()
+        columns["SIZE_1"] = cat["size_true"].to_numpy()
+    return columns
+
+
+def hsc_source_columns(starlet_sources, source_catalog=None):
+    """
+    Makes the metadata columns of all sources for the packed mask layout, with the same
+    values as the headers of write_scarlet_results_HSC.
+    Parameters
+    ----------
+    starlet_sources: list
+        List of ScarletSource objects
+    source_catalog: pandas df
+        HSC catalog, with one row per source
+
+    Returns
+    -------
+    columns : dict
+        The metadata columns
+    """
+    columns = _bbox_columns(starlet_sources)
+    if source_catalog is not None:
+        cat = pd.DataFrame(source_catalog).iloc[: len(starlet_sources)]
+        columns["OBJID"] = cat["object_id"].to_numpy().astype(int)
+        columns["ET_1"] = cat["e1"].to_numpy()
+        columns["ET_2"] = cat["e2"].to_numpy()
+        columns["E_WEIGHT"] = cat["shape_weight"].to_numpy()
+        columns["E_RMS"] = cat["rms_e"].to_numpy()
+        columns["E_SIGMA"] = cat["sigma_e"].to_numpy()
+        columns["HAS_E"] = cat["has_shape"].to_numpy()
+        columns["C_ID"] = np.where(cat["i_calib_psf_used"].to_numpy(dtype=bool), 1, 0)
+        columns["MAG_I"] = cat["i_cmodel_mag"].to_numpy()
+    return columns
+
+
+def _stream_hdu(filename, hdu):
+    """Appends an HDU to a FITS file, without reading or holding the rest of the file"""
+    streaming_hdu = fits.StreamingHDU(filename, hdu.header)
+    if hdu.data is not None:
+        streaming_hdu.write(hdu.data)
+    streaming_hdu.close()
+
+
+class StreamingResultsWriter:
+    """Writes the segmentation mask (and optionally the model) of each source as it is rendered
+
+    Pass to run_scarlet as `writer`, so that the masks are written one HDU at a time instead of
+    being kept until the end.  The masks.fits file is the same as the one written by
+    write_scarlet_results_nomodels.  The files are written under a temporary name and moved into
+    place by close(), so an interrupted job does not leave a partial file behind.
+    """
+
+    def __init__(self, outdir, filters=None, write_models=False, make_header=dc2_source_header):
+        """
+        Parameters
+        ----------
+        outdir : str
+            The output directory
+        filters : list
+            The filters of the models, needed if write_models is True
+        write_models : bool
+            Whether to also write the rendered model of each source to model_{f}.fits for every
+            filter. Default is False
+        make_header : function
+            Makes the header of a source as make_header(starlet_source, source_cat).
+            Default is dc2_source_header
+        """
+        self.make_header = make_header
+        self.filters = list(filters) if write_models else []
+        self.filenames = {"segmask": os.path.join(outdir, "masks.fits")}
+        for f in self.filters:
+            self.filenames[f"model_{f}"] = os.path.join(outdir, f"model_{f}.fits")
+
+        for filename in self.filenames.values():
+            tmp_file = filename + ".tmp"
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            _stream_hdu(tmp_file, fits.PrimaryHDU())
+
+    def write(self, starlet_source, model, mask, source_cat=None):
+        """Appends the model and mask of one source, in catalog order
+
+        Parameters
+        ----------
+        starlet_source : scarlet source
+            The source, for its bounding box
+        model : array
+            The rendered model of the source in its box, shape (Nfilters x h x w)
+        mask : array
+            The segmentation mask of the source in its box, or None
+        source_cat : pandas Series (optional)
+            The catalog row of the source
+        """
+        hdr = self.make_header(starlet_source, source_cat)
+        if mask is not None:
+            _stream_hdu(self.filenames["segmask"] + ".tmp", fits.ImageHDU(data=mask, header=hdr))
+        for i, f in enumerate(self.filters):
+            _stream_hdu(self.filenames[f"model_{f}"] + ".tmp", fits.ImageHDU(data=model[i], header=hdr))
+
+    def close(self):
+        """Moves the finished files into place and returns their filenames"""
+        for filename in self.filenames.values():
+            os.replace(filename + ".tmp", filename)
+        return self.filenames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for filename in self.filenames.values():
+                if os.path.exists(filename + ".tmp"):
+                    os.remove(filename + ".tmp")
+
+
 def write_scarlet_results_nomodels(
     datas,
     observation,
@@ -184,6 +402,7 @@ def write_scarlet_results_nomodels(
     filters,
     s,
     catalog=None,
+    layout="hdus",
 ):
     """
     Saves images in each channel, with headers for each source in image,
@@ -211,6 +430,10 @@ def write_scarlet_results_nomodels(
         A list of filters for your images. Default is ['g', 'r', 'i'].
     s : str
         File basename string
+    layout : str
+        "hdus" to write one ImageHDU per source mask, or "packed" to write all masks and a
+        table of their metadata in three HDUs, see mask_reader.write_packed_masks.
+        Default is "hdus"
 
 
     Returns
@@ -220,64 +443,6 @@ def write_scarlet_results_nomodels(
         Saved image and model files for each filter, and one total segmentation mask file for all filters.
     """
 
-    def _make_hdr(starlet_source, source_cat=None):
-        """
-        Helper function to make FITS header and insert metadata.
-        Parameters
-        ----------
-        starlet_source: starlet_source
-            starlet_source object for source k
-        cat: dict
-            catalog data for source k
-
-        Returns
-        -------
-        model_hdr : Astropy fits.Header
-            FITS header for source k with catalog metadata
-        """
-        # For each header, assign descriptive data about each source
-        # (x0, y0, w, h) in absolute floating pixel coordinates
-        bbox_h = starlet_source.bbox.shape[1]
-        bbox_w = starlet_source.bbox.shape[2]
-        bbox_y = starlet_source.bbox.origin[1] + int(np.floor(bbox_w / 2))  # y-coord of the source's center
-        bbox_x = starlet_source.bbox.origin[2] + int(np.floor(bbox_w / 2))  # x-coord of the source's center
-
-        
-        # Add info to header
-        model_hdr = fits.Header()
-        model_hdr["bbox"] = ",".join(map(str, [bbox_x, bbox_y, bbox_w, bbox_h]))
-        model_hdr["area"] = bbox_w * bbox_h
-
-        if source_cat is not None:
-            #catalog_redshift = source_cat["redshift_truth"]
-            #oid = source_cat["objectId"]
-            catalog_redshift = source_cat["redshift"]
-            oid = source_cat["id"]
-            imag = source_cat["mag_i"]
-            shear_1 = source_cat["shear_1"]
-            shear_2 = source_cat["shear_2"]
-            convergence = source_cat["convergence"]
-            et_1 = source_cat["ellipticity_1_true"]
-            et_2 = source_cat["ellipticity_2_true"]
-            size_1 = source_cat["size_true"]
-            
-            if not np.isfinite(imag):
-                imag = -1
-            #model_hdr["cat_id"] = source_cat['truth_type']  # Category ID
-            model_hdr["redshift"] = catalog_redshift
-            model_hdr["objid"] = oid
-            model_hdr["mag_i"] = imag
-            model_hdr["shear_1"] = shear_1
-            model_hdr["shear_2"] = shear_2
-            model_hdr["kappa"] = convergence
-            model_hdr["et_1"] = et_1
-            model_hdr["et_2"] = et_2
-            model_hdr["size_1"] = size_1
-            #for psf_i in range(18):
-            #    model_hdr["psf_"+str(psf_i)] = source_cat["psf_"+str(psf_i)]
-
-        return model_hdr
-
     # Create dict for all saved filenames
     segmask_hdul = []
     filenames = {}
@@ -306,7 +471,15 @@ def write_scarlet_results_nomodels(
 
     # If we have segmentation mask data, save them as a separate fits file
     # Just using the first band for the segmentation mask
-    if segmentation_masks is not None:
+    if segmentation_masks is not None and layout == "packed":
+        filenames["segmask"] = os.path.join(outdir, "masks.fits")
+        write_packed_masks(
+            filenames["segmask"],
+            [segmentation_masks[k] for k in range(len(starlet_sources))],
+            dc2_source_columns(starlet_sources, catalog),
+            dtype=np.uint8,
+        )
+    elif segmentation_masks is not None:
         for i, f in enumerate(filters[0]):
             # Create header entry for each scarlet source
             for k, src in enumerate(starlet_sources):
@@ -316,7 +489,7 @@ def write_scarlet_results_nomodels(
                     source_cat=None
 
                 #segmask_hdr = _make_hdr(starlet_sources[k], cat, source_cat)
-                segmask_hdr = _make_hdr(starlet_sources[k], source_cat)
+                segmask_hdr = dc2_source_header(starlet_sources[k], source_cat)
 
                 # Save each model source k in the image
                 segmask_hdu = fits.ImageHDU(data=segmentation_masks[k], header=segmask_hdr)
@@ -344,6 +517,7 @@ def write_scarlet_results_HSC(
     filters,
     s,
     source_catalog=None,
+    layout="hdus",
 ):
     """
     Saves images in each channel, with headers for each source in image,
@@ -371,6 +545,10 @@ def write_scarlet_results_HSC(
         A list of filters for your images. Default is ['g', 'r', 'i'].
     s : str
         File basename string
+    layout : str
+        "hdus" to write one ImageHDU per source mask, or "packed" to write all masks and a
+        table of their metadata in three HDUs, see mask_reader.write_packed_masks.
+        Default is "hdus"
 
 
     Returns
@@ -464,7 +642,15 @@ def write_scarlet_results_HSC(
 
     # If we have segmentation mask data, save them as a separate fits file
     # Just using the first band for the segmentation mask
-    if segmentation_masks is not None:
+    if segmentation_masks is not None and layout == "packed":
+        filenames["segmask"] = os.path.join(outdir, "masks.fits")
+        write_packed_masks(
+            filenames["segmask"],
+            [segmentation_masks[k] for k in range(len(starlet_sources))],
+            hsc_source_columns(starlet_sources, source_catalog),
+            dtype=np.uint8,
+        )
+    elif segmentation_masks is not None:
         for i, f in enumerate(filters[0]):
             # Create header entry for each scarlet source
             for k, src in enumerate(starlet_sources):
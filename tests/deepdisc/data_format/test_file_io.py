@@ -1,10 +1,11 @@
+import glob
 import os
 
 import pytest
 
 from deepdisc.data_format.annotation_functions.annotate_hsc import annotate_hsc
 from deepdisc.data_format.annotation_functions.annotate_decam import annotate_decam
-from deepdisc.data_format.file_io import DDLoader, get_data_from_json
+from deepdisc.data_format.file_io import DDLoader, get_data_from_json, match_files, scan_tree
 
 
 def test_get_data_from_json(tmp_path):
@@ -236,3 +237,124 @@ def test_data_loader_open_json_coco_file(hsc_single_test_file):
     assert len(dataset[0]['annotations']) == 454
     assert dataset[0]['height'] == 1050
     assert dataset[0]['width'] == 1025
+
+
+def make_tree(root):
+    """Writes a tract/patch/sub-patch tree of image and mask files with old modification times."""
+    for tract in ["3828", "3829"]:
+        for patch in ["1,1", "2,2"]:
+            for sp in ["0", "1"]:
+                leaf = root / tract / patch / sp
+                leaf.mkdir(parents=True)
+                for name in ["image_g.fits", "image_r.fits", "masks.fits", ".masks.fits"]:
+                    (leaf / name).touch()
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, ns=(10**18, 10**18))
+
+
+def test_scan_tree_matches_glob(tmp_path):
+    """Test that the listing finds the same files as glob."""
+    make_tree(tmp_path)
+    tree = scan_tree(str(tmp_path), 3)
+    for pattern in ["image_*.fits", "masks.fits", "*"]:
+        expected = sorted(glob.glob(os.path.join(str(tmp_path), "*", "*", "*", pattern)))
+        assert match_files(str(tmp_path), tree, pattern) == expected
+
+
+def test_scan_tree_only_lists_changed_directories(tmp_path, monkeypatch):
+    """Test that a manifest is reused for the directories that did not change."""
+    make_tree(tmp_path)
+    manifest = scan_tree(str(tmp_path), 3)
+
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: listed.append(path) or scandir(path))
+    assert scan_tree(str(tmp_path), 3, manifest=manifest) == manifest
+    assert listed == []
+
+    (tmp_path / "3829" / "2,2" / "1" / "image_i.fits").touch()
+    tree = scan_tree(str(tmp_path), 3, manifest=manifest)
+    assert listed == [os.path.join(str(tmp_path), "3829", "2,2", "1")]
+    assert len(match_files(str(tmp_path), tree, "image_*.fits")) == 17
+
+
+def test_data_loader_generate_filedict_manifest(tmp_path):
+    """Test that a filedict built from a saved manifest is the same."""
+    make_tree(tmp_path / "data")
+    manifest_file = str(tmp_path / "manifest.json")
+    filedicts = []
+    for _ in range(2):
+        loader = DDLoader().generate_filedict(
+            str(tmp_path / "data"),
+            ["g", "r"],
+            "image_*.fits",
+            "masks.fits",
+            subdirs=True,
+            filt_loc=-6,
+            manifest_file=manifest_file,
+        )
+        filedicts.append(loader.filedict)
+    assert os.path.exists(manifest_file)
+    assert filedicts[0] == filedicts[1]
+    assert len(filedicts[0]["g"]["img"]) == len(filedicts[0]["mask"]) == 8
+    assert filedicts[0]["index"] == list(range(8))
+
+
+def annotate_names(images, mask, index, filters, fail_index=None):
+    """A toy annotation function that fails on one index."""
+    if index == fail_index:
+        raise ValueError(f"bad image set {index}")
+    return {"file_name": os.path.basename(images[0]), "image_id": index, "filters": filters}
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_data_loader_generate_dataset_dict_workers(tmp_path, num_workers):
+    """Test that records keep their order in a process pool and that failures are collected."""
+    make_tree(tmp_path)
+    loader = DDLoader().generate_filedict(
+        str(tmp_path), ["g", "r"], "image_*.fits", "masks.fits", subdirs=True, filt_loc=-6
+    )
+    dataset = loader.generate_dataset_dict(
+        annotate_names, num_workers=num_workers, chunksize=3, skip_failures=True, fail_index=5
+    ).get_dataset()
+
+    assert [d["image_id"] for d in dataset] == [0, 1, 2, 3, 4, 6, 7]
+    assert dataset[0]["filters"] == ["g", "r"]
+    assert len(loader.failures) == 1
+    assert loader.failures[0]["index"] == 5
+    assert "bad image set 5" in loader.failures[0]["error"]
+
+    with pytest.raises(ValueError):
+        loader.generate_dataset_dict(annotate_names, num_workers=num_workers, fail_index=5)
+
+
+def test_data_loader_generate_dataset_dict_incremental(tmp_path):
+    """Test that only the image sets whose files changed are annotated again."""
+    make_tree(tmp_path / "data")
+    loader = DDLoader().generate_filedict(
+        str(tmp_path / "data"), ["g", "r"], "image_*.fits", "masks.fits", subdirs=True, filt_loc=-6
+    )
+    index_file = str(tmp_path / "records.jsonl")
+
+    annotated = []
+
+    def count_calls(images, mask, index, filters):
+        annotated.append(index)
+        return annotate_names(images, mask, index, filters)
+
+    expected = loader.generate_dataset_dict(count_calls, index_file=index_file).get_dataset()
+    assert annotated == list(range(8))
+
+    annotated.clear()
+    with open(loader.filedict["mask"][3], "w") as f:
+        f.write("regenerated")
+    dataset = loader.generate_dataset_dict(count_calls, index_file=index_file).get_dataset()
+    assert dataset == expected
+    assert annotated == [3]
+
+    # Switching to content hashes annotates everything once, then nothing
+    annotated.clear()
+    for _ in range(2):
+        dataset = loader.generate_dataset_dict(count_calls, index_file=index_file, fingerprint="hash")
+        assert dataset.get_dataset() == expected
+    assert annotated == list(range(8))
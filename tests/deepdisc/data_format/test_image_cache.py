@@ -0,0 +1,132 @@
+import errno
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from deepdisc.data_format.image_cache import DiskImageCache, SharedMemoryImageCache
+from deepdisc.data_format.image_readers import wlHSCImageReader
+
+
+@pytest.fixture
+def hsc_band_files(tmp_path):
+    bands = ["G", "R", "I"]
+    prefix = os.path.join(tmp_path, "cutout")
+    for i, band in enumerate(bands):
+        fits.PrimaryHDU(data=np.arange(120, dtype=np.float32).reshape(12, 10) * (i + 1)).writeto(f"{prefix}_{band}.fits")
+    return prefix, bands
+
+
+def test_cached_reads_match_uncached_reads(tmp_path, hsc_band_files):
+    """Test that a cache hit returns the same scaled image as reading the files."""
+    prefix, bands = hsc_band_files
+    cache = DiskImageCache(os.path.join(tmp_path, "cache"))
+    ir = wlHSCImageReader(bands, norm="zscore", cache=cache, A=3.0)
+    expected = wlHSCImageReader(bands, norm="zscore", A=3.0)(prefix)
+
+    first = ir(prefix)
+    second = ir(prefix)
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(first, expected)
+    np.testing.assert_array_equal(second, expected)
+
+
+def test_cache_key_changes_with_inputs(tmp_path, hsc_band_files):
+    """Test that the key covers the scaling kwargs and the source file modification times."""
+    prefix, bands = hsc_band_files
+    cache = DiskImageCache(os.path.join(tmp_path, "cache"))
+    files = [f"{prefix}_{band}.fits" for band in bands]
+    key = cache.make_key(prefix, files, "zscore", {"A": 1.0})
+    assert key != cache.make_key(prefix, files, "zscore", {"A": 2.0})
+
+    os.utime(files[0], ns=(0, 0))
+    assert key != cache.make_key(prefix, files, "zscore", {"A": 1.0})
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    """Test that the cache stays within its size budget by dropping the oldest images."""
+    image = np.zeros((32, 32, 3), dtype=np.float32)
+    cache = DiskImageCache(os.path.join(tmp_path, "cache"), max_bytes=int(2.5 * image.nbytes))
+    for i, key in enumerate(["aa1", "bb2", "cc3"]):
+        cache.put(key, image)
+        os.utime(cache._path(key), ns=(i * 10**9, i * 10**9))
+        cache.evict(cache.max_bytes)
+
+    assert cache.get("aa1") is None
+    assert cache.get("cc3") is not None
+
+
+def test_float16_cache_returns_float32(tmp_path):
+    cache = DiskImageCache(os.path.join(tmp_path, "cache"), dtype=np.float16)
+    cache.put("key", np.ones((4, 4, 2), dtype=np.float32))
+    image = cache.get("key")
+    assert image.dtype == np.float32
+    np.testing.assert_array_equal(image, 1.0)
+
+
+def test_shared_cache_is_filled_once(tmp_path, hsc_band_files):
+    """Test that a second reader is served from the shared cache instead of the files."""
+    prefix, bands = hsc_band_files
+    shm = SharedMemoryImageCache(name="test", shm_dir=str(tmp_path))
+    expected = wlHSCImageReader(bands, norm="zscore")(prefix)
+
+    first = wlHSCImageReader(bands, norm="zscore", shared_cache=shm)(prefix)
+    reader = wlHSCImageReader(bands, norm="zscore", shared_cache=shm)
+
+    def _fail(key):
+        raise AssertionError("The image should come from the shared cache")
+
+    reader._read_image = _fail
+    second = reader(prefix)
+
+    np.testing.assert_array_equal(first, expected)
+    np.testing.assert_array_equal(second, expected)
+
+
+def test_shared_cache_respects_budget(tmp_path):
+    image = np.zeros((8, 8, 2), dtype=np.float32)
+    shm = SharedMemoryImageCache(name="test", max_bytes=image.nbytes, shm_dir=str(tmp_path))
+    shm.put("a", image)
+    shm.put("b", image)
+    assert shm.get("a") is not None
+    assert shm.get("b") is None
+    shm.clear()
+    assert not os.path.exists(shm.cache_dir)
+
+
+def test_shared_cache_frees_failed_slots(tmp_path, monkeypatch):
+    """Test that a failed write gives back its slot and its reservation."""
+    image = np.zeros((8, 8, 2), dtype=np.float32)
+    shm = SharedMemoryImageCache(name="test", max_bytes=image.nbytes, shm_dir=str(tmp_path))
+
+    def _fail(*args):
+        raise OSError(errno.EIO, "I/O error")
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", _fail)
+        shm.put("a", image)
+    assert not os.path.exists(shm._path("a") + ".tmp")
+    assert shm.get("a") is None
+
+    shm.put("a", image)
+    assert shm.get("a") is not None
+    with open(os.path.join(shm.cache_dir, "reserved_bytes")) as f:
+        assert int(f.read()) == image.nbytes
+
+
+def test_shared_cache_takes_over_stale_slots(tmp_path):
+    """Test that a slot left behind by a dead writer is only taken over once it is stale."""
+    image = np.ones((8, 8, 2), dtype=np.float32)
+    shm = SharedMemoryImageCache(name="test", shm_dir=str(tmp_path), stale_seconds=60)
+    tmp_file = shm._path("a") + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(b"\x93NUMPY")
+
+    shm.put("a", image)
+    assert shm.get("a") is None
+
+    os.utime(tmp_file, (0, 0))
+    shm.put("a", image)
+    np.testing.assert_array_equal(shm.get("a"), image)
+    assert not os.path.exists(tmp_file)
@@ -0,0 +1,87 @@
+import numpy as np
+
+from deepdisc.data_format.image_readers import NumpyImageReader
+from deepdisc.data_format.image_stats import (
+    PixelStats,
+    add_image_stats,
+    compute_pixel_stats,
+    format_pixel_stats,
+    image_moments,
+)
+
+
+def test_image_moments():
+    rng = np.random.default_rng(0)
+    im = rng.normal(loc=[1.0, 2.0], scale=[0.5, 3.0], size=(200, 200, 2)).astype(np.float32)
+    stats = image_moments(im)
+    np.testing.assert_allclose(stats["mean"], [1.0, 2.0], atol=0.05)
+    np.testing.assert_allclose(stats["std"], [0.5, 3.0], rtol=0.02)
+    np.testing.assert_allclose(stats["sigma_robust"], [0.5, 3.0], rtol=0.05)
+    assert np.isclose(stats["image_mean"], np.mean(im))
+
+
+def test_zscore_uses_stored_stats(tmp_path):
+    """Test that zscore with stored statistics matches zscore computing them on the fly."""
+    rng = np.random.default_rng(1)
+    fn = str(tmp_path / "img.npy")
+    np.save(fn, rng.normal(size=(3, 16, 16)).astype(np.float32))
+    dataset_dicts = [{"file_name": fn}]
+
+    ir = NumpyImageReader(norm="zscore")
+    add_image_stats(dataset_dicts, ir, lambda d: d["file_name"])
+    stats = dataset_dicts[0]["norm_stats"]
+
+    np.testing.assert_allclose(ir(fn, stats=stats), ir(fn), rtol=1e-5, atol=1e-6)
+
+    # The stored statistics are used instead of those of the image
+    shifted = dict(stats, image_mean=stats["image_mean"] + 1.0)
+    np.testing.assert_allclose(ir(fn, stats=shifted), ir(fn) - 1.0 / stats["image_std"], atol=1e-5)
+
+
+def test_add_image_stats_reads_unscaled_images(tmp_path):
+    """Test that the stored statistics are those of the unscaled images, also with a pool."""
+    rng = np.random.default_rng(3)
+    dataset_dicts = []
+    for i in range(4):
+        fn = str(tmp_path / f"img{i}.npy")
+        np.save(fn, rng.normal(loc=i, size=(2, 8, 8)).astype(np.float32))
+        dataset_dicts.append({"file_name": fn})
+
+    add_image_stats(dataset_dicts, NumpyImageReader(norm="zscore"), lambda d: d["file_name"], num_workers=2)
+    for d in dataset_dicts:
+        expected = image_moments(np.transpose(np.load(d["file_name"]), axes=(1, 2, 0)))
+        for name, value in expected.items():
+            np.testing.assert_allclose(d["norm_stats"][name], value, rtol=1e-5, atol=1e-6)
+
+
+def test_compute_pixel_stats_matches_numpy(tmp_path):
+    """Test that the streamed statistics equal those of all images stacked together."""
+    rng = np.random.default_rng(2)
+    images = [rng.normal(loc=i, size=(2, 8, 8 + i)).astype(np.float32) for i in range(5)]
+    dataset_dicts = []
+    for i, image in enumerate(images):
+        fn = str(tmp_path / f"img{i}.npy")
+        np.save(fn, image)
+        dataset_dicts.append({"file_name": fn})
+
+    stats = compute_pixel_stats(
+        dataset_dicts, NumpyImageReader(norm="raw"), lambda d: d["file_name"], num_workers=2, quantiles=[0.5]
+    )
+    pixels = np.concatenate([image.reshape(2, -1) for image in images], axis=1)
+    np.testing.assert_allclose(stats["pixel_mean"], pixels.mean(axis=1), rtol=1e-6)
+    np.testing.assert_allclose(stats["pixel_std"], pixels.std(axis=1), rtol=1e-6)
+    np.testing.assert_allclose(stats["quantiles"][0.5], np.median(pixels, axis=1), atol=0.2)
+    assert format_pixel_stats(stats).startswith("model.pixel_mean = [")
+
+
+def test_pixel_sample_is_uniform_over_pixels():
+    """Test that a large image is not under-represented in the quantile sample."""
+    total = PixelStats(1, max_samples=2000, sample_per_image=2000, seed=0)
+    total.update(np.ones((100, 100, 1), dtype=np.float32))
+    for i in range(100):
+        small = PixelStats(1, max_samples=2000, sample_per_image=2000, seed=i + 1)
+        total.merge(small.update(np.zeros((10, 10, 1), dtype=np.float32)))
+
+    # Half of the pixels are in the large image
+    assert len(total.samples) == 2000
+    assert abs(total.samples.mean() - 0.5) < 0.05
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from deepdisc.data_format.annotation_functions.mask_reader import SourceMasks, image_shape, write_packed_masks
+
+
+@pytest.fixture
+def mask_file(tmp_path):
+    """A mask file with an empty primary HDU and one HDU per source."""
+    hdus = [fits.PrimaryHDU()]
+    for k in range(4):
+        header = fits.Header()
+        header["BBOX"] = f"{10 * k},{5 * k},{3 + k},{4 + k}"
+        header["objid"] = 100 + k
+        if k != 2:
+            header["c_id"] = 1
+        hdus.append(fits.ImageHDU(data=np.full((4 + k, 3 + k), k, dtype=np.float32), header=header))
+    filename = str(tmp_path / "masks.fits")
+    fits.HDUList(hdus).writeto(filename)
+    return filename
+
+
+def test_source_masks_columns(mask_file):
+    """Test that the headers are read into columns and the data on request."""
+    with SourceMasks(mask_file, ["BBOX", "objid", "c_id"], defaults={"c_id": 0}) as masks:
+        assert len(masks) == 4
+        assert masks.bbox == [[0, 0, 3, 4], [10, 5, 4, 5], [20, 10, 5, 6], [30, 15, 6, 7]]
+        assert masks["objid"] == [100, 101, 102, 103]
+        # One source lacks the keyword, so every source gets the default
+        assert masks["c_id"] == [0, 0, 0, 0]
+        for k in range(4):
+            np.testing.assert_array_equal(masks.data(k), np.full((4 + k, 3 + k), k))
+
+    with pytest.raises(KeyError):
+        SourceMasks(mask_file, ["c_id"])
+
+
+def test_image_shape(mask_file):
+    assert image_shape(mask_file, ext=3) == (6, 5)
+
+
+def test_packed_layout_matches_hdus(mask_file, tmp_path):
+    """Test that the packed layout reads back the same columns and data as one HDU per source."""
+    with fits.open(mask_file) as hdul:
+        masks = [hdu.data for hdu in hdul[1:]]
+        columns = {
+            "BBOX": [hdu.header["BBOX"] for hdu in hdul[1:]],
+            "OBJID": [hdu.header["objid"] for hdu in hdul[1:]],
+        }
+    packed_file = str(tmp_path / "packed.fits")
+    write_packed_masks(packed_file, masks, columns)
+
+    keys = ["BBOX", "objid", "c_id"]
+    with SourceMasks(mask_file, keys, defaults={"c_id": 0}) as expected:
+        with SourceMasks(packed_file, keys, defaults={"c_id": 0}) as packed:
+            assert len(packed) == len(expected) == 4
+            assert packed.bbox == expected.bbox
+            assert packed.columns == expected.columns
+            for k in range(4):
+                np.testing.assert_array_equal(packed.data(k), expected.data(k))
+                assert packed.data(k).dtype == expected.data(k).dtype
+
+    with pytest.raises(KeyError):
+        SourceMasks(packed_file, ["c_id"])
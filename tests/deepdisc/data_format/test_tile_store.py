@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+from deepdisc.data_format.image_readers import TileStoreImageReader
+from deepdisc.data_format.tile_store import TileStore, write_tile_store
+
+
+@pytest.fixture
+def tile_store_file(tmp_path):
+    cubes = [np.random.rand(3, 8, 10).astype(np.float32), np.random.rand(3, 6, 6).astype(np.float32)]
+    filename = os.path.join(tmp_path, "tiles.dat")
+    write_tile_store(filename, cubes, ["a", "b"])
+    return filename, cubes
+
+
+def test_tile_store_round_trip(tile_store_file):
+    """Test that every cutout is read back as a memory mapped view with the stored values."""
+    filename, cubes = tile_store_file
+    store = TileStore(filename)
+    assert len(store) == 2
+    assert store.shape("b") == (3, 6, 6)
+    for key, cube in zip(["a", "b"], cubes):
+        view = store[key]
+        assert isinstance(view, np.memmap)
+        np.testing.assert_array_equal(view, cube)
+
+
+def test_tile_store_rejects_duplicate_keys(tmp_path):
+    cube = np.zeros((1, 2, 2))
+    with pytest.raises(ValueError):
+        write_tile_store(os.path.join(tmp_path, "tiles.dat"), [cube, cube], ["a", "a"])
+
+
+def test_tile_store_image_reader(tile_store_file):
+    """Test that the reader returns images with the same (h, w, band) layout as the FITS readers."""
+    filename, cubes = tile_store_file
+    ir = TileStoreImageReader(filename, norm="raw")
+    img = ir("a")
+    assert img.shape == (8, 10, 3)
+    assert img.dtype == np.float32
+    np.testing.assert_array_equal(img, np.transpose(cubes[0], (1, 2, 0)))
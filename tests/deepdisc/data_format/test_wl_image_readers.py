@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from scipy.ndimage import zoom
+
+from deepdisc.data_format.image_readers import wlDC2ImageReader, wlDC2psfImageReader
+
+
+@pytest.fixture
+def dc2_band_files(tmp_path):
+    """Write a small cutout as one FITS file per band, named {prefix}_{band}.fits"""
+    bands = ["u", "g", "r", "i", "z", "y"]
+    prefix = os.path.join(tmp_path, "3828_2,2_12")
+    rng = np.random.default_rng(0)
+    cube = rng.normal(size=(len(bands), 20, 16)).astype(np.float32)
+    for band, data in zip(bands, cube):
+        fits.PrimaryHDU(data=data).writeto(f"{prefix}_{band}.fits")
+    return prefix, cube
+
+
+def test_read_wl_dc2_data(dc2_band_files):
+    """Test that the bands are stacked into an (h, w, band) float32 image."""
+    prefix, cube = dc2_band_files
+    ir = wlDC2ImageReader(norm="raw")
+    img = ir(prefix)
+    assert img.shape == (20, 16, 6)
+    assert img.dtype == np.float32
+    np.testing.assert_array_equal(img, np.transpose(cube, (1, 2, 0)))
+
+
+def test_threaded_reads_match_serial_reads(dc2_band_files):
+    """Test that io_threads gives the same image as reading the bands one after another."""
+    prefix, _ = dc2_band_files
+    serial = wlDC2ImageReader(norm="raw")(prefix)
+    threaded = wlDC2ImageReader(norm="raw", io_threads=6)(prefix)
+    np.testing.assert_array_equal(serial, threaded)
+
+
+def test_buffer_pool_reuses_buffers(dc2_band_files):
+    """Test that pooled reads cycle through buffer_pool float32 buffers per shape."""
+    prefix, cube = dc2_band_files
+    ir = wlDC2ImageReader(norm="raw", buffer_pool=2)
+    images = [ir(prefix) for _ in range(3)]
+    assert images[0] is not images[1]
+    assert images[2] is images[0]
+    assert images[0].dtype == np.float32
+    np.testing.assert_array_equal(images[2], np.transpose(cube, (1, 2, 0)))
+
+
+def test_inplace_zscore_matches_reference(dc2_band_files):
+    """Test that zscore applied in place on a pooled buffer gives the same result as on a copy."""
+    prefix, _ = dc2_band_files
+    raw = wlDC2ImageReader(norm="raw")(prefix)
+    expected = wlDC2ImageReader.zscore(raw.copy(), A=2.0)
+    img = wlDC2ImageReader(norm="zscore", buffer_pool=1, A=2.0)(prefix)
+    np.testing.assert_allclose(img, expected, rtol=1e-6)
+
+
+def test_lupton_float_matches_lupton(dc2_band_files):
+    """Test that the float lupton scaling agrees with the uint8 astropy version up to quantization."""
+    prefix, _ = dc2_band_files
+    im = wlDC2ImageReader(norm="raw")(prefix) * 10
+    expected = wlDC2ImageReader.lupton(im)
+    scaled = wlDC2ImageReader.lupton_float(im)
+    assert scaled.dtype == np.float32
+    assert scaled.shape == expected.shape
+    np.testing.assert_allclose(scaled, expected, atol=1.0)
+
+
+def test_zscore_writes_to_out(dc2_band_files):
+    prefix, _ = dc2_band_files
+    im = wlDC2ImageReader(norm="raw")(prefix)
+    out = np.empty_like(im)
+    scaled = wlDC2ImageReader.zscore(im, out=out)
+    assert scaled is out
+    mean = np.mean(scaled, axis=-1)
+    np.testing.assert_allclose([mean.mean(), mean.std()], [0, 1], atol=1e-5)
+
+
+def test_psf_grid_matches_psf_images(dc2_band_files):
+    """Test that upsampling a coarse PSF grid gives the full resolution PSF planes."""
+    prefix, cube = dc2_band_files
+    grid = np.random.default_rng(1).uniform(0.5, 1.0, size=(6, 5, 4)).astype(np.float32)
+    np.save(f"{prefix}_psfgrid.npy", grid)
+    for band, plane in zip(["u", "g", "r", "i", "z", "y"], grid):
+        fits.PrimaryHDU(data=zoom(plane, (4, 4), order=1)).writeto(f"{prefix}_{band}_psfs.fits")
+
+    full = wlDC2psfImageReader(norm="raw")(prefix)
+    compact = wlDC2psfImageReader(norm="raw", psf_grid=True)(prefix)
+    assert compact.shape == full.shape == (20, 16, 12)
+    np.testing.assert_array_equal(compact[:, :, :6], np.transpose(cube, (1, 2, 0)))
+    np.testing.assert_allclose(compact, full, rtol=1e-6)
@@ -0,0 +1,85 @@
+import numpy as np
+
+from deepdisc.preprocessing.blends import footprint_boxes, group_overlapping_boxes
+
+
+def brute_force_groups(boxes, pad):
+    """Connected components of the box overlap graph, by flood fill."""
+    n = len(boxes)
+    overlap = np.zeros((n, n), dtype=bool)
+    for i in range(n):
+        for j in range(n):
+            overlap[i, j] = (
+                boxes[i, 0] < boxes[j, 2] + pad
+                and boxes[j, 0] < boxes[i, 2] + pad
+                and boxes[i, 1] < boxes[j, 3] + pad
+                and boxes[j, 1] < boxes[i, 3] + pad
+            )
+    labels = -np.ones(n, dtype=int)
+    for i in range(n):
+        if labels[i] >= 0:
+            continue
+        stack = [i]
+        labels[i] = i
+        while stack:
+            k = stack.pop()
+            for j in np.where(overlap[k] & (labels < 0))[0]:
+                labels[j] = i
+                stack.append(j)
+    return sorted(sorted(np.where(labels == label)[0].tolist()) for label in np.unique(labels))
+
+
+def test_group_overlapping_boxes():
+    """Test that chains of overlapping boxes are grouped, and separated boxes are not."""
+    boxes = np.array(
+        [
+            [0, 0, 10, 10],
+            [50, 50, 60, 60],
+            [8, 8, 20, 20],
+            [18, 30, 25, 40],
+            [100, 0, 110, 10],
+        ]
+    )
+    groups = group_overlapping_boxes(boxes)
+    assert [g.tolist() for g in groups] == [[0, 2], [1], [3], [4]]
+
+    # Box 3 is 10 pixels to the right of box 2
+    groups = group_overlapping_boxes(boxes, pad=11)
+    assert [g.tolist() for g in groups] == [[0, 2, 3], [1], [4]]
+
+
+def test_group_overlapping_boxes_random():
+    """Test the sweep against a brute force search of the overlap graph."""
+    rng = np.random.default_rng(0)
+    origins = rng.integers(0, 500, size=(200, 2))
+    sizes = rng.integers(3, 30, size=(200, 2))
+    boxes = np.hstack([origins, origins + sizes])
+    for pad in [0, 5]:
+        groups = [g.tolist() for g in group_overlapping_boxes(boxes, pad=pad)]
+        assert sorted(groups) == brute_force_groups(boxes, pad)
+        assert sum(len(g) for g in groups) == len(boxes)
+
+
+def test_group_overlapping_boxes_empty():
+    assert group_overlapping_boxes(np.zeros((0, 4), dtype=int)) == []
+
+
+def test_footprint_boxes():
+    """Test that centers in one footprint share its box, and isolated centers get the smallest box."""
+    yy, xx = np.mgrid[:80, :80]
+    image = np.random.default_rng(0).normal(scale=0.01, size=(80, 80))
+    # Two touching sources and one far away
+    for y, x in [(20, 20), (20, 27), (60, 60)]:
+        image += np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / (2 * 2.0**2))
+
+    centers = [(20, 20), (20, 27), (60, 60), (5, 70), (78, 2)]
+    boxes = footprint_boxes(image, centers, lvl=5, min_size=5)
+    np.testing.assert_array_equal(boxes[0], boxes[1])
+    assert boxes[0, 1] < 20 - 2 and boxes[0, 3] > 27 + 2
+    assert boxes[2, 0] < 60 - 2 and boxes[2, 2] > 60 + 2
+    np.testing.assert_array_equal(boxes[3], [3, 68, 8, 73])
+    # Clipped to the image
+    np.testing.assert_array_equal(boxes[4], [76, 0, 80, 5])
+
+    groups = group_overlapping_boxes(boxes)
+    assert [g.tolist() for g in groups] == [[0, 1], [2], [3], [4]]
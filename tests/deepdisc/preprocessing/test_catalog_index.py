@@ -0,0 +1,44 @@
+import pickle
+
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.wcs import WCS
+
+from deepdisc.preprocessing.catalog_index import build_catalog_index
+
+
+@pytest.fixture
+def catalog():
+    rng = np.random.default_rng(0)
+    ra = rng.uniform(-1.0, 1.0, 20000) % 360.0
+    dec = rng.uniform(-31.0, -29.0, 20000)
+    return ra, dec
+
+
+def make_wcs(ra, dec, scale=0.2 / 3600):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [500.5, 400.5]
+    wcs.wcs.cdelt = [-scale, scale]
+    return wcs
+
+
+@pytest.mark.parametrize("center_ra", [0.0, 0.5])
+def test_query_footprint_matches_full_projection(tmp_path, catalog, center_ra):
+    """Test that the footprint query finds every row inside the image, also across RA = 0."""
+    ra, dec = catalog
+    index = build_catalog_index(ra, dec, str(tmp_path / "index"), zone_height=0.05)
+    wcs = make_wcs(center_ra, -30.0, scale=2.0 / 3600)
+
+    xs, ys = wcs.world_to_pixel(SkyCoord(ra=ra, dec=dec, unit="deg"))
+    inside = np.where((xs >= 0) & (xs < 1000 - 1) & (ys >= 0) & (ys < 800 - 1))[0]
+
+    rows, coords = index.query_footprint(wcs, (800, 1000), return_coords=True)
+    assert len(rows) < len(ra)
+    assert set(inside) <= set(rows)
+    np.testing.assert_allclose(coords.ra.deg, ra[rows])
+
+    # The index is shared with workers by pickling only its location
+    assert np.array_equal(pickle.loads(pickle.dumps(index)).query_footprint(wcs, (800, 1000)), rows)
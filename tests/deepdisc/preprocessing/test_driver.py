@@ -0,0 +1,90 @@
+import json
+import os
+
+import numpy as np
+
+from deepdisc.preprocessing.driver import build_manifest, read_fit_telemetry, read_status, run_jobs
+
+
+def touch_job(tract, patch, sp, outdir, fail_sp=()):
+    """A job that writes one file per sub-patch, and fails on the sub-patches in fail_sp."""
+    if sp in fail_sp:
+        raise RuntimeError(f"bad sub-patch {sp}")
+    with open(os.path.join(outdir, f"{tract}_{patch}_{sp}.txt"), "w") as f:
+        f.write(str(os.environ.get("OMP_NUM_THREADS")))
+
+
+def test_run_jobs_records_failures_and_resumes(tmp_path):
+    """Test that a rerun only runs the jobs that did not complete."""
+    manifest = str(tmp_path / "jobs.jsonl")
+    status = str(tmp_path / "status.jsonl")
+    jobs = build_manifest(manifest, [(3828, "2,2")], nblocks=2)
+    assert len(jobs) == 4
+
+    summary = run_jobs(manifest, status, touch_job, {"outdir": str(tmp_path), "fail_sp": (1,)})
+    assert summary == {"done": 3, "failed": 1}
+    assert "bad sub-patch 1" in read_status(status)["3828_2,2_1"]["error"]
+
+    # A killed run can leave a partial line behind
+    with open(status, "a") as f:
+        f.write('{"job_id": "3828_2,2_0", "sta')
+    os.remove(tmp_path / "3828_2,2_0.txt")
+
+    summary = run_jobs(manifest, status, touch_job, {"outdir": str(tmp_path)})
+    assert summary == {"done": 1, "failed": 0}
+    assert not os.path.exists(tmp_path / "3828_2,2_0.txt")
+    assert all(record["status"] == "done" for record in read_status(status).values())
+
+
+def test_run_jobs_process_pool(tmp_path):
+    """Test that jobs run in spawned workers with the requested thread limit."""
+    manifest = str(tmp_path / "jobs.jsonl")
+    status = str(tmp_path / "status.jsonl")
+    build_manifest(manifest, [(3828, "2,2"), (3828, "2,3")], nblocks=2)
+
+    summary = run_jobs(manifest, status, touch_job, {"outdir": str(tmp_path)}, num_workers=2, threads_per_worker=3)
+    assert summary == {"done": 8, "failed": 0}
+    with open(tmp_path / "3828_2,3_3.txt") as f:
+        assert f.read() == "3"
+    assert len(read_status(status)) == 8
+
+
+def telemetry_job(tract, patch, sp):
+    """A job that reports the fit record of one blend per source count."""
+    return {"blends": [{"n_sources": n, "iterations": 5 * n, "stop": "budget"} for n in range(1, sp + 2)]}
+
+
+def test_read_fit_telemetry(tmp_path):
+    """Test that the blend records returned by the jobs are collected from the status log."""
+    manifest = str(tmp_path / "jobs.jsonl")
+    status = str(tmp_path / "status.jsonl")
+    build_manifest(manifest, [(3828, "2,2")], nblocks=2)
+    run_jobs(manifest, status, telemetry_job)
+
+    telemetry = read_fit_telemetry(status)
+    assert len(telemetry) == 1 + 2 + 3 + 4
+    assert set(telemetry["job_id"]) == {f"3828_2,2_{sp}" for sp in range(4)}
+    assert telemetry.groupby("job_id")["iterations"].sum()["3828_2,2_3"] == 5 * (1 + 2 + 3 + 4)
+
+
+def extraction_job(tract, patch, sp, num_workers):
+    """A job that extracts sources with a process pool of its own."""
+    from deepdisc.preprocessing.extraction import extract_tiled
+
+    rng = np.random.default_rng(sp)
+    image = rng.normal(scale=0.1, size=(64, 64))
+    image[10:13, 20:23] += 5
+    image[40:43, 50:53] += 5
+    catalog = extract_tiled(image, 5, 0.1, tile_size=32, overlap=8, num_workers=num_workers)
+    return {"n_sources": len(catalog)}
+
+
+def test_nested_pool_runs_serially_in_workers(tmp_path):
+    """Test that a job asking for its own process pool runs in the daemonic workers of run_jobs."""
+    manifest = str(tmp_path / "jobs.jsonl")
+    status = str(tmp_path / "status.jsonl")
+    build_manifest(manifest, [(3828, "2,2")], nblocks=2)
+
+    summary = run_jobs(manifest, status, extraction_job, {"num_workers": 2}, num_workers=2)
+    assert summary == {"done": 4, "failed": 0}
+    assert all(record["telemetry"]["n_sources"] == 2 for record in read_status(status).values())
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import sep
+
+from deepdisc.preprocessing.extraction import extract_tiled
+
+
+@pytest.fixture
+def detection_image():
+    """Gaussian sources on a noisy background, some of them across the tile seams."""
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:300, :260]
+    image = rng.normal(scale=0.1, size=(300, 260))
+    centers = np.column_stack([rng.uniform(5, 255, 60), rng.uniform(5, 295, 60)])
+    centers = np.vstack([centers, [[100.3, 50.0], [128.0, 127.6], [64.2, 200.0]]])
+    for x, y in centers:
+        image += 5 * np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / (2 * 1.5**2))
+    return image
+
+
+def sort_catalog(catalog):
+    return catalog[np.lexsort((catalog["x"], catalog["y"]))]
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_extract_tiled_matches_full_image(detection_image, num_workers):
+    """Test that the merged tile catalogs equal the catalog of the whole image."""
+    err = sep.Background(detection_image).globalrms
+    expected, expected_segmap = sep.extract(detection_image, 5, err=err, segmentation_map=True)
+
+    catalog, segmap = extract_tiled(
+        detection_image, 5, err, tile_size=64, overlap=16, num_workers=num_workers, segmentation_map=True
+    )
+    assert catalog.dtype == expected.dtype
+    assert len(catalog) == len(expected)
+    catalog, expected_sorted = sort_catalog(catalog), sort_catalog(expected)
+    for field in ["x", "y"]:
+        np.testing.assert_allclose(catalog[field], expected_sorted[field])
+    # Deblended siblings can trade a few ambiguous pixels, sep draws them at random
+    np.testing.assert_allclose(catalog["flux"], expected_sorted["flux"], rtol=0.05)
+    np.testing.assert_allclose(catalog["flux"].sum(), expected["flux"].sum())
+    np.testing.assert_array_equal(segmap > 0, expected_segmap > 0)
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from deepdisc.preprocessing import get_data
+from deepdisc.preprocessing.get_data import get_cutout, get_cutout_HSC, tile_patch, tile_patch_HSC
+
+SHAPE = (40, 48)
+NBLOCKS = 4
+
+
+def make_header(naxis=2):
+    wcs = WCS(naxis=naxis)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"] + ["BAND"] * (naxis - 2)
+    wcs.wcs.crpix = [24.0, 20.0] + [1.0] * (naxis - 2)
+    wcs.wcs.cdelt = [-5e-5, 5e-5] + [1.0] * (naxis - 2)
+    wcs.wcs.crval = [56.0, -30.0] + [1.0] * (naxis - 2)
+    return wcs.to_header()
+
+
+def band_image(band, offset=0.0):
+    """An image whose pixels encode their band and position."""
+    yy, xx = np.mgrid[: SHAPE[0], : SHAPE[1]]
+    return (1000 * band + 100 * yy + xx + offset).astype(np.float32)
+
+
+@pytest.fixture
+def dc2_patch(tmp_path, monkeypatch):
+    """A DC2 patch with its six bands in one HDU, and a full resolution PSF image per band."""
+    filters = ["u", "g", "r", "i", "z", "y"]
+    images = np.array([band_image(b) for b in range(len(filters))])
+    patch_psf = np.random.default_rng(0).random((len(filters), 5, 5)).astype(np.float32)
+    hdul = fits.HDUList(
+        [fits.PrimaryHDU(), fits.ImageHDU(data=images, header=make_header(3)), fits.ImageHDU(data=patch_psf)]
+    )
+    hdul.writeto(tmp_path / "3828_2,2_images.fits")
+
+    psf_dir = tmp_path / "psf"
+    os.makedirs(psf_dir / "3828" / "2,2")
+    for b, f in enumerate(filters):
+        psf_image = band_image(b, offset=0.5)
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data=psf_image, header=make_header())])
+        hdul.writeto(psf_dir / "3828" / "2,2" / f"{f}_psf_image.fits")
+    # get_cutout reads the PSF images from the module directory
+    monkeypatch.setattr(get_data, "DC2_PSF_IMG_DIR", str(psf_dir) + "/")
+    return str(tmp_path), str(psf_dir), patch_psf
+
+
+def test_tile_patch_matches_get_cutout(dc2_patch):
+    """Test that every sub-patch of tile_patch is the window get_cutout reads."""
+    dirpath, psf_dir, patch_psf = dc2_patch
+    blocks = list(tile_patch(dirpath, 3828, "2,2", nblocks=NBLOCKS, psf_dirpath=psf_dir))
+    assert [sp for sp, _, _, _ in blocks] == list(range(NBLOCKS**2))
+
+    for sp, cutout, dats_all, psf in blocks:
+        expected_cutout, expected, _ = get_cutout(dirpath, 3828, "2,2", sp, nblocks=NBLOCKS, get_psf=False)
+        assert cutout.slices_original == expected_cutout.slices_original
+        np.testing.assert_array_equal(dats_all, expected)
+        np.testing.assert_array_equal(psf, patch_psf)
+
+
+def test_tile_patch_windows(dc2_patch):
+    """Test the windows at the edges of the patch, and that each band is paired with its PSF."""
+    dirpath, psf_dir, _ = dc2_patch
+    blocks = list(tile_patch(dirpath, 3828, "2,2", nblocks=NBLOCKS, get_psf=False, psf_dirpath=psf_dir))
+    h, w = SHAPE[0] // NBLOCKS, SHAPE[1] // NBLOCKS
+
+    # The sub-patch index runs along x first
+    assert blocks[0][1].slices_original == (slice(0, h), slice(0, w))
+    assert blocks[1][1].slices_original == (slice(0, h), slice(w, 2 * w))
+    assert blocks[NBLOCKS][1].slices_original == (slice(h, 2 * h), slice(0, w))
+    assert blocks[-1][1].slices_original == (slice(SHAPE[0] - h, SHAPE[0]), slice(SHAPE[1] - w, SHAPE[1]))
+
+    for sp, cutout, dats_all, psf in blocks:
+        assert psf is None
+        assert dats_all.shape == (12, h, w)
+        window = cutout.slices_original
+        for b in range(6):
+            np.testing.assert_array_equal(dats_all[b], band_image(b)[window])
+            np.testing.assert_array_equal(dats_all[6 + b], band_image(b, offset=0.5)[window])
+
+
+@pytest.fixture
+def hsc_patch(tmp_path):
+    """An HSC patch with one calexp file per band, with the PSF in HDU 3."""
+    filters = ["G", "R", "I", "Z", "Y"]
+    os.makedirs(tmp_path / "9813" / "4,4")
+    for b, f in enumerate(filters):
+        hdul = fits.HDUList(
+            [
+                fits.PrimaryHDU(),
+                fits.ImageHDU(data=band_image(b), header=make_header()),
+                fits.ImageHDU(),
+                fits.ImageHDU(data=np.full((5, 5), b, dtype=np.float32)),
+            ]
+        )
+        hdul.writeto(tmp_path / "9813" / "4,4" / f"calexp-HSC-{f}-9813-4,4.fits")
+    return str(tmp_path) + "/", filters
+
+
+def test_tile_patch_HSC_matches_get_cutout_HSC(hsc_patch):
+    """Test that every sub-patch of tile_patch_HSC is the window get_cutout_HSC reads."""
+    dirpath, filters = hsc_patch
+    blocks = list(tile_patch_HSC(dirpath, 9813, "4,4", nblocks=NBLOCKS, filters=filters))
+    assert len(blocks) == NBLOCKS**2
+
+    for sp, cutout, datsm, psf in blocks:
+        expected_cutout, expected, expected_psf = get_cutout_HSC(
+            dirpath, 9813, "4,4", sp, nblocks=NBLOCKS, filters=filters
+        )
+        assert cutout.slices_original == expected_cutout.slices_original
+        np.testing.assert_array_equal(datsm, expected)
+        # The PSF of the last filter
+        np.testing.assert_array_equal(psf, expected_psf)
+        np.testing.assert_array_equal(psf, 4)
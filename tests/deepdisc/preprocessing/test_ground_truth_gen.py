@@ -1,7 +1,24 @@
+import filecmp
+
 import numpy as np
+import pandas as pd
 import pytest
+import scarlet
 import sep
-from deepdisc.preprocessing.detection import mad_wavelet_own
+from deepdisc.data_format.annotation_functions.mask_reader import SourceMasks
+from deepdisc.preprocessing import detection
+from deepdisc.preprocessing.blends import FittedSource
+from deepdisc.preprocessing.detection import (
+    fit_scarlet_blend,
+    iteration_budget,
+    mad_first_scale,
+    make_catalog,
+    mad_wavelet_own,
+    run_scarlet,
+    starlet_coefficients,
+)
+from deepdisc.preprocessing.driver import build_manifest, read_status, run_jobs
+from deepdisc.preprocessing.process import StreamingResultsWriter, write_scarlet_results_nomodels
 
 
 @pytest.fixture
@@ -14,3 +31,198 @@ def one_channel_image():
 def test_mad_wavelet_own(one_channel_image):
     mad_own = mad_wavelet_own(one_channel_image)
     assert mad_own > 0
+
+
+def test_shared_starlet_matches_separate_transforms():
+    """Test that one per-band transform gives the detection image and the per-band noise."""
+    cube = np.random.default_rng(0).normal(size=(3, 32, 32))
+    coefficients = starlet_coefficients(cube)
+
+    detect = scarlet.Starlet.from_image(cube.sum(axis=0)).coefficients[:3].sum(axis=0)
+    np.testing.assert_allclose(coefficients[:, :3].sum(axis=(0, 1)), detect, atol=1e-10)
+    np.testing.assert_allclose(mad_first_scale(coefficients[:, 0]), [mad_wavelet_own(band) for band in cube])
+
+
+def test_make_catalog_needs_three_scales():
+    """Test that coefficients without 3 scales and the residual are rejected for wavelet detection."""
+    cube = np.random.default_rng(0).normal(size=(3, 32, 32))
+    with pytest.raises(ValueError, match="3 starlet scales"):
+        make_catalog(cube, wave=True, coefficients=starlet_coefficients(cube, scales=2))
+
+
+def test_iteration_budget():
+    """Test that the iteration cap grows with the number of sources up to max_iters."""
+    assert iteration_budget(3, max_iters=50) == 50
+    assert iteration_budget(1, max_iters=50, iters_per_source=4, min_iters=10) == 14
+    assert iteration_budget(5, max_iters=50, iters_per_source=4, min_iters=10) == 30
+    assert iteration_budget(100, max_iters=50, iters_per_source=4, min_iters=10) == 50
+
+
+def make_two_source_scene():
+    """Two gaussian sources in two bands, with their positions in an external catalog."""
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:40, :40]
+    datas = rng.normal(scale=0.01, size=(2, 40, 40))
+    for (y, x), flux in zip([(12, 12), (28, 26)], [1.0, 2.0]):
+        profile = np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / (2 * 2.0**2))
+        datas += flux * np.array([1.0, 1.5])[:, None, None] * profile
+    catalog = pd.DataFrame({"new_x": [12.0, 26.0], "new_y": [12.0, 28.0]})
+    return datas.astype(np.float32), catalog
+
+
+@pytest.fixture
+def two_source_scene():
+    return make_two_source_scene()
+
+
+def test_run_scarlet_fits_blend_only_on_request(monkeypatch, two_source_scene):
+    """Test that the joint blend is only fit with fit_blend=True."""
+    datas, catalog = two_source_scene
+    calls = []
+
+    def fake_fit(starlet_sources, observation, catalog, **kwargs):
+        calls.append(len(starlet_sources))
+        return None, 0.0, {"n_sources": len(starlet_sources)}
+
+    monkeypatch.setattr(detection, "fit_scarlet_blend", fake_fit)
+    kwargs = dict(catalog=catalog, weights=np.ones_like(datas), plot_likelihood=False)
+    _, sources, _, _, _ = run_scarlet(datas, ["g", "r"], **kwargs)
+    assert len(sources) > 0
+    assert calls == []
+
+    records = []
+    run_scarlet(datas, ["g", "r"], fit_blend=True, fit_records=records, **kwargs)
+    assert calls == [len(sources)]
+    assert records == [{"n_sources": len(sources)}]
+
+
+def init_scene_sources(datas, catalog):
+    """Initializes the sources of a scene as run_scarlet does."""
+    model_frame = scarlet.Frame(datas.shape, psf=scarlet.GaussianPSF(sigma=1), channels=["g", "r"])
+    observation = scarlet.Observation(
+        datas, psf=scarlet.GaussianPSF(sigma=2), weights=np.ones_like(datas), channels=["g", "r"]
+    ).match(model_frame)
+    centers = list(zip(catalog["new_y"], catalog["new_x"]))
+    sources, _ = scarlet.initialization.init_all_sources(
+        model_frame,
+        centers,
+        observation,
+        max_components=5,
+        thresh=0.1,
+        fallback=False,
+        silent=True,
+        set_spectra=False,
+    )
+    return sources, observation
+
+
+def test_fit_scarlet_blend_is_one_fit(two_source_scene):
+    """Test that the budgeted fit matches a single scarlet fit with the same stopping rule."""
+    datas, catalog = two_source_scene
+    sources, observation = init_scene_sources(datas, catalog)
+    it, logL = scarlet.Blend(sources, observation).fit(20, e_rel=1e-6)
+
+    sources, observation = init_scene_sources(datas, catalog)
+    _, fit_logL, record = fit_scarlet_blend(
+        sources, observation, catalog, max_iters=20, e_rel=1e-6, plot_likelihood=False, return_record=True
+    )
+    assert record["iterations"] == it
+    np.testing.assert_allclose(fit_logL, logL)
+    assert record["stop"] == ("converged" if it < 20 else "budget")
+
+    # The log likelihood plateau stops the fit early
+    sources, observation = init_scene_sources(datas, catalog)
+    _, _, record = fit_scarlet_blend(
+        sources, observation, catalog, max_iters=200, e_rel=0.1, plot_likelihood=False, return_record=True
+    )
+    assert record["stop"] == "converged"
+    assert record["iterations"] < 200
+
+
+def independent_blends_job(tract, patch, sp, num_workers):
+    """A job that fits independent blends with a process pool of its own."""
+    datas, catalog = make_two_source_scene()
+    _, sources, _, _, _ = run_scarlet(
+        datas,
+        ["g", "r"],
+        catalog=catalog,
+        weights=np.ones_like(datas),
+        plot_likelihood=False,
+        max_iters=2,
+        independent_blends=True,
+        num_workers=num_workers,
+    )
+    return {"n_sources": len(sources)}
+
+
+def test_independent_blends_in_run_jobs(tmp_path):
+    """Test that independent blends are fit serially in the daemonic workers of run_jobs."""
+    manifest = str(tmp_path / "jobs.jsonl")
+    status = str(tmp_path / "status.jsonl")
+    build_manifest(manifest, [(3828, "2,2")], nblocks=1)
+
+    summary = run_jobs(manifest, status, independent_blends_job, {"num_workers": 2}, num_workers=2)
+    assert summary == {"done": 1, "failed": 0}
+    assert read_status(status)["3828_2,2_0"]["telemetry"]["n_sources"] == 2
+
+
+@pytest.fixture
+def fitted_scene():
+    """Fitted sources with their masks and DC2 truth catalog rows."""
+    rng = np.random.default_rng(0)
+    sources, masks = [], []
+    for k in range(4):
+        model = rng.random((2, 5 + k, 6)).astype(np.float32)
+        sources.append(FittedSource((0, 3 * k, k), model, model))
+        masks.append((model.sum(axis=0) > 1).astype(np.float32))
+    columns = ["redshift", "id", "mag_i", "shear_1", "shear_2", "convergence"]
+    columns += ["ellipticity_1_true", "ellipticity_2_true", "size_true"]
+    catalog = pd.DataFrame(rng.random((4, len(columns))), columns=columns)
+    catalog["id"] = np.arange(4)
+    catalog.loc[1, "mag_i"] = np.nan
+    return sources, masks, catalog
+
+
+def test_streaming_writer_matches_nomodels(tmp_path, fitted_scene):
+    """Test that the streamed masks file is identical to the one written at the end."""
+    rng = np.random.default_rng(1)
+    filters = ["g", "r"]
+    sources, masks, catalog = fitted_scene
+
+    expected_dir, streamed_dir = tmp_path / "expected", tmp_path / "streamed"
+    expected_dir.mkdir()
+    streamed_dir.mkdir()
+    datas = rng.random((2, 20, 20))
+    write_scarlet_results_nomodels(
+        datas, None, sources, None, masks, str(expected_dir), filters, "s", catalog=catalog
+    )
+
+    with StreamingResultsWriter(str(streamed_dir), filters, write_models=True) as writer:
+        for k, src in enumerate(sources):
+            writer.write(src, src.rendered, masks[k], catalog.iloc[k])
+    assert filecmp.cmp(expected_dir / "masks.fits", streamed_dir / "masks.fits", shallow=False)
+    assert sorted(p.name for p in streamed_dir.iterdir()) == ["masks.fits", "model_g.fits", "model_r.fits"]
+
+
+def test_packed_masks_match_hdus(tmp_path, fitted_scene):
+    """Test that the packed mask layout reads back like one HDU per source."""
+    sources, masks, catalog = fitted_scene
+    datas = np.zeros((2, 20, 20))
+    for layout in ["hdus", "packed"]:
+        (tmp_path / layout).mkdir()
+        outdir = str(tmp_path / layout)
+        write_scarlet_results_nomodels(
+            datas, None, sources, None, masks, outdir, ["g", "r"], "s", catalog=catalog, layout=layout
+        )
+
+    keys = ["BBOX", "AREA", "redshift", "objid", "mag_i", "shear_1", "shear_2", "kappa"]
+    keys += ["et_1", "et_2", "size_1"]
+    with SourceMasks(str(tmp_path / "hdus" / "masks.fits"), keys) as expected:
+        with SourceMasks(str(tmp_path / "packed" / "masks.fits"), keys) as packed:
+            assert len(packed) == len(expected) == 4
+            assert packed.bbox == expected.bbox
+            assert packed["mag_i"][1] == -1
+            for key in keys[1:]:
+                np.testing.assert_allclose(packed[key], expected[key])
+            for k in range(4):
+                np.testing.assert_array_equal(packed.data(k), expected.data(k))
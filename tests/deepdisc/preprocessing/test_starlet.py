@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from scipy.ndimage import correlate1d
+
+from deepdisc.preprocessing.starlet import (
+    bspline_convolve,
+    mad_wavelet,
+    starlet_reconstruction,
+    starlet_transform,
+)
+
+
+@pytest.fixture
+def image_stack():
+    return np.random.default_rng(0).normal(size=(3, 40, 36))
+
+
+def test_bspline_convolve_matches_dilated_convolution(image_stack):
+    """Test the separable convolution against a dilated B3-spline with zero edges."""
+    for scale in range(3):
+        step = 2**scale
+        weights = np.zeros(4 * step + 1)
+        weights[::step] = [1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16]
+        expected = correlate1d(image_stack, weights, axis=-2, mode="constant")
+        expected = correlate1d(expected, weights, axis=-1, mode="constant")
+        np.testing.assert_allclose(bspline_convolve(image_stack, scale), expected, atol=1e-12)
+
+
+@pytest.mark.parametrize("generation", [1, 2])
+def test_starlet_transform_batched(image_stack, generation):
+    """Test that a stack is transformed like each image separately and reconstructs exactly."""
+    coefficients = starlet_transform(image_stack, scales=3, generation=generation)
+    assert coefficients.shape == (3, 4, 40, 36)
+    for image, expected in zip(image_stack, coefficients):
+        np.testing.assert_allclose(starlet_transform(image, scales=3, generation=generation), expected)
+    np.testing.assert_allclose(starlet_reconstruction(coefficients, generation=generation), image_stack, atol=1e-10)
+
+
+def test_starlet_transform_float32(image_stack):
+    """Test that float32 input is transformed in float32."""
+    coefficients = starlet_transform(image_stack.astype(np.float32), scales=2)
+    assert coefficients.dtype == np.float32
+    np.testing.assert_allclose(coefficients, starlet_transform(image_stack, scales=2), atol=1e-5)
+    assert mad_wavelet(image_stack).shape == (3,)
+
+
+def test_starlet_transform_torch(image_stack):
+    """Test that the torch backend gives the numpy coefficients."""
+    pytest.importorskip("torch")
+    np.testing.assert_allclose(
+        starlet_transform(image_stack, scales=3, backend="torch"), starlet_transform(image_stack, scales=3)
+    )
+
+
+def test_starlet_transform_matches_scarlet(image_stack):
+    """Test the coefficients against scarlet."""
+    scarlet = pytest.importorskip("scarlet")
+    expected = scarlet.Starlet.from_image(image_stack[0], scales=3).coefficients
+    np.testing.assert_allclose(starlet_transform(image_stack[0], scales=3), expected, atol=1e-10)